@@ -0,0 +1,45 @@
+# 2つのベンチマーク結果 (benchmarks/run.py の出力) を比較する
+# 使い方: python -m benchmarks.compare base.json head.json --threshold 0.1
+# p50/p99 が threshold の割合を超えて悪化した計測があれば終了コード 1 を返す
+import sys
+import json
+import argparse
+from benchmarks.run import format_rss
+
+def load(path: str):
+    with open(path, "r", encoding="utf-8") as f:
+        document = json.load(f)
+    return document["meta"], {(r["name"], r["size"], r["mode"]): r for r in document["results"]}
+
+def change(base: float, head: float) -> float:
+    return (head - base) / base if base else 0.0
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two benchmark result files")
+    parser.add_argument("base")
+    parser.add_argument("head")
+    parser.add_argument("--threshold", type=float, default=0.1, help="回帰とみなす悪化の割合")
+    args = parser.parse_args()
+
+    base_meta, base = load(args.base)
+    head_meta, head = load(args.head)
+    print(f"base {base_meta.get('commit')}  head {head_meta.get('commit')}")
+
+    regressions = 0
+    for key in sorted(base.keys() & head.keys(), key=lambda k: (k[0], k[1], k[2])):
+        b, h = base[key], head[key]
+        p50, p99 = change(b["p50_ms"], h["p50_ms"]), change(b["p99_ms"], h["p99_ms"])
+        regressed = p50 > args.threshold or p99 > args.threshold
+        regressions += regressed
+        print(
+            f"{'REGRESSION' if regressed else '':>10} {key[0]:>24} {key[1]:>7} {key[2]:>10}  "
+            f"p50 {b['p50_ms']:8.2f} -> {h['p50_ms']:8.2f} ms ({p50:+.0%})  "
+            f"p99 {b['p99_ms']:8.2f} -> {h['p99_ms']:8.2f} ms ({p99:+.0%})  "
+            f"rss {format_rss(b.get('peak_rss_mb'))} -> {format_rss(h.get('peak_rss_mb'))}"
+        )
+    for key in sorted(base.keys() ^ head.keys()):
+        print(f"{'':>10} {key[0]:>24} {key[1]:>7} {key[2]:>10}  only in {'base' if key in base else 'head'}")
+    sys.exit(1 if regressions else 0)
+
+if __name__ == "__main__":
+    main()
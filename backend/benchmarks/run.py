@@ -0,0 +1,255 @@
+# バックエンドの主要なエンドポイントがプロジェクトの規模に対してどう伸びるかを計測するベンチマーク
+#
+# 使い方 (backend ディレクトリで実行):
+#   python -m benchmarks.run --sizes 1000,10000 --output benchmarks/results/latest.json
+#   python -m benchmarks.run --sizes 1000,10000,100000 --projects 500
+#
+# 合成プロジェクトは一時的な作業ディレクトリ (--workdir で指定可) の datas/ 以下に作成するため，既存のデータには触れない
+# 各エンドポイントを TestClient から1件ずつ呼び出して計測し (mode=sequential)，
+# 一覧・取得・更新は同時接続の負荷をかけた場合も計測する (mode=concurrent)
+# 結果は JSON で出力し，benchmarks/compare.py でコミット間の比較ができる
+import os
+import sys
+import json
+import time
+import random
+import logging
+import shutil
+import asyncio
+import argparse
+import platform
+import tempfile
+import subprocess
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+BACKEND_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BACKEND_ROOT not in sys.path:
+    sys.path.insert(0, BACKEND_ROOT)
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+# 計測ごとのピークRSS
+# ru_maxrss はプロセス全体の最大値で下がらないため，Linux では計測の開始時に /proc/self/clear_refs で
+# ピーク (VmHWM) をリセットし，その計測の間の最大値を読む
+# 計測の開始時に常駐していた分を除いた増加量も記録する
+# リセットできない環境では計測ごとの値にならないため None を返す
+def _proc_status_mb(field: str) -> Optional[float]:
+    with open("/proc/self/status", "r") as f:
+        for line in f:
+            if line.startswith(f"{field}:"):
+                return int(line.split()[1]) / 1024
+    return None
+
+# ピークをリセットし，開始時のRSS (MB) を返す
+def reset_peak_rss() -> Optional[float]:
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return _proc_status_mb("VmRSS")
+    except OSError:
+        return None
+
+def peak_rss_mb(start_rss: Optional[float]) -> Dict:
+    peak = _proc_status_mb("VmHWM") if start_rss is not None else None
+    return {
+        "peak_rss_mb": peak,
+        "peak_rss_growth_mb": peak - start_rss if peak is not None else None,
+    }
+
+def summarize(name: str, size: int, mode: str, latencies: List[float], elapsed: float, start_rss: Optional[float], errors: int = 0, **extra) -> Dict:
+    return {
+        "name": name,
+        "size": size,
+        "mode": mode,
+        "requests": len(latencies),
+        "errors": errors,
+        "mean_ms": sum(latencies) / len(latencies) * 1000 if latencies else 0.0,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p90_ms": percentile(latencies, 0.90) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "max_ms": max(latencies) * 1000 if latencies else 0.0,
+        "throughput_rps": len(latencies) / elapsed if elapsed > 0 else 0.0,
+        **peak_rss_mb(start_rss),
+        **extra,
+    }
+
+# TestClient から request を iterations 回呼び出して計測する
+def run_sequential(name: str, size: int, iterations: int, request: Callable[[int], object]) -> Dict:
+    latencies = []
+    errors = 0
+    start_rss = reset_peak_rss()
+    started = time.perf_counter()
+    for i in range(iterations):
+        start = time.perf_counter()
+        response = request(i)
+        latency = time.perf_counter() - start
+        if response.status_code >= 400:
+            errors += 1
+        else:
+            latencies.append(latency)
+    return summarize(name, size, "sequential", latencies, time.perf_counter() - started, start_rss, errors)
+
+# ASGIアプリに対して concurrency 本の同時接続から合計 total 件のリクエストを送る
+def run_concurrent(app, name: str, size: int, concurrency: int, total: int, method: str, url: Callable[[int], str], body: Callable[[int], Dict] = None) -> Dict:
+    import httpx
+
+    async def load():
+        latencies = []
+        errors = 0
+        counter = iter(range(total))
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            async def worker():
+                nonlocal errors
+                for i in counter:
+                    start = time.perf_counter()
+                    response = await client.request(method, url(i), json=body(i) if body else None)
+                    if response.status_code >= 400:
+                        errors += 1
+                    else:
+                        latencies.append(time.perf_counter() - start)
+
+            started = time.perf_counter()
+            await asyncio.gather(*(worker() for _ in range(concurrency)))
+            return latencies, errors, time.perf_counter() - started
+
+    start_rss = reset_peak_rss()
+    latencies, errors, elapsed = asyncio.run(load())
+    return summarize(name, size, "concurrent", latencies, elapsed, start_rss, errors, concurrency=concurrency)
+
+def git_revision() -> Dict:
+    def git(*args):
+        try:
+            return subprocess.check_output(["git", *args], cwd=BACKEND_ROOT, stderr=subprocess.DEVNULL, text=True).strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+    return {"commit": git("rev-parse", "HEAD"), "dirty": bool(git("status", "--porcelain", "--untracked-files=no"))}
+
+def format_rss(value: Optional[float]) -> str:
+    return f"{value:7.1f} MB" if value is not None else "    n/a"
+
+def report(result: Dict):
+    print(
+        f"{result['name']:>24} {result['size']:>7} {result['mode']:>10}  "
+        f"p50 {result['p50_ms']:8.2f} ms  p99 {result['p99_ms']:8.2f} ms  "
+        f"{result['throughput_rps']:8.1f} req/s  rss {format_rss(result['peak_rss_mb'])} (+{format_rss(result['peak_rss_growth_mb']).strip()})"
+        + (f"  errors {result['errors']}" if result["errors"] else ""),
+        file=sys.stderr,
+    )
+
+def run_benchmarks(args) -> List[Dict]:
+    from fastapi.testclient import TestClient
+    from benchmarks.synthetic import make_project, make_projects, synthetic_png
+    import main
+
+    # リクエストごとのログは計測の邪魔になるため抑える
+    logging.getLogger().setLevel(logging.WARNING)
+
+    results = []
+
+    def record(result: Dict):
+        report(result)
+        results.append(result)
+
+    rng = random.Random(args.seed)
+    print(f"creating {args.projects} small projects", file=sys.stderr)
+    make_projects(args.projects)
+
+    with TestClient(main.app) as client:
+        for size in args.sizes:
+            print(f"creating project with {size} images", file=sys.stderr)
+            started = time.perf_counter()
+            pid = make_project(size, name=f"bench-{size}", seed=size)
+            print(f"  done in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+            images = [anno["image"] for anno in client.get(f"/annotation/get_annotations?pid={pid}&fields=image").json()["annotations"]]
+
+            record(run_sequential("get_annotations_page", size, args.iterations,
+                                  lambda i: client.get(f"/annotation/get_annotations?pid={pid}&limit=100&offset={rng.randrange(max(1, size - 100))}")))
+            record(run_sequential("get_annotations_all", size, max(1, args.iterations // 10),
+                                  lambda i: client.get(f"/annotation/get_annotations?pid={pid}")))
+
+            def add_body(i):
+                return {"pid": pid, "image": rng.choice(images), "sys": "s", "user": "u", "label": f"bench label {i}", "dataset_split": "train"}
+            record(run_sequential("add_annotation", size, args.iterations,
+                                  lambda i: client.post("/annotation/add_annotation", json=add_body(i))))
+
+            # 初回はすべてのレコードをエンコードし，2回目以降は変更の無い行を再利用する
+            record(run_sequential("annojson2dataset_cold", size, 1,
+                                  lambda i: client.post(f"/annotation/generate-jsonl?pid={pid}")))
+            record(run_sequential("annojson2dataset_warm", size, max(1, args.iterations // 20),
+                                  lambda i: client.post(f"/annotation/generate-jsonl?pid={pid}")))
+
+            record(run_concurrent(main.app, "get_annotations_page", size, args.concurrency, args.iterations * 4, "GET",
+                                  lambda i: f"/annotation/get_annotations?pid={pid}&limit=100&offset={rng.randrange(max(1, size - 100))}"))
+            record(run_concurrent(main.app, "add_annotation", size, args.concurrency, args.iterations * 4, "POST",
+                                  lambda i: "/annotation/add_annotation", add_body))
+
+        projects = args.projects + len(args.sizes)
+        record(run_sequential("list_projects", projects, args.iterations, lambda i: client.get("/projects/list")))
+        record(run_sequential("search_projects", projects, args.iterations,
+                              lambda i: client.get(f"/projects/search?keyword=small-{rng.randrange(max(1, args.projects))}")))
+        record(run_concurrent(main.app, "list_projects", projects, args.concurrency, args.iterations * 4, "GET",
+                              lambda i: "/projects/list"))
+        record(run_concurrent(main.app, "search_projects", projects, args.concurrency, args.iterations * 4, "GET",
+                              lambda i: f"/projects/search?keyword=small-{rng.randrange(max(1, args.projects))}"))
+
+        # プロジェクト作成はアップロードする画像の枚数で計測する
+        uploads = [("files", (f"upload_{i}.png", synthetic_png(5_000_000 + i, size=64), "image/png")) for i in range(args.create_images)]
+        record(run_sequential("create_project", args.create_images, max(1, args.iterations // 10),
+                              lambda i: client.post("/projects/create", data={"name": f"bench-create-{i}", "default_role": "r", "description": "d"}, files=uploads)))
+
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the backend hot paths against synthetic projects")
+    parser.add_argument("--sizes", default="1000,10000", help="カンマ区切りのプロジェクトの画像数")
+    parser.add_argument("--projects", type=int, default=200, help="一覧・検索用に作成する小さなプロジェクトの数")
+    parser.add_argument("--iterations", type=int, default=100, help="1計測あたりのリクエスト数")
+    parser.add_argument("--concurrency", type=int, default=16, help="同時接続の計測で使う接続数")
+    parser.add_argument("--create-images", type=int, default=50, help="create_project の計測でアップロードする画像数")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workdir", help="合成プロジェクトを作成するディレクトリ (指定しない場合は一時ディレクトリを作成して削除する)")
+    parser.add_argument("--output", help="結果を書き出すJSONファイル (指定しない場合は標準出力)")
+    args = parser.parse_args()
+    args.sizes = [int(size) for size in args.sizes.split(",") if size]
+
+    output = os.path.abspath(args.output) if args.output else None
+    workdir = os.path.abspath(args.workdir) if args.workdir else tempfile.mkdtemp(prefix="visiontunehub-bench-")
+    os.makedirs(os.path.join(workdir, "datas"), exist_ok=True)
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        started = time.time()
+        results = run_benchmarks(args)
+    finally:
+        os.chdir(cwd)
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    document = {
+        "meta": {
+            **git_revision(),
+            "timestamp": datetime.now().isoformat(),
+            "duration_s": time.time() - started,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "args": {key: value for key, value in vars(args).items() if key not in ("workdir", "output")},
+        },
+        "results": results,
+    }
+    text = json.dumps(document, indent=2, ensure_ascii=False)
+    if output:
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+        with open(output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+# ベンチマーク用の合成プロジェクトを datas/ 以下に作成する
+# アップロードAPIは経由せず，取り込み後と同じ構成 (コンテンツハッシュ名の画像・annotation.db・annotation.json・project_info.json) を直接書き出す
+import io
+import os
+import uuid
+import random
+import hashlib
+from datetime import datetime
+from typing import List
+from PIL import Image
+from utils.annotation_store import get_store
+from utils.fileio import write_json_atomic
+
+# 画像ごとに内容が異なる小さなPNG (色で区別する)
+def synthetic_png(index: int, size: int = 16) -> bytes:
+    color = (index % 256, (index // 256) % 256, (index // 65536) % 256)
+    buffer = io.BytesIO()
+    Image.new("RGB", (size, size), color).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+# images 枚の画像を持つプロジェクトを作成してIDを返す
+# labeled_ratio の割合のレコードにはラベルを付けておく
+def make_project(images: int, name: str = "bench", labeled_ratio: float = 0.5, train_ratio: float = 0.8, seed: int = 0) -> str:
+    rng = random.Random(seed)
+    project_id = str(uuid.uuid4())
+    project_root = os.path.join("datas", project_id)
+    imgs_dir = os.path.join(project_root, "imgs")
+    os.makedirs(imgs_dir, exist_ok=True)
+
+    annotations = []
+    for i in range(images):
+        data = synthetic_png(seed * 1_000_003 + i)
+        filename = f"{hashlib.sha256(data).hexdigest()}.png"
+        with open(os.path.join(imgs_dir, filename), "wb") as f:
+            f.write(data)
+        labeled = rng.random() < labeled_ratio
+        annotations.append({
+            "image": filename,
+            "sys": "You are an image captioner.",
+            "user": "Describe the image." if labeled else "",
+            "label": f"synthetic caption {i}" if labeled else "",
+            "dataset_split": "train" if rng.random() < train_ratio else "val",
+        })
+
+    store = get_store(project_id, create=True)
+    store.insert_many(annotations)
+    store.export_json()
+    write_json_atomic(os.path.join(project_root, "project_info.json"), {
+        "id": project_id,
+        "name": name,
+        "image_count": images,
+        "created_at": datetime.now().isoformat(),
+        "dir_path": os.path.abspath(project_root),
+        "description": f"synthetic project with {images} images",
+        "model": "",
+    })
+    return project_id
+
+# 小さなプロジェクトを count 個作成する (一覧・検索の計測用)
+def make_projects(count: int, images: int = 10) -> List[str]:
+    return [make_project(images, name=f"bench-small-{i}", seed=10_000 + i) for i in range(count)]
@@ -0,0 +1,42 @@
+# 本番用の gunicorn 設定 (uvicorn ワーカーを複数起動する)
+# 使い方: gunicorn -c gunicorn.conf.py main:app
+#
+# 環境変数
+#   WEB_CONCURRENCY: ワーカープロセス数 (既定は CPU コア数 x 2 + 1，最大 8)
+#   KEEPALIVE: Keep-Alive 接続を保持する時間 (秒)
+#   LIMIT_CONCURRENCY: 1ワーカーあたりの同時接続数の上限 (超えた分は 503 を返す，0 の場合は無制限)
+#   BACKLOG: 接続待ちキューの長さ
+#   WORKER_TIMEOUT: 応答の無いワーカーを再起動するまでの時間 (秒)
+#   GRACEFUL_TIMEOUT: 終了時に処理中のリクエストとジョブを待つ時間 (秒)
+#   MAX_REQUESTS: ワーカーを再起動するまでのリクエスト数 (0 の場合は再起動しない)
+import os
+import multiprocessing
+from uvicorn_worker import UvicornWorker
+
+bind = f"{os.environ.get('BACKEND_HOST', '0.0.0.0')}:{os.environ.get('BACKEND_PORT', '8080')}"
+workers = int(os.environ.get("WEB_CONCURRENCY", min(multiprocessing.cpu_count() * 2 + 1, 8)))
+keepalive = int(os.environ.get("KEEPALIVE", 5))
+backlog = int(os.environ.get("BACKLOG", 2048))
+timeout = int(os.environ.get("WORKER_TIMEOUT", 120))
+graceful_timeout = int(os.environ.get("GRACEFUL_TIMEOUT", 30))
+max_requests = int(os.environ.get("MAX_REQUESTS", 0))
+max_requests_jitter = int(os.environ.get("MAX_REQUESTS_JITTER", 0))
+
+# SQLite の接続やスレッドプールはワーカーごとに作る必要があるため，アプリはフォーク後に読み込む
+preload_app = False
+
+accesslog = "-"
+errorlog = "-"
+loglevel = os.environ.get("LOG_LEVEL", "info")
+
+LIMIT_CONCURRENCY = int(os.environ.get("LIMIT_CONCURRENCY", 0))
+
+# 同時接続数の上限と終了時の待ち時間を uvicorn に渡すワーカー
+class ProductionUvicornWorker(UvicornWorker):
+    CONFIG_KWARGS = {
+        **UvicornWorker.CONFIG_KWARGS,
+        "limit_concurrency": LIMIT_CONCURRENCY or None,
+        "timeout_graceful_shutdown": graceful_timeout,
+    }
+
+worker_class = ProductionUvicornWorker
@@ -1,14 +1,24 @@
-from fastapi import Depends, FastAPI, HTTPException, status
+import time
+from contextlib import asynccontextmanager
+from fastapi import Depends, FastAPI, HTTPException, Request, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import PlainTextResponse
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 from starlette.middleware.cors import CORSMiddleware
 from fastapi.openapi.docs import get_swagger_ui_html
-from fastapi.staticfiles import StaticFiles
 
 from routers import (
     annotation,
     playground,
-    projects
+    projects,
+    uploads
 )
+from utils.project_catalog import catalog
+from utils.jobs import jobs
+from utils.metrics import metrics
+from utils.image_files import ImageFiles
+from utils.profiling import RequestProfiler
+from utils.trash import reclaimer
 
 security = HTTPBasic()
 
@@ -24,12 +34,44 @@ def get_current_username(credentials: HTTPBasicCredentials = Depends(security)):
         )
     return credentials.username
 
-app = FastAPI(docs_url=None)
-app.mount("/images", StaticFiles(directory="./datas"), name="images")
+# 起動時にプロジェクトカタログを構築し，終了時は実行中のジョブを待ってから終了する
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    catalog.build()
+    reclaimer.start()
+    yield
+    await reclaimer.stop()
+    await jobs.shutdown()
+
+app = FastAPI(docs_url=None, lifespan=lifespan)
+# 画像はETagとキャッシュヘッダ付きで配信する (Range リクエストにも対応)
+app.mount("/images", ImageFiles(directory="./datas"), name="images")
 
 app.include_router(annotation.router)
 app.include_router(playground.router)
 app.include_router(projects.router)
+app.include_router(uploads.router)
+
+# リクエストごとのレイテンシをルート (パスのテンプレート) 単位で記録する
+# ストリーミングのレスポンスはヘッダを返すまでの時間になる
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    profiler = RequestProfiler.start(request)
+    start = time.perf_counter()
+    status_code = 500
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+    finally:
+        route = request.scope.get("route")
+        route_path = getattr(route, "path", None) or "unmatched"
+        metrics.observe_request(request.method, route_path, status_code, time.perf_counter() - start)
+        if profiler is not None:
+            profile_file = profiler.stop(request.method, route_path)
+        metrics.flush()
+    if profiler is not None:
+        response.headers["X-Profile-File"] = profile_file
+    return response
 
 # CORSを回避する
 app.add_middleware(
@@ -40,6 +82,11 @@ app.add_middleware(
     allow_headers=["*"]
 )
 
+# 全ワーカーのレイテンシと内部処理の所要時間を Prometheus のテキスト形式で返す
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    return PlainTextResponse(await run_in_threadpool(metrics.render), media_type="text/plain; version=0.0.4")
+
 # FastAPIドキュメントの認証機能の追加
 @app.get("/docs", dependencies=[Depends(get_current_username)], include_in_schema=False)
 async def get_documentation():
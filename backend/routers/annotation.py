@@ -1,12 +1,29 @@
-from fastapi import APIRouter, Depends, HTTPException, Form, UploadFile
+from fastapi import APIRouter, Depends, HTTPException, Form, UploadFile, Query, Request, Response
 from pydantic import BaseModel
-from typing import Optional
-from fastapi.responses import FileResponse
+from typing import List, Optional
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
+from fastapi.concurrency import run_in_threadpool
 import os
 import json
-import unicodedata
-import base64
+import hashlib
+import asyncio
+from datetime import datetime
 from urllib.parse import quote
+from utils.annotation_store import ANNOTATION_FIELDS, SEARCH_FIELDS, get_store, normalize_string
+from utils.annotation_search import search_annotations
+from utils.near_duplicates import MAX_NEAR_DUPLICATE_THRESHOLD, NEAR_DUPLICATE_THRESHOLD, near_duplicate_groups
+from utils.dataset_export import encode_image_cached, iter_dataset_archive, iter_dataset_lines, write_dataset
+from utils.jobs import jobs
+from utils.fileio import write_json_atomic
+from utils.metrics import span
+from routers.playground import MAX_BATCH_CONCURRENCY, get_client, image2txt, resolve_base_url
+
+# 変更フィードが新しい変更を確認する間隔 (秒)，keep-alive を送る間隔 (秒)，1回に読む件数
+CHANGE_FEED_POLL_INTERVAL = float(os.environ.get("CHANGE_FEED_POLL_INTERVAL", 0.5))
+CHANGE_FEED_HEARTBEAT = float(os.environ.get("CHANGE_FEED_HEARTBEAT", 15))
+CHANGE_FEED_BATCH = 500
+# 接続が切れた場合にブラウザが再接続するまでの時間 (ミリ秒)
+CHANGE_FEED_RETRY_MS = 2000
 
 # エンドポイントをグループ化するためのAPIRouterの設定
 router = APIRouter(
@@ -15,76 +32,112 @@ router = APIRouter(
 )
 
 # アノテーションデータを取得するエンドポイント
+# limit を指定するとページ単位で返す (offset または前ページの next_cursor で位置を指定)
+# dataset_split / labeled で絞り込み，fields (カンマ区切り) で返すフィールドを選択できる
+# ETag を返し，If-None-Match が一致する場合は 304 を返す
 @router.get("/get_annotations")
-async def get_annotations(pid: str):
+async def get_annotations(
+    request: Request,
+    pid: str,
+    offset: int = Query(0, ge=0),
+    limit: Optional[int] = Query(None, ge=1, le=1000),
+    cursor: Optional[int] = Query(None, ge=0),
+    dataset_split: Optional[str] = None,
+    labeled: Optional[bool] = None,
+    fields: Optional[str] = None,
+    include_project_info: bool = True
+):
     # プロジェクトルートの設定
     # project_root = f"./datas/{pid}"
     project_root = os.path.join("datas", f"{pid}")
-    annotation_file = os.path.join(project_root, "annotation.json")
     project_info_file = os.path.join(project_root, "project_info.json")
 
-    # アノテーションファイルの存在確認
-    if not os.path.exists(annotation_file):
+    # アノテーションストアの存在確認
+    try:
+        store = get_store(pid)
+    except FileNotFoundError:
         raise HTTPException(status_code=404, detail="Annotation file not found")
 
+    selected_fields = None
+    if fields:
+        selected_fields = [field.strip() for field in fields.split(",") if field.strip()]
+        unknown = [field for field in selected_fields if field not in ANNOTATION_FIELDS]
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+
+    # ストアのリビジョン・project_info.json の更新時刻・クエリからETagを作成
+    # SQLite の読み書きはイベントループを止めないようスレッドプールで行う
+    try:
+        info_mtime_ns = os.stat(project_info_file).st_mtime_ns if include_project_info else 0
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Project not found")
+    revision = await run_in_threadpool(lambda: store.revision)
+    etag_source = f"{pid}:{revision}:{info_mtime_ns}:{request.url.query}"
+    etag = f'W/"{hashlib.sha1(etag_source.encode("utf-8")).hexdigest()}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag in [tag.strip() for tag in request.headers.get("if-none-match", "").split(",")]:
+        return Response(status_code=304, headers=headers)
+
     try:
-        with open(project_info_file, "r") as f:
-            project_info = json.load(f)
-        # JSONファイルの読み込み
-        with open(annotation_file, "r") as f:
-            annotations = json.load(f)
-        return {"project_id": pid, "annotations": annotations, "project_info": project_info}
+        # 変更フィードはこの位置から購読すれば取りこぼしが無い (一覧の取得より先に読む)
+        change_seq = await run_in_threadpool(store.change_seq)
+        annotations, total, next_cursor = await run_in_threadpool(
+            store.query,
+            offset=offset,
+            limit=limit,
+            after_seq=cursor,
+            dataset_split=dataset_split,
+            labeled=labeled,
+            fields=selected_fields,
+        )
+        result = {
+            "project_id": pid,
+            "annotations": annotations,
+            "total": total,
+            "offset": offset,
+            "limit": limit,
+            "next_cursor": next_cursor,
+            "change_seq": change_seq,
+        }
+        if include_project_info:
+            with span("json.load"), open(project_info_file, "r") as f:
+                result["project_info"] = json.load(f)
+        return JSONResponse(result, headers=headers)
     except json.JSONDecodeError:
         # JSONの読み込みエラーに対応
         raise HTTPException(status_code=500, detail="Error reading annotation file")
 
-def encode_image(image_path):
-	with open(image_path, "rb") as image_file:
-		return base64.b64encode(image_file.read()).decode('utf-8')
+# 全プロジェクトのアノテーション (sys / user / label) を部分一致で検索するエンドポイント
+# field で検索対象のフィールドを，pid でプロジェクトを絞り込める
+# 一致したレコードをプロジェクトIDと画像名付きでページ単位に返し，プロジェクトごとの一致件数も返す
+@router.get("/search")
+async def search(
+    q: str = Query(..., min_length=1),
+    field: Optional[str] = None,
+    pid: Optional[str] = None,
+    offset: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=1000)
+):
+    if field is not None and field not in SEARCH_FIELDS:
+        raise HTTPException(status_code=400, detail=f"Unknown field: {field}")
+    if not q.strip():
+        raise HTTPException(status_code=400, detail="Empty query")
+    return await run_in_threadpool(search_annotations, q, field, pid, offset, limit)
 
 # アノテーションデータを元にデータセットを作成する関数
-def annojson2dataset(pid, dataset_split):
-    # プロジェクトルートとアノテーションファイルのパスを設定
-    # project_root = f"./datas/{pid}"
-    project_root = os.path.join("datas", f"{pid}")
-    annotation_file = os.path.join(project_root, "annotation.json")
-
-    # アノテーションファイルの読み込み
-    with open(annotation_file, "r") as f:
-        annotations = json.load(f)
-
-    # データセットファイルの作成
-    dataset_path = os.path.join(project_root, f"{dataset_split}_dataset.jsonl")
-    with open(dataset_path, "w", encoding="utf-8") as f:
-        for anno in annotations: # アノテーションごとに処理
-            if anno["dataset_split"] == dataset_split and (anno["sys"] != "") and (anno["user"] != "") and (anno["label"] != ""):
-                # 画像ファイルのパスを取得
-                image_path = os.path.join(project_root, "imgs", anno["image"])
-                # 画像データをBase64エンコード
-                base64_image = encode_image(image_path)
-                # エンコードした画像データをURL形式に変換
-                url = f"data:image/jpeg;base64,{base64_image}"
-                # JSONL形式のデータを作成
-                item = {
-                    "messages": [
-                        {"role": "system", "content": anno["sys"]},
-                        {"role": "user", "content": anno["user"]},
-                        {"role": "user", "content": [
-                            {"type": "image_url", "image_url": {"url": url}}
-                        ]},
-                        {"role": "assistant", "content": anno["label"]}
-                    ]
-                }
-                f.write(json.dumps(item, ensure_ascii=False) + '\n')
-
-    return dataset_path
+# 画像のエンコードはワーカープールで並列に行い，結果はディスクにキャッシュされる
+# 前回から変更の無いレコードは既存のJSONLから再利用し，(パス, 再利用/再生成件数) を返す
+# exclude_duplicates=True の場合は，ほぼ同じ画像のグループごとに最初の1件だけを含める
+def annojson2dataset(pid, dataset_split, exclude_duplicates=False):
+    return write_dataset(pid, dataset_split, exclude_duplicates)
 
 # データセットJSONLファイルを生成し，ダウンロード可能な形式で返すエンドポイント
 @router.post("/generate-jsonl")
-async def generate_jsonl(pid: str):
+async def generate_jsonl(pid: str, exclude_duplicates: bool = False):
     try:
-        train_path = annojson2dataset(pid, "train")
-        val_path = annojson2dataset(pid, "val")
+        # イベントループを塞がないようにスレッドプールで実行
+        train_path, train_stats = await run_in_threadpool(annojson2dataset, pid, "train", exclude_duplicates)
+        val_path, val_stats = await run_in_threadpool(annojson2dataset, pid, "val", exclude_duplicates)
         train_file_relative = os.path.relpath(train_path, ".")
         val_file_relative = os.path.relpath(val_path, ".")
         # ファイルの存在確認
@@ -92,7 +145,10 @@ async def generate_jsonl(pid: str):
             raise HTTPException(status_code=500, detail="JSONL file creation failed")
         return {
             "train_file": f"{train_file_relative}",
-            "val_file": f"{val_file_relative}"
+            "val_file": f"{val_file_relative}",
+            "reused": train_stats["reused"] + val_stats["reused"],
+            "regenerated": train_stats["regenerated"] + val_stats["regenerated"],
+            "stats": {"train": train_stats, "val": val_stats}
         }
     except Exception as e:
         # エラーが発生した場合に例外のトレースバックを表示
@@ -100,6 +156,73 @@ async def generate_jsonl(pid: str):
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
 
+# データセットのJSONLを生成しながらそのままレスポンスとして返すエンドポイント
+@router.get("/stream-jsonl")
+async def stream_jsonl(pid: str, split: str = "train", exclude_duplicates: bool = False):
+    try:
+        get_store(pid)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Annotation file not found")
+    return StreamingResponse(
+        (line.encode("utf-8") for line in iter_dataset_lines(pid, split, exclude_duplicates)),
+        media_type="application/jsonl",
+        headers={"Content-Disposition": f'attachment; filename="{quote(split)}.jsonl"'},
+    )
+
+# train / val のデータセットを圧縮しながらストリーミングでダウンロードするエンドポイント
+# JSONLファイルを作らずに行を生成してそのまま圧縮し，チャンク転送で返す
+# format=zip は split ごとのJSONLを1つのアーカイブにまとめ，shard_size (バイト) を指定すると
+# ファインチューニングAPIのアップロード上限に合わせて train-00001.jsonl のようなシャードに分ける
+# format=gzip は1つの split だけを .jsonl.gz で返す
+@router.get("/download-dataset")
+async def download_dataset(
+    pid: str,
+    format: str = "zip",
+    splits: str = "train,val",
+    shard_size: Optional[int] = Query(None, ge=1),
+    exclude_duplicates: bool = False
+):
+    try:
+        get_store(pid)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Annotation file not found")
+
+    selected_splits = [split.strip() for split in splits.split(",") if split.strip()]
+    if not selected_splits:
+        raise HTTPException(status_code=400, detail="No dataset split selected")
+    if format == "zip":
+        filename, media_type = f"{pid}_dataset.zip", "application/zip"
+    elif format == "gzip":
+        if len(selected_splits) != 1 or shard_size is not None:
+            raise HTTPException(status_code=400, detail="gzip format supports a single split without shards; use zip instead")
+        filename, media_type = f"{selected_splits[0]}.jsonl.gz", "application/gzip"
+    else:
+        raise HTTPException(status_code=400, detail=f"Unknown format: {format}")
+
+    return StreamingResponse(
+        iter_dataset_archive(pid, selected_splits, format, shard_size, exclude_duplicates),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{quote(filename)}"'},
+    )
+
+# ほぼ同じ画像 (連写やほとんど同じフレーム) のグループを返すエンドポイント
+# 取り込み時に計算した知覚ハッシュのハミング距離が threshold 以下の画像を1つのグループにまとめる
+# 各グループの先頭 (登録順で最初の画像) が代表で，データセットのエクスポートで exclude_duplicates を指定すると残りが除かれる
+@router.get("/near-duplicates")
+async def near_duplicates(pid: str, threshold: int = Query(NEAR_DUPLICATE_THRESHOLD, ge=0, le=MAX_NEAR_DUPLICATE_THRESHOLD)):
+    try:
+        store = get_store(pid)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Annotation file not found")
+    groups = await run_in_threadpool(near_duplicate_groups, pid, threshold)
+    return {
+        "project_id": pid,
+        "threshold": threshold,
+        "image_count": await run_in_threadpool(store.count),
+        "duplicate_count": sum(len(members) - 1 for members in groups),
+        "groups": groups,
+    }
+
 # ファイルをダウンロードするエンドポイント
 @router.get("/download")
 async def download_file(path: str):
@@ -115,22 +238,6 @@ async def download_file(path: str):
     print(filename)
     return FileResponse(path, media_type='application/json', filename=filename)
 
-# プロジェクトのアノテーション情報を取得するエンドポイント
-@router.get("/get_annotations")
-async def get_annotations(pid: str):
-    # project_root = f"./datas/{pid}"
-    project_root = os.path.join("datas", f"{pid}")
-    annotation_file = os.path.join(project_root, "annotation.json")
-    project_info_file = os.path.join(project_root, "project_info.json")
-
-    # アノテーションとプロジェクト情報の読み込み
-    with open(annotation_file, "r") as f:
-        annotations = json.load(f)
-    with open(project_info_file, "r") as f:
-        project_info = json.load(f)
-
-    return {"project_id": pid, "annotations": annotations, "project_info": project_info}
-
 # アノテーション情報のデータモデルを定義
 class AnnotationInfo(BaseModel):
     pid: str
@@ -140,52 +247,300 @@ class AnnotationInfo(BaseModel):
     label: str
     dataset_split: str
 
-# Unicode正規化を行う関数
-# 入力文字列の正規化を行い，一貫性を保つ
-def normalize_string(s: str) -> str:
-    return unicodedata.normalize('NFC', s.strip())
-
-# アノテーション情報を受け取り，JSONファイルを更新するエンドポイント
+# アノテーション情報を受け取り，対応するレコードだけを更新するエンドポイント
 @router.post("/add_annotation")
 async def add_annotation(anno_info: AnnotationInfo):
-    # project_root = f"./datas/{anno_info.pid}"
-    project_root = os.path.join("datas", f"{anno_info.pid}")
-    annotation_file = os.path.join(project_root, "annotation.json")
+    # アノテーションストアの存在確認
+    try:
+        store = get_store(anno_info.pid)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Annotation file not found")
+
+    # 画像名の索引を使って対応するレコードを更新
+    # 更新後のレコードは変更フィード (/annotation/changes) で配信するため，受け付けた内容だけを返す
+    try:
+        ack = await run_in_threadpool(store.save, anno_info.image, {
+            "sys": anno_info.sys,
+            "user": anno_info.user,
+            "label": anno_info.label,
+            "dataset_split": anno_info.dataset_split,
+        })
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error writing to annotation store: {str(e)}")
 
-    # アノテーションファイルの存在確認
-    if not os.path.exists(annotation_file):
+    if ack is None:
+        raise HTTPException(status_code=404, detail="Image not found in annotations")
+
+    return {"message": "Annotation updated successfully", **ack}
+
+# プロジェクトのアノテーションの変更を Server-Sent Events で配信するエンドポイント
+# 各イベントは1レコード分の変更 (upsert は現在の内容，delete は画像名) で，id に単調増加する seq を付ける
+# since (または再接続時の Last-Event-ID) より後の変更から配信し，履歴が残っていない場合は reset イベントを送る
+# 変更履歴はストアの SQLite にあるため，どのワーカーで書き込まれた変更も届く
+@router.get("/changes")
+async def changes(request: Request, pid: str, since: Optional[int] = Query(None, ge=0)):
+    try:
+        store = get_store(pid)
+    except FileNotFoundError:
         raise HTTPException(status_code=404, detail="Annotation file not found")
+    last_event_id = request.headers.get("last-event-id", "")
+    if last_event_id.isdigit():
+        since = int(last_event_id)
+    if since is None:
+        since = await run_in_threadpool(store.change_seq)
 
-    # JSONファイルの読み込み
+    def event(name: str, seq: int, data: dict) -> str:
+        return f"id: {seq}\nevent: {name}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+    async def stream():
+        position = since
+        yield f"retry: {CHANGE_FEED_RETRY_MS}\n" + event("ready", position, {"seq": position})
+        idle = 0.0
+        while not await request.is_disconnected():
+            try:
+                feed_store = get_store(pid)
+            except FileNotFoundError:
+                yield event("deleted", position, {"project_id": pid})
+                return
+            batch = await run_in_threadpool(feed_store.changes_since, position, CHANGE_FEED_BATCH)
+            if batch is None:
+                position = await run_in_threadpool(feed_store.change_seq)
+                yield event("reset", position, {"seq": position})
+                continue
+            for change in batch:
+                position = change["seq"]
+                yield event("change", position, change)
+            if len(batch) == CHANGE_FEED_BATCH:
+                continue
+            if batch:
+                idle = 0.0
+            elif idle >= CHANGE_FEED_HEARTBEAT:
+                # プロキシに接続を切られないよう，コメント行を定期的に送る
+                idle = 0.0
+                yield ": keep-alive\n\n"
+            await asyncio.sleep(CHANGE_FEED_POLL_INTERVAL)
+            idle += CHANGE_FEED_POLL_INTERVAL
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+# 部分更新用のデータモデル (None のフィールドは変更しない)
+class AnnotationPatch(BaseModel):
+    image: str
+    sys: Optional[str] = None
+    user: Optional[str] = None
+    label: Optional[str] = None
+    dataset_split: Optional[str] = None
+    draft: Optional[bool] = None
+
+class AnnotationBatch(BaseModel):
+    pid: str
+    updates: List[AnnotationPatch]
+
+# 複数のアノテーションをまとめて更新するエンドポイント
+# すべての更新を1つのトランザクションで書き込み，項目ごとの結果だけを返す
+@router.post("/batch_update")
+async def batch_update(batch: AnnotationBatch):
+    try:
+        store = get_store(batch.pid)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Annotation file not found")
+
+    updates = [
+        (normalize_string(patch.image), patch.model_dump(exclude={"image"}, exclude_none=True))
+        for patch in batch.updates
+    ]
     try:
-        with open(annotation_file, "r", encoding="utf-8") as f:
-            annotations = json.load(f)
+        results = await run_in_threadpool(store.update_many, updates)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error writing to annotation store: {str(e)}")
+
+    statuses = []
+    for (image, fields), annotation in zip(updates, results):
+        if annotation is None:
+            status = "not_found"
+        elif not fields:
+            status = "unchanged"
+        else:
+            status = "updated"
+        statuses.append({"image": image, "status": status})
+
+    return {
+        "message": "Annotations updated successfully",
+        "updated": sum(1 for item in statuses if item["status"] == "updated"),
+        "results": statuses,
+    }
+
+# annotation.json をストアに取り込み直すエンドポイント
+@router.post("/import_json")
+async def import_json(pid: str):
+    try:
+        store = get_store(pid)
+        count = await run_in_threadpool(store.import_json)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Annotation file not found")
     except json.JSONDecodeError:
         raise HTTPException(status_code=500, detail="Error reading annotation file")
+    return {"message": "Annotations imported successfully", "count": count}
 
-    # 対応する画像のアノテーション情報を更新
-    updated = False
-    for annotation in annotations:
-        # JSONから取得した画像名とリクエストデータの画像名を標準化して比較
-        json_image = normalize_string(annotation.get("image", ""))
-        request_image = normalize_string(anno_info.image)
-
-        if json_image == request_image:
-            annotation["sys"] = anno_info.sys
-            annotation["user"] = anno_info.user
-            annotation["label"] = anno_info.label
-            annotation["dataset_split"] = anno_info.dataset_split
-            updated = True
-            break
-
-    if not updated:
-        raise HTTPException(status_code=404, detail="Image not found in annotations")
+# ストアの内容を annotation.json に書き出すエンドポイント
+@router.post("/export_json")
+async def export_json(pid: str):
+    try:
+        store = get_store(pid)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Annotation file not found")
+    path = await run_in_threadpool(store.export_json)
+    return {"message": "Annotations exported successfully", "path": os.path.relpath(path, ".")}
+
+# 事前ラベル付けのチェックポイントファイル
+def _prelabel_checkpoint_path(pid: str) -> str:
+    return os.path.join("datas", f"{pid}", "prelabel_checkpoint.json")
+
+def _save_prelabel_checkpoint(pid: str, checkpoint: dict):
+    write_json_atomic(_prelabel_checkpoint_path(pid), checkpoint)
+
+# ラベルが空のアノテーションにモデルの応答を下書きとして書き込むジョブ
+# 同時実行数を制限したワーカーで推論し，batch_size 件ごとにストアへ書き込んでチェックポイントを保存する
+# 書き込み済みのレコードはラベルが埋まるため，再開時には自然に対象から外れる
+async def _run_prelabel(job, pid, client, model, role, instruction, targets, concurrency, batch_size, checkpoint):
+    store = get_store(pid)
+    project_root = os.path.join("datas", f"{pid}")
+    queue = asyncio.Queue()
+    for anno in targets:
+        queue.put_nowait(anno)
+    pending = []
+
+    async def flush():
+        nonlocal pending
+        batch, pending = pending, []
+        if batch:
+            # 書き込みを待つ間に別の flush が件数を更新するため，待ち終えてから加算する
+            labeled = await run_in_threadpool(store.fill_drafts, batch)
+            checkpoint["labeled"] += labeled
+        checkpoint["updated_at"] = datetime.now().isoformat()
+        await run_in_threadpool(_save_prelabel_checkpoint, pid, checkpoint)
+
+    async def worker():
+        while True:
+            try:
+                anno = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            try:
+                image_path = os.path.join(project_root, "imgs", anno["image"])
+                encoded_image, mime = await run_in_threadpool(encode_image_cached, image_path)
+                result = await image2txt(
+                    client, encoded_image, model, role or anno["sys"], instruction or anno["user"], mime
+                )
+                pending.append((anno["image"], result["response"]))
+                job.advance()
+            except Exception as e:
+                checkpoint["failed"].append(anno["image"])
+                job.advance(failed=True, error=f"{anno['image']}: {str(e)}")
+            if len(pending) >= batch_size:
+                await flush()
 
-    # JSONファイルの書き込み
     try:
-        with open(annotation_file, "w", encoding="utf-8") as f:
-            json.dump(annotations, f, indent=4, ensure_ascii=False)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error writing to annotation file: {str(e)}")
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        checkpoint["status"] = "completed"
+    except BaseException:
+        checkpoint["status"] = "interrupted"
+        raise
+    finally:
+        await flush()
+
+    return {"labeled": checkpoint["labeled"], "failed": len(checkpoint["failed"])}
 
-    return {"message": "Annotation updated successfully", "annotations": annotations}
\ No newline at end of file
+# 事前ラベル付けを開始するエンドポイント
+# resume=True の場合は前回のチェックポイントの設定を引き継ぎ，失敗した画像は retry_failed=True でなければ対象外にする
+@router.post("/prelabel", status_code=202)
+async def start_prelabel(
+    pid: str = Form(...),
+    api_key: str = Form(...),
+    model: Optional[str] = Form(None),
+    role: Optional[str] = Form(None),
+    instruction: Optional[str] = Form(None),
+    dataset_split: Optional[str] = Form(None),
+    base_url: Optional[str] = Form(None),
+    concurrency: int = Form(4),
+    batch_size: int = Form(50),
+    resume: bool = Form(False),
+    retry_failed: bool = Form(False)
+):
+    try:
+        store = get_store(pid)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Annotation file not found")
+    base_url = resolve_base_url(base_url)
+
+    # 同じプロジェクトで実行中のジョブがある場合は開始しない
+    try:
+        with open(_prelabel_checkpoint_path(pid), "r", encoding="utf-8") as f:
+            previous = json.load(f)
+    except FileNotFoundError:
+        previous = None
+    running = jobs.get(previous["job_id"]) if previous and previous.get("job_id") else None
+    if running is not None and running.status == "running":
+        raise HTTPException(status_code=409, detail=f"Prelabeling is already running (job {running.id})")
+
+    checkpoint = None
+    if resume:
+        if previous is None:
+            raise HTTPException(status_code=404, detail="No prelabel checkpoint to resume")
+        checkpoint = previous
+        if retry_failed:
+            checkpoint["failed"] = []
+        model = model or checkpoint["model"]
+        role = role if role is not None else checkpoint["role"]
+        instruction = instruction if instruction is not None else checkpoint["instruction"]
+        dataset_split = dataset_split if dataset_split is not None else checkpoint["dataset_split"]
+    if not model:
+        raise HTTPException(status_code=400, detail="model is required")
+    if checkpoint is None:
+        checkpoint = {"labeled": 0, "failed": []}
+    # APIキーはチェックポイントに保存しない
+    checkpoint.update({
+        "pid": pid,
+        "model": model,
+        "role": role,
+        "instruction": instruction,
+        "dataset_split": dataset_split,
+        "status": "running",
+    })
+
+    skipped = set(checkpoint["failed"])
+    annotations = await run_in_threadpool(store.all)
+    targets = [
+        anno for anno in annotations
+        if anno["label"] == "" and anno["image"] not in skipped
+        and (dataset_split is None or anno["dataset_split"] == dataset_split)
+    ]
+    concurrency = max(1, min(concurrency, MAX_BATCH_CONCURRENCY))
+    client = get_client(api_key, base_url)
+
+    job = jobs.create("prelabel", total=len(targets), project_id=pid, model=model)
+    checkpoint["job_id"] = job.id
+    jobs.start(job, _run_prelabel(
+        job, pid, client, model, role, instruction, targets, concurrency, max(1, batch_size), checkpoint
+    ))
+    return {"message": "Prelabeling started", "job_id": job.id, "targets": len(targets), "resumed": resume}
+
+# 事前ラベル付けの進捗 (処理件数・スループット・エラー件数) を返すエンドポイント
+# 実行中のジョブが無い場合 (サーバーの再起動後など) はチェックポイントの内容を返す
+@router.get("/prelabel/status")
+async def prelabel_status(pid: str, job_id: Optional[str] = None):
+    job = jobs.get(job_id) if job_id else None
+    try:
+        with open(_prelabel_checkpoint_path(pid), "r", encoding="utf-8") as f:
+            checkpoint = json.load(f)
+    except FileNotFoundError:
+        checkpoint = None
+    if job is None and checkpoint is not None and checkpoint.get("job_id"):
+        job = jobs.get(checkpoint["job_id"])
+    if job is None and checkpoint is None:
+        raise HTTPException(status_code=404, detail="No prelabel job found")
+    return {"job": job.to_dict() if job else None, "checkpoint": checkpoint}
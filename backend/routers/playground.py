@@ -1,7 +1,17 @@
 from fastapi import APIRouter, Depends, HTTPException, File, UploadFile, Form
-from openai import OpenAI
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, APIConnectionError, APITimeoutError, InternalServerError, RateLimitError
+from typing import Dict, List, Optional
 import os
+import json
+import random
+import asyncio
 import base64
+from utils.annotation_store import get_store
+from utils.dataset_export import encode_image_cached
+from utils.response_cache import response_cache
+from utils.metrics import span
 
 # エンドポイントの設定
 router = APIRouter(
@@ -9,12 +19,69 @@ router = APIRouter(
     tags=["playground"]
 )
 
+# レート制限などで失敗した場合のリトライ回数と初回の待ち時間 (秒)
+MAX_RETRIES = int(os.environ.get("OPENAI_MAX_RETRIES", 5))
+RETRY_BASE_DELAY = float(os.environ.get("OPENAI_RETRY_BASE_DELAY", 1.0))
+# バッチ推論の同時実行数の上限
+MAX_BATCH_CONCURRENCY = int(os.environ.get("MAX_BATCH_CONCURRENCY", 16))
+
+RETRYABLE_ERRORS = (RateLimitError, APIConnectionError, APITimeoutError, InternalServerError)
+
+# 推論に使うOpenAI互換APIの接続先 (未設定の場合は OpenAI の API)
+OPENAI_BASE_URL = os.environ.get("OPENAI_BASE_URL") or None
+# リクエストの base_url で選べる接続先 (カンマ区切り)
+# 任意のホストにリクエストを送らせないよう，サーバーの設定に無い接続先は受け付けない
+OPENAI_ALLOWED_BASE_URLS = [url.strip().rstrip("/") for url in os.environ.get("OPENAI_ALLOWED_BASE_URLS", "").split(",") if url.strip()]
+
+# リクエストで指定された接続先を設定と照合する (指定が無い場合は OPENAI_BASE_URL)
+def resolve_base_url(base_url: Optional[str]) -> Optional[str]:
+    if not base_url:
+        return OPENAI_BASE_URL
+    base_url = base_url.rstrip("/")
+    if base_url != (OPENAI_BASE_URL or "").rstrip("/") and base_url not in OPENAI_ALLOWED_BASE_URLS:
+        raise HTTPException(status_code=400, detail="base_url is not allowed")
+    return base_url
+
+# 接続先ごとにコネクションプールを使い回す (APIキーごとのクライアントはキャッシュしない)
+# 接続先は設定で決まる数に限られるため，プールを閉じることはない
+_http_clients: Dict[Optional[str], DefaultAsyncHttpxClient] = {}
+
+# base_url は resolve_base_url で照合したものを渡す
+def get_client(api_key: str, base_url: Optional[str] = None) -> AsyncOpenAI:
+    http_client = _http_clients.get(base_url)
+    if http_client is None:
+        http_client = _http_clients[base_url] = DefaultAsyncHttpxClient()
+    # リトライはこのモジュールで行うため，クライアント側のリトライは無効にする
+    return AsyncOpenAI(api_key=api_key, base_url=base_url, max_retries=0, http_client=http_client)
+
 def encode_image(file):
-	return base64.b64encode(file.read()).decode('utf-8')
+	with span("base64.encode"):
+		return base64.b64encode(file.read()).decode('utf-8')
+
+# リトライ前の待ち時間 (Retry-After ヘッダがあればそれに従い，無ければ指数バックオフ)
+def _retry_delay(error: Exception, attempt: int) -> float:
+    response = getattr(error, "response", None)
+    if response is not None:
+        retry_after = response.headers.get("retry-after")
+        if retry_after:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+    return RETRY_BASE_DELAY * (2 ** attempt) * (0.5 + random.random() / 2)
+
+# use_cache=True の場合は，同じ画像・モデル・プロンプトに対する過去の応答をキャッシュから返す
+async def image2txt(client, encoded_image, model, role, instruction, mime="image/jpeg", use_cache=True):
+    cache_key = response_cache.make_key(
+        encoded_image, base_url=str(client.base_url), model=model, role=role, instruction=instruction
+    )
+    if use_cache:
+        cached = await run_in_threadpool(response_cache.get, cache_key)
+        if cached is not None:
+            return {"model": model, "role": role, "instruction": instruction, "response": cached["response"], "cached": True}
 
-def image2txt(client, encoded_image, model, role, instruction):
     base64_image = encoded_image
-    url = f"data:image/jpeg;base64,{base64_image}"
+    url = f"data:{mime};base64,{base64_image}"
 
     messages = [
         {"role": "system", "content": role},
@@ -30,15 +97,25 @@ def image2txt(client, encoded_image, model, role, instruction):
         },
     ]
 
-    completion = client.chat.completions.create(
-        model=model,
-        messages=messages
-    )
+    # レート制限や一時的なエラーの場合はバックオフしてリトライする
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            with span("openai.chat_completion"):
+                completion = await client.chat.completions.create(
+                    model=model,
+                    messages=messages
+                )
+            break
+        except RETRYABLE_ERRORS as e:
+            if attempt == MAX_RETRIES:
+                raise
+            await asyncio.sleep(_retry_delay(e, attempt))
 
     response = completion.choices[0].message.content
     print(response)
+    await run_in_threadpool(response_cache.put, cache_key, {"response": response})
 
-    return {"model": model, "role": role, "instruction": instruction, "response": response}
+    return {"model": model, "role": role, "instruction": instruction, "response": response, "cached": False}
 
 @router.post("/process_image", status_code=200)
 async def process_image(
@@ -46,19 +123,94 @@ async def process_image(
     role: str = Form(...),
     instruction: str = Form(...),
     file: UploadFile = File(...),
-    api_key: str = Form(...)
+    api_key: str = Form(...),
+    base_url: Optional[str] = Form(None),
+    no_cache: bool = Form(False)
 ):
+    # 接続先の確認 (許可されていない場合は 400)
+    base_url = resolve_base_url(base_url)
     try:
-        # OpenAIクライアントの初期化
-        client = OpenAI(api_key=api_key)
+        # OpenAIクライアントの取得
+        client = get_client(api_key, base_url)
 
         # ファイルをBase64エンコード
-        encoded_image = encode_image(file.file)
+        encoded_image = await run_in_threadpool(encode_image, file.file)
 
         # image2txtを呼び出し
-        result = image2txt(client, encoded_image, model, role, instruction)
+        result = await image2txt(client, encoded_image, model, role, instruction, file.content_type or "image/jpeg", use_cache=not no_cache)
 
         return {"message": "Success", "data": result}
 
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
+
+# 複数の画像に同じプロンプトで推論し，終わったものから順にNDJSONで返すエンドポイント
+# files を送るか，pid (と dataset_split) でプロジェクトの画像を指定する
+@router.post("/process_batch", status_code=200)
+async def process_batch(
+    model: str = Form(...),
+    role: str = Form(...),
+    instruction: str = Form(...),
+    api_key: str = Form(...),
+    files: List[UploadFile] = File([]),
+    pid: Optional[str] = Form(None),
+    dataset_split: Optional[str] = Form(None),
+    concurrency: int = Form(4),
+    base_url: Optional[str] = Form(None),
+    no_cache: bool = Form(False)
+):
+    client = get_client(api_key, resolve_base_url(base_url))
+    concurrency = max(1, min(concurrency, MAX_BATCH_CONCURRENCY))
+
+    # 推論対象の一覧 (画像名, Base64とMIMEタイプを返す関数)
+    targets = []
+    if pid is not None:
+        try:
+            annotations = get_store(pid).all()
+        except FileNotFoundError:
+            raise HTTPException(status_code=404, detail="Annotation file not found")
+        imgs_dir = os.path.join("datas", f"{pid}", "imgs")
+        for anno in annotations:
+            if dataset_split is None or anno["dataset_split"] == dataset_split:
+                image_path = os.path.join(imgs_dir, anno["image"])
+                targets.append((anno["image"], lambda path=image_path: encode_image_cached(path)))
+    for file in files:
+        # アップロードはレスポンス開始前に読み込んでおく (レスポンス中にファイルが閉じられるため)
+        encoded = await run_in_threadpool(encode_image, file.file)
+        targets.append((file.filename, lambda encoded=encoded, mime=file.content_type: (encoded, mime or "image/jpeg")))
+    if not targets:
+        raise HTTPException(status_code=400, detail="No images to process")
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(index, image, encode):
+        async with semaphore:
+            try:
+                encoded_image, mime = await run_in_threadpool(encode)
+                result = await image2txt(client, encoded_image, model, role, instruction, mime, use_cache=not no_cache)
+                return {"index": index, "image": image, "status": "ok", "response": result["response"], "cached": result["cached"]}
+            except Exception as e:
+                return {"index": index, "image": image, "status": "error", "error": str(e)}
+
+    async def stream():
+        tasks = [asyncio.ensure_future(run(i, image, encode)) for i, (image, encode) in enumerate(targets)]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield json.dumps(await next_done, ensure_ascii=False) + "\n"
+        finally:
+            # クライアントが切断した場合は残りの推論を取り消す
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+# 応答キャッシュのヒット/ミス回数と件数を返すエンドポイント
+@router.get("/cache_stats", status_code=200)
+async def cache_stats():
+    return await run_in_threadpool(response_cache.stats)
+
+# 応答キャッシュを空にするエンドポイント
+@router.delete("/cache", status_code=200)
+async def clear_cache():
+    await run_in_threadpool(response_cache.clear)
+    return {"message": "Response cache cleared"}
@@ -1,15 +1,26 @@
-from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, File, Form, Query
+from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, File, Form, Query, Request, Response
 from pydantic import BaseModel
 from typing import List
 import os
 import json
 import uuid
+import shutil
 from datetime import datetime
-from PIL import Image
 import random
 import logging
 from fastapi.logger import logger
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse
 import re
+from utils.annotation_store import get_store, close_store
+from utils.project_catalog import catalog
+from utils.ingest import stage_uploads, ingest_staged
+from utils.jobs import jobs
+from utils.blob_store import blob_store
+from utils.derivatives import get_thumbnail, schedule_thumbnails
+from utils.fileio import async_project_lock, write_json_atomic
+from utils.metrics import span
+from utils.trash import move_to_trash, purge, reclaimer, restore, trash_entries, trash_status
 
 logging.basicConfig(level=logging.INFO)
 
@@ -23,46 +34,32 @@ router = APIRouter(
 class ProjectCreateRequest(BaseModel):
     name: str # プロジェクト名
 
-@router.post("/create", status_code=status.HTTP_201_CREATED)
-async def create_project(
-    name: str = Form(...), # プロジェクト名
-    default_role: str = Form(...), # デフォルトのロール情報
-    description: str = Form(...), # プロジェクトの説明
-    files: List[UploadFile] = File(...), # アップロードされる画像ファイル
-    train_ratio: float = Form(0.8) # 学習データの割合
-):
-    if default_role is None:
-        default_role = ""
+# 画像の存在確認用のリクエストモデル
+class ImageExistsRequest(BaseModel):
+    paths: List[str] # /images 以下のパス
 
-    # プロジェクトIDの生成とディレクトリの準備
-    project_id = str(uuid.uuid4())
+# 1回の存在確認で受け付けるパスの数
+MAX_EXISTS_PATHS = 1000
+
+# 検証済みの画像からプロジェクトを作成する (ジョブとして実行される)
+# 画像の取り込みが終わってからストアと project_info.json を書き込むため，
+# 途中で失敗した場合は中途半端なプロジェクトを残さない
+async def finish_create_project(job, project_id, staged, name, default_role, description, train_ratio):
     project_root = f"./datas/{project_id}"
     imgs_dir = os.path.join(project_root, "imgs")
-    os.makedirs(imgs_dir, exist_ok=True)
 
-    annotations = [] # アノテーション情報を格納するリスト
-    image_paths = [] # 画像ファイルパスのリスト
+    try:
+        image_paths, dedup, hashes = await ingest_staged(job, staged, imgs_dir, project_id) # 画像ファイルパスのリスト
+    except BaseException:
+        shutil.rmtree(project_root, ignore_errors=True)
+        raise
+    finally:
+        shutil.rmtree(os.path.join(project_root, ".staging"), ignore_errors=True)
 
-    for file in files:
-        # アップロードされたファイルが画像かどうかを確認
-        try:
-            img = Image.open(file.file)
-            img.verify()  # PILを使って画像として検証
-            file.file.seek(0)
-        except (IOError, SyntaxError):
-            # 画像でない場合はスキップ
-            print(f"Skipped non-image file: {file.filename}")
-            continue
-
-        # 新しいユニークなファイル名を生成
-        file_extension = os.path.splitext(file.filename)[1]  # ファイル拡張子を取得
-        unique_file_name = f"{uuid.uuid4().hex}{file_extension}"  # ユニークな名前を生成
-        full_file_path = os.path.join(imgs_dir, unique_file_name)
-
-        # ファイル保存
-        with open(full_file_path, "wb") as buffer:
-            buffer.write(await file.read())
-        image_paths.append(full_file_path)
+    # UI用のサムネイルをバックグラウンドで作成しておく
+    schedule_thumbnails(image_paths)
+
+    annotations = [] # アノテーション情報を格納するリスト
 
     # データ分割
     random.shuffle(image_paths)
@@ -77,7 +74,8 @@ async def create_project(
             "sys": default_role,
             "user": "",
             "label": "",
-            "dataset_split": "train"
+            "dataset_split": "train",
+            "phash": hashes.get(img_path)
         })
 
     for img_path in val_images:
@@ -86,7 +84,8 @@ async def create_project(
             "sys": default_role,
             "user": "",
             "label": "",
-            "dataset_split": "val"
+            "dataset_split": "val",
+            "phash": hashes.get(img_path)
         })
 
     # プロジェクト情報を作成
@@ -100,15 +99,71 @@ async def create_project(
         "model": "",
     }
 
-    # project_info.json 作成
-    with open(os.path.join(project_root, "project_info.json"), "w") as f:
-        json.dump(project_info, f, indent=4, ensure_ascii=False)
+    try:
+        # アノテーションストアの作成 (互換性のため annotation.json も書き出す)
+        store = get_store(project_id, create=True)
+        store.insert_many(annotations)
+        store.export_json()
+
+        # project_info.json 作成
+        write_json_atomic(os.path.join(project_root, "project_info.json"), project_info)
+    except BaseException:
+        close_store(project_id)
+        shutil.rmtree(project_root, ignore_errors=True)
+        blob_store.release_project(project_id)
+        raise
+    catalog.update(project_id)
+
+    # 結果はジョブとして保存されるため，アノテーションの内容ではなく件数だけを返す
+    return {"message": "Project created successfully", "project": project_info, "added": len(annotations), "job_id": job.id, "dedup": dedup}
+
+# background=True の場合はアップロードの書き出しだけを行って 202 とジョブIDを返し，
+# 画像の検証と登録は /projects/jobs/{job_id} で進捗を確認できるバックグラウンドジョブで行う
+@router.post("/create", status_code=status.HTTP_201_CREATED)
+async def create_project(
+    response: Response,
+    name: str = Form(...), # プロジェクト名
+    default_role: str = Form(...), # デフォルトのロール情報
+    description: str = Form(...), # プロジェクトの説明
+    files: List[UploadFile] = File(...), # アップロードされる画像ファイル
+    train_ratio: float = Form(0.8), # 学習データの割合
+    background: bool = Form(False) # バックグラウンドで処理するかどうか
+):
+    if default_role is None:
+        default_role = ""
 
-    # annotation.json 作成
-    with open(os.path.join(project_root, "annotation.json"), "w") as f:
-        json.dump(annotations, f, indent=4, ensure_ascii=False)
+    # プロジェクトIDの生成とディレクトリの準備
+    project_id = str(uuid.uuid4())
+    project_root = f"./datas/{project_id}"
+    imgs_dir = os.path.join(project_root, "imgs")
+    os.makedirs(imgs_dir, exist_ok=True)
 
-    return {"message": "Project created successfully", "project": project_info, "annotations": annotations}
+    # アップロードをチャンク単位でディスクに書き出す
+    try:
+        staged = await stage_uploads(files, os.path.join(project_root, ".staging"))
+    except BaseException:
+        shutil.rmtree(project_root, ignore_errors=True)
+        raise
+
+    job = jobs.create("create_project", total=len(staged), project_id=project_id)
+    coro = finish_create_project(job, project_id, staged, name, default_role, description, train_ratio)
+    if background:
+        jobs.start(job, coro)
+        response.status_code = status.HTTP_202_ACCEPTED
+        return {"message": "Project creation started", "job_id": job.id, "project_id": project_id}
+
+    try:
+        return await jobs.run(job, coro)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Project creation failed: {str(e)}")
+
+# ジョブの進捗を取得するエンドポイント
+@router.get("/jobs/{job_id}", status_code=status.HTTP_200_OK)
+async def get_job(job_id: str):
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
 
 # プロジェクトを削除するエンドポイント
 @router.delete("/delete/{project_id}", status_code=status.HTTP_200_OK)
@@ -117,170 +172,214 @@ async def delete_project(project_id: str):
     # project_root = f"./datas/{project_id}"
     project_root = os.path.join("datas", f"{project_id}")
 
-    # ディレクトリとその内容を削除
+    # ディレクトリをゴミ箱に移す (書き込み中の処理が終わるのを待ってから移す)
+    # ファイルの削除とブロブの解放は取り消せる期間を過ぎてからバックグラウンドで行う
+    trashed = None
     if os.path.exists(project_root):
-        for root, dirs, files in os.walk(project_root, topdown=False):
-            for file in files:
-                os.remove(os.path.join(root, file))
-            for dir in dirs:
-                os.rmdir(os.path.join(root, dir))
-        os.rmdir(project_root)
-
-    return {"message": f"Project '{project_id}' deleted"}
+        try:
+            async with async_project_lock(project_id):
+                close_store(project_id)
+                trashed = await run_in_threadpool(move_to_trash, project_id)
+        except FileNotFoundError:
+            # 同時に削除された
+            pass
+    catalog.remove(project_id)
+
+    return {"message": f"Project '{project_id}' moved to trash", "trash": trashed}
+
+# ゴミ箱のプロジェクトの一覧 (削除を取り消せる期限と解放の状況) を返すエンドポイント
+@router.get("/trash", status_code=status.HTTP_200_OK)
+async def list_trash():
+    return await run_in_threadpool(trash_entries)
+
+# ゴミ箱のプロジェクト1件の状態を返すエンドポイント
+@router.get("/trash/{project_id}", status_code=status.HTTP_200_OK)
+async def get_trash_status(project_id: str):
+    entry = await run_in_threadpool(trash_status, project_id)
+    if entry is None:
+        raise HTTPException(status_code=404, detail="Project not found in trash")
+    return entry
+
+# 削除を取り消し，プロジェクトを元に戻すエンドポイント
+@router.post("/trash/{project_id}/restore", status_code=status.HTTP_200_OK)
+async def restore_project(project_id: str):
+    try:
+        await run_in_threadpool(restore, project_id)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Project not found in trash")
+    except BlockingIOError:
+        raise HTTPException(status_code=409, detail="Project is being reclaimed")
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    catalog.update(project_id)
+    return {"message": f"Project '{project_id}' restored", "project_id": project_id}
+
+# 取り消せる期間を待たずにディスクを解放するエンドポイント
+@router.delete("/trash/{project_id}", status_code=status.HTTP_202_ACCEPTED)
+async def purge_project(project_id: str):
+    try:
+        entry = await run_in_threadpool(purge, project_id)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Project not found in trash")
+    reclaimer.wake()
+    return entry
 
 # プロジェクトの一覧を取得するエンドポイント
+# datas ディレクトリは走査せず，カタログの内容を返す
 @router.get("/list", status_code=status.HTTP_200_OK)
 async def list_projects():
-    # プロジェクトが格納されているディレクトリ
-    datas_dir = os.path.abspath("./datas")
-    project_summaries = []
-
-    # datasディレクトリを探索
-    if os.path.exists(datas_dir):
-        for project_id in os.listdir(datas_dir): 
-            project_root = os.path.join(datas_dir, project_id)
-            project_info_path = os.path.join(project_root, "project_info.json") 
-            imgs_dir = os.path.join(project_root, "imgs")
-            first_image = None
-
-            # プロジェクト情報を読み込み
-            if os.path.exists(project_info_path):
-                with open(project_info_path, "r", encoding="utf-8") as f:
-                    info = json.load(f)
-
-                # 最初の画像ファイルを取得
-                if os.path.exists(imgs_dir):
-                    images = [img for img in os.listdir(imgs_dir) if img.lower().endswith(('png', 'jpg', 'jpeg', 'gif'))]
-                    if images:
-                        first_image = os.path.join(imgs_dir, images[0])
-
-                # サマリー情報を追加
-                project_summaries.append({
-                    "id": info["id"],
-                    "name": info["name"],
-                    "created_at": info["created_at"],
-                    "first_image": first_image,
-                    "dir_path": os.path.abspath(project_root)
-                })
-
-    return project_summaries
+    return catalog.summaries()
 
-# プロジェクトに画像を追加するエンドポイント
-@router.post("/add_image", status_code=status.HTTP_201_CREATED)
-async def add_image(
-    pid: str = Form(...),
-    files: List[UploadFile] = Form([]),
-    name: str = Form(...),
-    description: str = Form(...),
-    model: str = Form(...)
-):
-
-    logger.info(f"Received files: {files}")
-    logger.info(f"Received pid: {pid}, name: {name}, description: {description}, model: {model}")
+# ステージング済みの画像をプロジェクトに追加する (ジョブとして実行される)
+async def finish_add_image(job, pid, staged, name, description, model):
     # プロジェクトディレクトリのパスを取得
     # project_root = f"./datas/{pid}"
     project_root = os.path.join("datas", f"{pid}")
     imgs_dir = os.path.join(project_root, "imgs")
-    annotation_file = os.path.join(project_root, "annotation.json")
     project_info_file = os.path.join(project_root, "project_info.json")
 
-    images_paths = []
+    # 既存のアノテーションストアの取得
+    store = get_store(pid)
 
-    # 既存のアノテーション情報の取得
-    with open(annotation_file, "r") as f:
-        annotations = json.load(f)
+    dedup = {"dedup_hits": 0, "duplicates_in_project": 0, "bytes_saved": 0}
+    images_paths, hashes = [], {}
+    if staged:
+        images_paths, dedup, hashes = await ingest_staged(job, staged, imgs_dir, pid)
+        schedule_thumbnails(images_paths)
 
-    if files:
-        for file in files:
-            # アップロードされたファイルが画像かどうかを確認
-            try:
-                img = Image.open(file.file)
-                img.verify()
-                file.file.seek(0)
-            except (IOError, SyntaxError):
-                continue
-
-            # 新しいユニークなファイル名を生成
-            file_extension = os.path.splitext(file.filename)[1]  # ファイル拡張子を取得
-            unique_file_name = f"{uuid.uuid4().hex}{file_extension}"  # ユニークな名前を生成
-            full_file_path = os.path.join(imgs_dir, unique_file_name)
-
-            # 重複チェック
-            if os.path.exists(full_file_path):
-                # ファイル名に一意の識別子を追加
-                fname, ext = os.path.splitext(file_name)
-                unique_id = uuid.uuid4().hex[:6]
-                file_name = f"{fname}_{unique_id}{ext}"
-                full_file_path = os.path.join(imgs_dir, file_name)
-
-            # ファイル保存
-            with open(full_file_path, "wb") as buffer:
-                buffer.write(await file.read())
-            images_paths.append(full_file_path)
-
-        default_role = annotations[0]["sys"]
-
-        # 追加された画像のアノテーション情報を追加
-        for img_path in images_paths:
-            annotations.append({
+    # 同じプロジェクトへの他の書き込み (別ワーカーを含む) と重ならないようにロックを取る
+    async with async_project_lock(pid):
+        project_info = await run_in_threadpool(_register_images, store, pid, imgs_dir, images_paths, hashes, project_info_file, name, description, model)
+    catalog.update(pid)
+
+    # 追加後のアノテーションは /annotation/get_annotations で取得する
+    return {"message": "Images added successfully", "project": project_info, "added": len(images_paths), "job_id": job.id, "dedup": dedup}
+
+# 取り込んだ画像をストアに追加し，project_info.json を更新する (プロジェクトのロックを取った状態で呼ぶ)
+def _register_images(store, pid, imgs_dir, images_paths, hashes, project_info_file, name, description, model):
+    if images_paths:
+        first = store.first()
+        default_role = first["sys"] if first else ""
+
+        # 追加された画像のアノテーション情報を1つのトランザクションで追加
+        try:
+            store.insert_many([{
                 "image": os.path.relpath(img_path, imgs_dir),
                 "sys": default_role,
                 "user": "",
                 "label": "",
-                "dataset_split": "train"
-            })
-        with open(annotation_file, 'w') as f:
-            json.dump(annotations, f, indent=4, ensure_ascii=False)
+                "dataset_split": "train",
+                "phash": hashes.get(img_path)
+            } for img_path in images_paths])
+        except BaseException:
+            for img_path in images_paths:
+                os.remove(img_path)
+                blob_store.release(os.path.splitext(os.path.basename(img_path))[0], pid)
+            raise
+        store.export_json()
 
     # プロジェクト情報の更新
-    with open(project_info_file, "r") as f:
+    with span("json.load"), open(project_info_file, "r") as f:
         project_info = json.load(f)
-        project_info["image_count"] = len(annotations)
+        project_info["image_count"] = store.count()
         project_info["model"] = model
         project_info["description"] = description
         project_info["name"] = name
 
-    with open(project_info_file, 'w') as f:
-        json.dump(project_info, f, indent=4, ensure_ascii=False)
-    
-    return {"message": "Images added successfully", "project": project_info, "annotations": annotations}
+    write_json_atomic(project_info_file, project_info)
+    return project_info
+
+# プロジェクトに画像を追加するエンドポイント
+@router.post("/add_image", status_code=status.HTTP_201_CREATED)
+async def add_image(
+    response: Response,
+    pid: str = Form(...),
+    files: List[UploadFile] = Form([]),
+    name: str = Form(...),
+    description: str = Form(...),
+    model: str = Form(...),
+    background: bool = Form(False)
+):
+
+    logger.info(f"Received files: {files}")
+    logger.info(f"Received pid: {pid}, name: {name}, description: {description}, model: {model}")
+    project_root = os.path.join("datas", f"{pid}")
+    try:
+        get_store(pid)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Project not found")
+
+    # アップロードをチャンク単位でディスクに書き出す
+    job = jobs.create("add_image", project_id=pid)
+    staging_dir = os.path.join(project_root, ".staging", job.id)
+    try:
+        staged = await stage_uploads(files or [], staging_dir)
+    except BaseException:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        raise
+    job.total = len(staged)
+
+    async def run():
+        try:
+            return await finish_add_image(job, pid, staged, name, description, model)
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            try:
+                os.rmdir(os.path.dirname(staging_dir))
+            except OSError:
+                pass
+
+    if background:
+        jobs.start(job, run())
+        response.status_code = status.HTTP_202_ACCEPTED
+        return {"message": "Image upload started", "job_id": job.id, "project_id": pid}
+
+    try:
+        return await jobs.run(job, run())
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Adding images failed: {str(e)}")
+
+# 画像のサムネイルを返すエンドポイント (初回アクセス時に作成してキャッシュする)
+# サムネイルのファイル名 (元画像のハッシュとサイズ・品質) をETagにし，変わっていなければ 304 を返す
+@router.get("/thumbnail/{pid}/{image}", status_code=status.HTTP_200_OK)
+async def get_project_thumbnail(pid: str, image: str, request: Request):
+    source_path = os.path.join("datas", pid, "imgs", image)
+    if os.path.basename(pid) != pid or os.path.basename(image) != image or not os.path.isfile(source_path):
+        raise HTTPException(status_code=404, detail="Image not found")
+    try:
+        thumbnail_path = await run_in_threadpool(get_thumbnail, source_path)
+    except (IOError, SyntaxError):
+        raise HTTPException(status_code=415, detail="Unable to create thumbnail")
+    headers = {"Cache-Control": "public, max-age=86400", "ETag": f'"{os.path.splitext(os.path.basename(thumbnail_path))[0]}"'}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and headers["ETag"] in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return FileResponse(thumbnail_path, media_type="image/jpeg", headers=headers)
+
+# 画像がまだ存在するかをまとめて確認するエンドポイント
+# paths は /images 以下のパス (例: "{pid}/imgs/{image}")
+@router.post("/images/exists", status_code=status.HTTP_200_OK)
+async def images_exist(request: ImageExistsRequest):
+    if len(request.paths) > MAX_EXISTS_PATHS:
+        raise HTTPException(status_code=400, detail=f"Too many paths (max {MAX_EXISTS_PATHS})")
+    root = os.path.abspath("datas")
+
+    def check():
+        exists = {}
+        for path in request.paths:
+            full_path = os.path.abspath(os.path.join(root, path.lstrip("/")))
+            # datas ディレクトリの外は参照させない
+            exists[path] = full_path.startswith(root + os.sep) and os.path.isfile(full_path)
+        return exists
+
+    return {"exists": await run_in_threadpool(check)}
 
 @router.get("/search", status_code=status.HTTP_200_OK)
 async def search_projects(keyword: str = Query(..., description="検索するキーワード")):
-    # プロジェクトが格納されているディレクトリ
-    datas_dir = os.path.abspath("./datas")
-    matched_projects = []
-
-    # datasディレクトリを探索
-    if os.path.exists(datas_dir):
-        for project_id in os.listdir(datas_dir):
-            project_root = os.path.join(datas_dir, project_id)
-            project_info_path = os.path.join(project_root, "project_info.json")
-            imgs_dir = os.path.join(project_root, "imgs")
-            first_image = None
-
-            # プロジェクト情報を読み込み
-            if os.path.exists(project_info_path):
-                with open(project_info_path, "r", encoding="utf-8") as f:
-                    info = json.load(f)
-
-                # 最初の画像ファイルを取得
-                if os.path.exists(imgs_dir):
-                    images = [img for img in os.listdir(imgs_dir) if img.lower().endswith(('png', 'jpg', 'jpeg', 'gif'))]
-                    if images:
-                        first_image = os.path.join(imgs_dir, images[0])
-
-                # name または description に正規表現が一致する場合
-                if (re.search(keyword, info.get("name", ""), re.IGNORECASE) or
-                        re.search(keyword, info.get("description", ""), re.IGNORECASE)):
-                    matched_projects.append({
-                        "id": info["id"],
-                        "name": info["name"],
-                        "created_at": info["created_at"],
-                        "description": info["description"],
-                        "image_count": info.get("image_count", 0),
-                        "first_image": first_image,
-                        "dir_path": info["dir_path"]
-                    })
-
-    return {"matched_projects": matched_projects}
\ No newline at end of file
+    # 正規表現は一度だけコンパイルし，カタログの name と description に対して照合する
+    try:
+        pattern = re.compile(keyword, re.IGNORECASE)
+    except re.error as e:
+        raise HTTPException(status_code=400, detail=f"Invalid search pattern: {str(e)}")
+
+    return {"matched_projects": catalog.search(pattern)}
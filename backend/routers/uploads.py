@@ -0,0 +1,465 @@
+from fastapi import APIRouter, HTTPException, Request, Response, status
+from fastapi.concurrency import run_in_threadpool
+from pydantic import BaseModel
+from starlette.requests import ClientDisconnect
+from typing import Dict, List, Optional
+import os
+import json
+import time
+import uuid
+import shutil
+import sqlite3
+import hashlib
+from contextlib import contextmanager
+from utils.annotation_store import get_store
+from utils.fileio import file_lock, write_json_atomic
+from utils.jobs import jobs, _owner, _owner_alive
+from routers.projects import finish_create_project, finish_add_image
+
+# 再開可能なアップロードセッション
+# 1. POST /uploads/sessions でセッションを作成し，アップロードするファイルを登録する
+# 2. PUT /uploads/sessions/{sid}/files/{fid} でファイルの内容を送る
+#    Upload-Offset ヘッダに受信済みのバイト数を指定して，途中から何回かに分けて送ることができる
+#    接続が切れた場合は GET /uploads/sessions/{sid} で受信済みのバイト数を確認して続きから送る
+# 3. POST /uploads/sessions/{sid}/commit で受信したファイルを新しいプロジェクトまたは既存のプロジェクトに追加する
+# 受信したデータはすぐにディスクに書き出すため，全体のサイズに関わらずメモリ使用量は一定
+router = APIRouter(
+    prefix='/uploads',
+    tags=["uploads"]
+)
+
+UPLOADS_DIR = os.path.join("datas", ".uploads")
+# ディスクに書き出す単位
+UPLOAD_WRITE_SIZE = 1024 * 1024
+# 1ファイルの最大サイズ (バイト)
+UPLOAD_MAX_FILE_SIZE = int(os.environ.get("UPLOAD_MAX_FILE_SIZE", 200 * 1024 * 1024))
+# 1セッションに登録できるファイル数
+UPLOAD_MAX_FILES = int(os.environ.get("UPLOAD_MAX_FILES", 100000))
+# 更新の無いセッションを削除するまでの時間 (秒)
+UPLOAD_SESSION_TTL = float(os.environ.get("UPLOAD_SESSION_TTL", 24 * 3600))
+# コミットがこの時間 (秒) を過ぎても終わらない場合は中断されたものとみなす
+UPLOAD_COMMIT_TIMEOUT = float(os.environ.get("UPLOAD_COMMIT_TIMEOUT", 6 * 3600))
+
+# アップロードするファイルの情報
+class UploadFileSpec(BaseModel):
+    filename: str
+    size: int
+    sha256: Optional[str] = None # 指定した場合は受信完了時に照合する
+
+# セッション作成用のリクエストモデル
+# target="create" の場合は新しいプロジェクトを作成し，"add" の場合は pid のプロジェクトに追加する
+class UploadSessionCreate(BaseModel):
+    target: str = "create"
+    pid: Optional[str] = None
+    name: Optional[str] = None
+    description: Optional[str] = None
+    default_role: str = ""
+    train_ratio: float = 0.8
+    model: Optional[str] = None
+    files: List[UploadFileSpec] = []
+
+class UploadFilesAdd(BaseModel):
+    files: List[UploadFileSpec]
+
+def _session_dir(sid: str) -> str:
+    if os.path.basename(sid) != sid or not sid:
+        raise HTTPException(status_code=404, detail="Upload session not found")
+    return os.path.join(UPLOADS_DIR, sid)
+
+def _part_path(sid: str, fid: str) -> str:
+    return os.path.join(_session_dir(sid), "files", f"{fid}.part")
+
+# コミット中に取り込みへ渡すファイル (受信したファイルのハードリンク) を置くディレクトリ
+def _commit_dir(sid: str) -> str:
+    return os.path.join(_session_dir(sid), "commit")
+
+# コミットしていたプロセスが終了している，またはコミットに時間がかかりすぎている
+def _commit_stale(session: Dict) -> bool:
+    if not _owner_alive(session.get("commit_owner")):
+        return True
+    return time.time() - session.get("commit_started_at", 0) > UPLOAD_COMMIT_TIMEOUT
+
+# ファイルごとの情報と受信状況はセッションディレクトリの files.db に記録する
+# session.json にはセッション単位の情報 (状態やコミットの情報) だけを置き，
+# ファイル数が多くてもチャンクの受信やファイルの受信完了のたびに全体を読み書きしないようにする
+@contextmanager
+def _files_db(sid: str):
+    conn = sqlite3.connect(os.path.join(_session_dir(sid), "files.db"), isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    try:
+        conn.execute("PRAGMA busy_timeout=5000")
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                fid TEXT PRIMARY KEY,
+                filename TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                sha256 TEXT,
+                digest TEXT,
+                complete INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        yield conn
+    finally:
+        conn.close()
+
+def _insert_files(conn: sqlite3.Connection, entries: List[Dict]):
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.executemany(
+            "INSERT OR IGNORE INTO files (fid, filename, size, sha256, digest, complete) VALUES (:fid, :filename, :size, :sha256, :digest, :complete)",
+            entries,
+        )
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+
+# 登録順のファイルの一覧
+def _list_files(sid: str) -> List[Dict]:
+    with _files_db(sid) as conn:
+        return [dict(row) for row in conn.execute("SELECT * FROM files ORDER BY rowid")]
+
+def _get_file(sid: str, fid: str) -> Optional[Dict]:
+    with _files_db(sid) as conn:
+        row = conn.execute("SELECT * FROM files WHERE fid = ?", (fid,)).fetchone()
+    return dict(row) if row is not None else None
+
+# 中断されたコミットのセッションは open として扱い，もう一度コミットや削除ができるようにする
+def _load_session(sid: str) -> Dict:
+    try:
+        with open(os.path.join(_session_dir(sid), "session.json"), "r", encoding="utf-8") as f:
+            session = json.load(f)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Upload session not found")
+    if "files" in session:
+        # ファイルの情報を session.json に置いていた以前のセッションは files.db に移す
+        with _files_db(sid) as conn:
+            _insert_files(conn, [
+                {"fid": fid, **{key: entry.get(key) for key in ("filename", "size", "sha256", "digest")}, "complete": int(entry["complete"])}
+                for fid, entry in session.pop("files").items()
+            ])
+        write_json_atomic(os.path.join(_session_dir(sid), "session.json"), session)
+    if session["status"] == "committing" and _commit_stale(session):
+        session["status"] = "open"
+        session["error"] = "Commit was interrupted"
+    return session
+
+def _save_session(session: Dict):
+    session["updated_at"] = time.time()
+    write_json_atomic(os.path.join(_session_dir(session["id"]), "session.json"), session)
+
+def _session_lock(sid: str):
+    return file_lock(os.path.join(_session_dir(sid), ".lock"))
+
+# 受信済みのバイト数はファイルの実際のサイズから求める (接続が切れた場合も書き込めた分は残る)
+def _received(sid: str, fid: str) -> int:
+    try:
+        return os.path.getsize(_part_path(sid, fid))
+    except FileNotFoundError:
+        return 0
+
+def _session_status(session: Dict) -> Dict:
+    files = []
+    for entry in _list_files(session["id"]):
+        complete = bool(entry["complete"])
+        received = entry["size"] if complete else _received(session["id"], entry["fid"])
+        files.append({"file_id": entry["fid"], "filename": entry["filename"], "size": entry["size"], "received": received, "complete": complete})
+    return {
+        "session_id": session["id"],
+        "status": session["status"],
+        "target": session["target"],
+        "pid": session.get("pid"),
+        "job_id": session.get("job_id"),
+        "error": session.get("error"),
+        "files": files,
+        "total_bytes": sum(f["size"] for f in files),
+        "received_bytes": sum(f["received"] for f in files),
+        "complete_files": sum(f["complete"] for f in files),
+    }
+
+def _register_files(sid: str, specs: List[UploadFileSpec]) -> List[Dict]:
+    with _session_lock(sid):
+        session = _load_session(sid)
+        if session["status"] != "open":
+            raise HTTPException(status_code=409, detail=f"Upload session is {session['status']}")
+        for spec in specs:
+            if spec.size < 0 or spec.size > UPLOAD_MAX_FILE_SIZE:
+                raise HTTPException(status_code=413, detail=f"{spec.filename}: file size must be at most {UPLOAD_MAX_FILE_SIZE} bytes")
+        entries = [
+            {"fid": uuid.uuid4().hex, "filename": spec.filename, "size": spec.size, "sha256": spec.sha256, "digest": None, "complete": 0}
+            for spec in specs
+        ]
+        with _files_db(sid) as conn:
+            registered = conn.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+            if registered + len(specs) > UPLOAD_MAX_FILES:
+                raise HTTPException(status_code=400, detail=f"Too many files (max {UPLOAD_MAX_FILES})")
+            _insert_files(conn, entries)
+        return [{"file_id": entry["fid"], "filename": entry["filename"], "size": entry["size"]} for entry in entries]
+
+# 期限切れのセッションを削除する (コミット中のものは残す)
+def _purge_expired_sessions():
+    if not os.path.exists(UPLOADS_DIR):
+        return
+    cutoff = time.time() - UPLOAD_SESSION_TTL
+    for sid in os.listdir(UPLOADS_DIR):
+        session_dir = os.path.join(UPLOADS_DIR, sid)
+        try:
+            # ファイルの受信完了は files.db (WAL) にだけ記録されるため，その更新時刻も見る
+            updated_at = os.stat(os.path.join(session_dir, "session.json")).st_mtime
+            for name in ("files.db", "files.db-wal"):
+                path = os.path.join(session_dir, name)
+                if os.path.exists(path):
+                    updated_at = max(updated_at, os.stat(path).st_mtime)
+            if updated_at >= cutoff:
+                continue
+            if _load_session(sid)["status"] == "committing":
+                continue
+        except (HTTPException, FileNotFoundError, NotADirectoryError, json.JSONDecodeError):
+            pass
+        shutil.rmtree(session_dir, ignore_errors=True)
+
+# アップロードセッションを作成するエンドポイント
+@router.post("/sessions", status_code=status.HTTP_201_CREATED)
+async def create_session(request: UploadSessionCreate):
+    if request.target not in ("create", "add"):
+        raise HTTPException(status_code=400, detail="target must be 'create' or 'add'")
+    if request.target == "create" and not request.name:
+        raise HTTPException(status_code=400, detail="name is required to create a project")
+    if request.target == "add":
+        if not request.pid:
+            raise HTTPException(status_code=400, detail="pid is required to add images")
+        try:
+            get_store(request.pid)
+        except FileNotFoundError:
+            raise HTTPException(status_code=404, detail="Project not found")
+
+    await run_in_threadpool(_purge_expired_sessions)
+    sid = uuid.uuid4().hex
+    os.makedirs(os.path.join(_session_dir(sid), "files"))
+    session = {
+        "id": sid,
+        "status": "open",
+        "target": request.target,
+        "pid": request.pid,
+        "name": request.name,
+        "description": request.description,
+        "default_role": request.default_role,
+        "train_ratio": request.train_ratio,
+        "model": request.model,
+        "created_at": time.time(),
+    }
+    await run_in_threadpool(_save_session, session)
+    try:
+        files = await run_in_threadpool(_register_files, sid, request.files)
+    except HTTPException:
+        shutil.rmtree(_session_dir(sid), ignore_errors=True)
+        raise
+    return {"session_id": sid, "files": files, "max_file_size": UPLOAD_MAX_FILE_SIZE}
+
+# セッションにファイルを追加で登録するエンドポイント
+@router.post("/sessions/{sid}/files", status_code=status.HTTP_201_CREATED)
+async def add_files(sid: str, request: UploadFilesAdd):
+    return {"session_id": sid, "files": await run_in_threadpool(_register_files, sid, request.files)}
+
+# セッションの状態 (ファイルごとの受信済みバイト数) を返すエンドポイント
+@router.get("/sessions/{sid}", status_code=status.HTTP_200_OK)
+async def get_session(sid: str):
+    session = await run_in_threadpool(_load_session, sid)
+    return await run_in_threadpool(_session_status, session)
+
+# 受信完了したファイルのハッシュを計算し，セッションに記録する
+def _complete_file(sid: str, fid: str) -> Dict:
+    h = hashlib.sha256()
+    with open(_part_path(sid, fid), "rb") as f:
+        for chunk in iter(lambda: f.read(UPLOAD_WRITE_SIZE), b""):
+            h.update(chunk)
+    digest = h.hexdigest()
+    with _files_db(sid) as conn:
+        entry = dict(conn.execute("SELECT * FROM files WHERE fid = ?", (fid,)).fetchone())
+        if entry["sha256"] and entry["sha256"].lower() != digest:
+            # 内容が壊れているため最初から送り直してもらう
+            os.truncate(_part_path(sid, fid), 0)
+            raise HTTPException(status_code=422, detail="sha256 mismatch, upload the file again")
+        conn.execute("UPDATE files SET digest = ?, complete = 1 WHERE fid = ?", (digest, fid))
+    entry.update(digest=digest, complete=1)
+    return entry
+
+# ファイルの内容 (またはその一部) を受け取るエンドポイント
+# Upload-Offset ヘッダの値は受信済みのバイト数と一致している必要がある (一致しない場合は 409 と受信済みのバイト数を返す)
+@router.put("/sessions/{sid}/files/{fid}", status_code=status.HTTP_200_OK)
+async def upload_chunk(sid: str, fid: str, request: Request, response: Response):
+    session = await run_in_threadpool(_load_session, sid)
+    entry = await run_in_threadpool(_get_file, sid, fid)
+    if entry is None:
+        raise HTTPException(status_code=404, detail="File not found in upload session")
+    if session["status"] != "open":
+        raise HTTPException(status_code=409, detail=f"Upload session is {session['status']}")
+    if entry["complete"]:
+        return {"file_id": fid, "received": entry["size"], "size": entry["size"], "complete": True}
+
+    part_path = _part_path(sid, fid)
+    try:
+        offset = int(request.headers.get("upload-offset", "0"))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid Upload-Offset header")
+
+    # 同じファイルへの同時書き込みは受け付けない
+    try:
+        lock = file_lock(f"{part_path}.lock", blocking=False)
+        lock.__enter__()
+    except BlockingIOError:
+        raise HTTPException(status_code=409, detail="Another upload for this file is in progress")
+    try:
+        received = _received(sid, fid)
+        if offset != received:
+            raise HTTPException(status_code=409, detail=f"Upload-Offset must be {received}", headers={"Upload-Offset": str(received)})
+
+        with open(part_path, "ab") as f:
+            buffer = bytearray()
+
+            async def write_buffer():
+                nonlocal received
+                if received + len(buffer) > entry["size"]:
+                    raise HTTPException(status_code=413, detail=f"Received more than the declared size ({entry['size']} bytes)")
+                await run_in_threadpool(f.write, bytes(buffer))
+                received += len(buffer)
+                buffer.clear()
+
+            try:
+                async for chunk in request.stream():
+                    buffer.extend(chunk)
+                    if len(buffer) >= UPLOAD_WRITE_SIZE:
+                        await write_buffer()
+                await write_buffer()
+            except ClientDisconnect:
+                # 受信できた分は書き込んでおき，続きから再開できるようにする
+                if received + len(buffer) <= entry["size"]:
+                    await write_buffer()
+                raise
+            except HTTPException:
+                f.truncate(offset)
+                raise
+    finally:
+        lock.__exit__(None, None, None)
+
+    complete = received == entry["size"]
+    if complete:
+        await run_in_threadpool(_complete_file, sid, fid)
+    response.headers["Upload-Offset"] = str(received)
+    return {"file_id": fid, "received": received, "size": entry["size"], "complete": complete}
+
+# セッションを確定状態に移し，プロジェクトに追加するファイルの一覧を返す
+# コミットしたプロセスと開始時刻を記録し，途中で止まった場合は _load_session で open に戻す
+def _begin_commit(sid: str):
+    with _session_lock(sid):
+        session = _load_session(sid)
+        if session["status"] != "open":
+            raise HTTPException(status_code=409, detail=f"Upload session is {session['status']}")
+        files = _list_files(sid)
+        if not files:
+            raise HTTPException(status_code=400, detail="No files in upload session")
+        incomplete = [entry["filename"] for entry in files if not entry["complete"]]
+        if incomplete:
+            raise HTTPException(status_code=409, detail=f"{len(incomplete)} files are not fully uploaded")
+        # 中断されたコミットの残りを消す
+        shutil.rmtree(_commit_dir(sid), ignore_errors=True)
+        session.update({
+            "status": "committing",
+            "commit_id": uuid.uuid4().hex,
+            "commit_owner": _owner(),
+            "commit_started_at": time.time(),
+            "error": None,
+        })
+        _save_session(session)
+
+    # 取り込みはステージングしたファイルを削除するため，受信したファイルのハードリンクを渡す
+    # (コミットに失敗しても受信したファイルは残り，そのままコミットし直せる)
+    try:
+        os.makedirs(_commit_dir(sid))
+        staged = []
+        for entry in files:
+            staged_path = os.path.join(_commit_dir(sid), f"{entry['fid']}.part")
+            try:
+                os.link(_part_path(sid, entry["fid"]), staged_path)
+            except OSError:
+                # ハードリンクが使えないファイルシステムではコピーする
+                shutil.copyfile(_part_path(sid, entry["fid"]), staged_path)
+            staged.append((entry["filename"], staged_path, entry["digest"]))
+    except BaseException as e:
+        _finish_commit(sid, session["commit_id"], False, status="open", error=str(e) or e.__class__.__name__)
+        raise
+    return session, staged
+
+# コミットの結果を記録する
+# 成功した場合だけ受信したファイルを削除し，失敗した場合は open に戻してファイルを残す
+# 中断扱いになった後に別のコミットが始まっている場合は何もしない
+def _finish_commit(sid: str, commit_id: str, committed: bool, **fields):
+    with _session_lock(sid):
+        session = _load_session(sid)
+        if session.get("commit_id") != commit_id:
+            return
+        session.update(fields)
+        _save_session(session)
+    shutil.rmtree(_commit_dir(sid), ignore_errors=True)
+    if committed:
+        shutil.rmtree(os.path.join(_session_dir(sid), "files"), ignore_errors=True)
+
+# 受信したファイルをプロジェクトに追加するエンドポイント
+# 画像の検証・登録は1つのジョブとして行い，途中で失敗した場合は何も追加しなかった状態に戻す
+@router.post("/sessions/{sid}/commit", status_code=status.HTTP_201_CREATED)
+async def commit_session(sid: str, response: Response, background: bool = False):
+    session, staged = await run_in_threadpool(_begin_commit, sid)
+
+    if session["target"] == "create":
+        pid = str(uuid.uuid4())
+        os.makedirs(os.path.join("datas", pid, "imgs"), exist_ok=True)
+        job = jobs.create("create_project", total=len(staged), project_id=pid, upload_session=sid)
+        coro = finish_create_project(
+            job, pid, staged, session["name"], session["default_role"] or "", session["description"] or "", session["train_ratio"]
+        )
+    else:
+        pid = session["pid"]
+        try:
+            with open(os.path.join("datas", pid, "project_info.json"), "r") as f:
+                project_info = json.load(f)
+        except FileNotFoundError:
+            await run_in_threadpool(_finish_commit, sid, session["commit_id"], False, status="open", error="Project not found")
+            raise HTTPException(status_code=404, detail="Project not found")
+        job = jobs.create("add_image", total=len(staged), project_id=pid, upload_session=sid)
+        coro = finish_add_image(
+            job, pid, staged,
+            session["name"] or project_info.get("name", ""),
+            session["description"] if session["description"] is not None else project_info.get("description", ""),
+            session["model"] if session["model"] is not None else project_info.get("model", ""),
+        )
+
+    async def run():
+        try:
+            result = await coro
+        except BaseException as e:
+            await run_in_threadpool(_finish_commit, sid, session["commit_id"], False, status="open", job_id=job.id, error=str(e) or e.__class__.__name__)
+            raise
+        await run_in_threadpool(_finish_commit, sid, session["commit_id"], True, status="committed", job_id=job.id, pid=pid, error=None)
+        return result
+
+    if background:
+        jobs.start(job, run())
+        response.status_code = status.HTTP_202_ACCEPTED
+        return {"message": "Upload commit started", "session_id": sid, "job_id": job.id, "project_id": pid}
+
+    try:
+        result = await jobs.run(job, run())
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Upload commit failed: {str(e)}")
+    return {**result, "session_id": sid}
+
+# セッションを破棄するエンドポイント
+@router.delete("/sessions/{sid}", status_code=status.HTTP_200_OK)
+async def delete_session(sid: str):
+    session = await run_in_threadpool(_load_session, sid)
+    if session["status"] == "committing":
+        raise HTTPException(status_code=409, detail="Upload session is being committed")
+    await run_in_threadpool(shutil.rmtree, _session_dir(sid), True)
+    return {"message": f"Upload session '{sid}' deleted"}
@@ -0,0 +1,146 @@
+# プロジェクト一覧とアノテーション取得のエンドポイントに負荷をかけ，スループットとレイテンシを計測する
+#
+# 起動済みのサーバーに対して計測する場合:
+#   python scripts/load_test.py --url http://localhost:8080
+# ワーカー数を変えて gunicorn を起動し，スループットの伸びを比較する場合 (backend ディレクトリで実行):
+#   python scripts/load_test.py --workers 1,2,4
+#
+# プロジェクトが1つも無い場合は，計測用のプロジェクトを作成してから計測する
+import os
+import io
+import sys
+import time
+import asyncio
+import argparse
+import subprocess
+import httpx
+from PIL import Image
+
+ENDPOINTS = {
+    "list": lambda pid: "/projects/list",
+    "annotations": lambda pid: f"/annotation/get_annotations?pid={pid}&limit=100",
+}
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+# 計測用のプロジェクトを作成してIDを返す
+def create_project(url: str, images: int) -> str:
+    files = []
+    for i in range(images):
+        buffer = io.BytesIO()
+        Image.new("RGB", (64, 64), (i % 256, (i * 7) % 256, (i * 13) % 256)).save(buffer, format="PNG")
+        files.append(("files", (f"load_{i}.png", buffer.getvalue(), "image/png")))
+    data = {"name": "load-test", "description": "load test", "default_role": "You are an image captioner.", "train_ratio": "0.8"}
+    response = httpx.post(f"{url}/projects/create", data=data, files=files, timeout=300)
+    response.raise_for_status()
+    return response.json()["project"]["id"]
+
+def find_project(url: str, images: int) -> str:
+    projects = httpx.get(f"{url}/projects/list", timeout=30).json()
+    if projects:
+        return projects[0]["id"]
+    return create_project(url, images)
+
+# duration 秒の間，concurrency 本の接続から繰り返しリクエストを送る
+async def run_load(url: str, path: str, concurrency: int, duration: float):
+    latencies = []
+    errors = 0
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=30) as client:
+        deadline = time.perf_counter() + duration
+
+        async def worker():
+            nonlocal errors
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                try:
+                    response = await client.get(path)
+                    if response.status_code != 200:
+                        errors += 1
+                        continue
+                except httpx.HTTPError:
+                    errors += 1
+                    continue
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": len(latencies) / elapsed,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+    }
+
+def measure(url: str, args) -> dict:
+    pid = find_project(url, args.images)
+    results = {}
+    for name in args.endpoints.split(","):
+        path = ENDPOINTS[name](pid)
+        # ウォームアップ (キャッシュやコネクションの準備)
+        asyncio.run(run_load(url, path, args.concurrency, min(1.0, args.duration)))
+        results[name] = asyncio.run(run_load(url, path, args.concurrency, args.duration))
+    return results
+
+# gunicorn を指定したワーカー数で起動し，応答するまで待つ
+def start_server(workers: int, port: int) -> subprocess.Popen:
+    env = dict(os.environ, WEB_CONCURRENCY=str(workers), BACKEND_HOST="127.0.0.1", BACKEND_PORT=str(port), LOG_LEVEL="warning")
+    process = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "--access-logfile", "/dev/null", "main:app"],
+        env=env,
+    )
+    url = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        try:
+            httpx.get(f"{url}/projects/list", timeout=1)
+            return process
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("server did not start")
+
+def print_results(label: str, results: dict):
+    for name, r in results.items():
+        print(
+            f"{label:>10} {name:>12} {r['rps']:>10.1f} req/s  p50 {r['p50_ms']:7.1f} ms  "
+            f"p95 {r['p95_ms']:7.1f} ms  p99 {r['p99_ms']:7.1f} ms  errors {r['errors']}"
+        )
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test for the list and annotation endpoints")
+    parser.add_argument("--url", default="http://localhost:8080", help="計測するサーバーのURL (--workers を指定しない場合)")
+    parser.add_argument("--workers", help="カンマ区切りのワーカー数 (指定した場合は gunicorn を起動して計測する)")
+    parser.add_argument("--port", type=int, default=8765, help="--workers で起動するサーバーのポート")
+    parser.add_argument("--concurrency", type=int, default=32, help="同時接続数")
+    parser.add_argument("--duration", type=float, default=10.0, help="エンドポイントごとの計測時間 (秒)")
+    parser.add_argument("--endpoints", default="list,annotations", help="計測するエンドポイント (list, annotations)")
+    parser.add_argument("--images", type=int, default=200, help="計測用に作成するプロジェクトの画像数")
+    args = parser.parse_args()
+
+    if not args.workers:
+        print_results(args.url, measure(args.url, args))
+        return
+
+    baseline = {}
+    for workers in [int(w) for w in args.workers.split(",")]:
+        process = start_server(workers, args.port)
+        try:
+            results = measure(f"http://127.0.0.1:{args.port}", args)
+        finally:
+            process.terminate()
+            process.wait()
+        print_results(f"{workers} worker", results)
+        for name, r in results.items():
+            baseline.setdefault(name, r["rps"])
+            print(f"{'':>10} {name:>12} x{r['rps'] / baseline[name]:.2f} vs first run")
+
+if __name__ == "__main__":
+    main()
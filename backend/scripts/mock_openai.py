@@ -0,0 +1,48 @@
+# OpenAI互換APIのモックサーバー (プレイグラウンドのバッチ推論や事前ラベル付けの動作確認用)
+# 使い方: uvicorn scripts.mock_openai:app --port 9000
+# バックエンドの環境変数 OPENAI_BASE_URL (または OPENAI_ALLOWED_BASE_URLS) に http://localhost:9000/v1 を設定して利用する
+#
+# 環境変数
+#   MOCK_LATENCY: 1リクエストあたりの応答待ち時間 (秒)
+#   MOCK_RATE_LIMIT_EVERY: N件に1件の割合で 429 を返す (0 の場合は返さない)
+import os
+import time
+import asyncio
+import hashlib
+from itertools import count
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+MOCK_LATENCY = float(os.environ.get("MOCK_LATENCY", 0.05))
+MOCK_RATE_LIMIT_EVERY = int(os.environ.get("MOCK_RATE_LIMIT_EVERY", 0))
+
+app = FastAPI()
+_counter = count(1)
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    n = next(_counter)
+    if MOCK_RATE_LIMIT_EVERY and n % MOCK_RATE_LIMIT_EVERY == 0:
+        return JSONResponse(
+            status_code=429,
+            headers={"retry-after": "0.1"},
+            content={"error": {"message": "Rate limit reached", "type": "rate_limit_error"}},
+        )
+
+    body = await request.json()
+    await asyncio.sleep(MOCK_LATENCY)
+
+    # 画像の内容から決まる応答を返す (同じ画像には同じ応答)
+    digest = hashlib.sha256(str(body["messages"]).encode("utf-8")).hexdigest()[:12]
+    return {
+        "id": f"chatcmpl-mock-{n}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "mock"),
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": f"mock caption {digest}"},
+            "finish_reason": "stop",
+        }],
+        "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+    }
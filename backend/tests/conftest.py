@@ -0,0 +1,81 @@
+import io
+import os
+import sys
+import time
+import socket
+import itertools
+import threading
+import pytest
+import uvicorn
+from PIL import Image
+
+# テストは backend ディレクトリをルートとして import する
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def make_image(color, size=(32, 32), fmt="PNG") -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", size, color).save(buffer, fmt)
+    return buffer.getvalue()
+
+# datas / cache はカレントディレクトリからの相対パスのため，一時ディレクトリでアプリを起動する
+@pytest.fixture(scope="session")
+def client(tmp_path_factory):
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp("work"))
+    os.makedirs("datas", exist_ok=True)
+    from fastapi.testclient import TestClient
+    import main
+    try:
+        with TestClient(main.app) as test_client:
+            yield test_client
+    finally:
+        os.chdir(cwd)
+
+# OpenAI互換APIのモックサーバー (scripts/mock_openai.py) を空いているポートで起動し，base_url を返す
+@pytest.fixture(scope="session")
+def mock_base_url():
+    from scripts import mock_openai
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(mock_openai.app, host="127.0.0.1", port=port, log_level="error"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    yield f"http://127.0.0.1:{port}/v1"
+    server.should_exit = True
+    thread.join()
+
+# テストごとにモックの設定とリクエスト数の数え方を初期化する
+# (レート制限のヘッダで待ち時間が決まるため，バックオフの待ち時間も短くしておく)
+# モックの接続先はリクエストの base_url で選べるよう許可しておく
+@pytest.fixture
+def mock_openai(mock_base_url, monkeypatch):
+    from scripts import mock_openai
+    import routers.playground as playground
+    monkeypatch.setattr(mock_openai, "MOCK_LATENCY", 0.01)
+    monkeypatch.setattr(mock_openai, "MOCK_RATE_LIMIT_EVERY", 0)
+    monkeypatch.setattr(mock_openai, "_counter", itertools.count(1))
+    monkeypatch.setattr(playground, "RETRY_BASE_DELAY", 0.01)
+    monkeypatch.setattr(playground, "OPENAI_ALLOWED_BASE_URLS", [mock_base_url])
+    return mock_openai
+
+# これまでにモックが受け付けたリクエスト数
+def mock_requests(mock_openai) -> int:
+    return next(mock_openai._counter) - 1
+
+# 色の異なる画像 n 枚でプロジェクトを作成し，プロジェクトIDとアノテーションを返す
+@pytest.fixture
+def make_project(client):
+    colors = itertools.count(1)
+
+    def make(n: int):
+        files = [("files", (f"img{i}.png", make_image((next(colors) * 7 % 256, i * 13 % 256, 64)), "image/png")) for i in range(n)]
+        response = client.post("/projects/create", data={"name": "test", "default_role": "role", "description": "desc"}, files=files)
+        assert response.status_code == 201, response.text
+        pid = response.json()["project"]["id"]
+        annotations = client.get(f"/annotation/get_annotations?pid={pid}&include_project_info=false").json()["annotations"]
+        return pid, annotations
+
+    return make
@@ -0,0 +1,10 @@
+import os
+
+# 存在しないプロジェクトや project_info.json の無いプロジェクトは 404 を返す
+def test_get_annotations_returns_404_for_missing_project(client, make_project):
+    assert client.get("/annotation/get_annotations?pid=missing").status_code == 404
+
+    pid, _ = make_project(1)
+    os.remove(os.path.join("datas", pid, "project_info.json"))
+    assert client.get(f"/annotation/get_annotations?pid={pid}").status_code == 404
+    assert client.get(f"/annotation/get_annotations?pid={pid}&include_project_info=false").status_code == 200
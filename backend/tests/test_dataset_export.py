@@ -0,0 +1,36 @@
+import time
+import pytest
+from utils.dataset_export import ordered_map
+
+# 読み出しをやめた場合は，それ以降に処理が走らない
+def test_ordered_map_stops_workers_when_closed():
+    calls = []
+
+    def slow(x):
+        time.sleep(0.02)
+        calls.append(x)
+        return x
+
+    lines = ordered_map(slow, range(100), window=8)
+    assert next(lines) == 0
+    lines.close()
+    finished = len(calls)
+    time.sleep(0.2)
+    assert len(calls) == finished < 100
+
+# 処理が失敗した場合も，残りを取り消してから例外を送出する
+def test_ordered_map_cancels_pending_on_error():
+    calls = []
+
+    def fail_on_three(x):
+        if x == 3:
+            raise ValueError(x)
+        time.sleep(0.02)
+        calls.append(x)
+        return x
+
+    with pytest.raises(ValueError):
+        list(ordered_map(fail_on_three, range(100), window=8))
+    finished = len(calls)
+    time.sleep(0.2)
+    assert len(calls) == finished < 100
@@ -0,0 +1,49 @@
+import os
+import asyncio
+import threading
+import pytest
+from utils.fileio import async_project_lock, file_lock, project_lock
+
+# ロックを待っている間に取り消されても，ロックを取得したまま残らない
+def test_async_project_lock_releases_after_cancelled_wait(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(os.path.join("datas", "p"))
+    held = threading.Event()
+    errors = []
+    release = threading.Event()
+
+    def holder():
+        with project_lock("p"):
+            held.set()
+            release.wait()
+
+    thread = threading.Thread(target=holder)
+    thread.start()
+    held.wait()
+
+    async def run():
+        async def waiter():
+            async with async_project_lock("p"):
+                pass
+
+        task = asyncio.create_task(waiter())
+        await asyncio.sleep(0.05)
+        task.cancel()
+        # 例外 (とトレースバックが参照するフレーム) を残しておき，ガベージコレクションで解放されないようにする
+        with pytest.raises(asyncio.CancelledError) as cancelled:
+            await task
+        errors.append(cancelled.value)
+        # 取り消した後にロックが空き，待っていたスレッドが取得してから解放する
+        release.set()
+        await asyncio.sleep(0.2)
+
+    asyncio.run(run())
+    thread.join()
+    with file_lock(os.path.join("datas", "p", ".lock"), blocking=False):
+        pass
+
+    async def reacquire():
+        async with async_project_lock("p"):
+            return True
+
+    assert asyncio.run(asyncio.wait_for(reacquire(), timeout=5))
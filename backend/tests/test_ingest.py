@@ -0,0 +1,69 @@
+import os
+import asyncio
+import hashlib
+import pytest
+import utils.ingest as ingest
+from utils.blob_store import blob_store
+from utils.jobs import Job
+from conftest import make_image
+
+def stage(tmp_path, files):
+    staged = []
+    for i, (filename, data) in enumerate(files):
+        path = tmp_path / f"staged{i}"
+        path.write_bytes(data)
+        staged.append((filename, str(path), hashlib.sha256(data).hexdigest()))
+    return staged
+
+# 同じバッチ内の同じ画像は1枚だけ配置する
+def test_ingest_dedups_within_batch(client, tmp_path):
+    data = make_image((1, 2, 3))
+    staged = stage(tmp_path, [("a.png", data), ("b.png", data), ("c.png", make_image((4, 5, 6)))])
+    imgs_dir = str(tmp_path / "imgs")
+
+    paths, stats, hashes = asyncio.run(ingest.ingest_staged(Job("test"), staged, imgs_dir, "ingest-dedup"))
+
+    assert len(paths) == 2
+    assert sorted(os.listdir(imgs_dir)) == sorted(os.path.basename(path) for path in paths)
+    assert stats["duplicates_in_project"] == 1
+    assert set(hashes) == set(paths)
+    assert not any(os.path.exists(path) for _, path, _ in staged)
+
+# 途中で失敗した場合は配置済みの画像とブロブへの参照を残さない
+def test_ingest_rolls_back_on_failure(client, tmp_path, monkeypatch):
+    staged = stage(tmp_path, [(f"img{i}.png", make_image((i, 99, 7))) for i in range(6)])
+    imgs_dir = str(tmp_path / "imgs")
+    link = blob_store.link
+
+    def failing_link(digest, dest_path):
+        if digest == staged[3][2]:
+            raise OSError("disk full")
+        link(digest, dest_path)
+
+    monkeypatch.setattr(blob_store, "link", failing_link)
+    with pytest.raises(OSError):
+        asyncio.run(ingest.ingest_staged(Job("test"), staged, imgs_dir, "ingest-rollback"))
+
+    assert os.listdir(imgs_dir) == []
+    assert not any(os.path.exists(path) for _, path, _ in staged)
+    refs = blob_store._connection().execute("SELECT COUNT(*) FROM refs WHERE project_id = 'ingest-rollback'").fetchone()[0]
+    assert refs == 0
+
+# 同じ内容の画像は拡張子が違っても (.jpg / .JPEG / 以前の形式のファイル名) 1枚として扱う
+def test_ingest_dedups_on_digest_regardless_of_extension(client, tmp_path):
+    data = make_image((9, 8, 7), fmt="JPEG")
+    imgs_dir = tmp_path / "imgs"
+    staged = stage(tmp_path, [("a.jpg", data), ("b.JPEG", data), ("c.jpeg", data)])
+
+    paths, stats, _ = asyncio.run(ingest.ingest_staged(Job("test"), staged, str(imgs_dir), "ingest-ext"))
+    assert [os.path.basename(path) for path in paths] == [f"{staged[0][2]}.jpg"]
+    assert stats["duplicates_in_project"] == 2
+
+    # 以前の取り込みで元の拡張子のまま保存されたファイルとも重複を判定する
+    other = make_image((1, 1, 1), fmt="JPEG")
+    (tmp_path / "staged_legacy").mkdir()
+    legacy = stage(tmp_path / "staged_legacy", [("d.jpeg", other)])
+    (imgs_dir / f"{legacy[0][2]}.jpeg").write_bytes(other)
+    paths, stats, _ = asyncio.run(ingest.ingest_staged(Job("test"), legacy, str(imgs_dir), "ingest-ext"))
+    assert paths == []
+    assert stats["duplicates_in_project"] == 1
@@ -0,0 +1,32 @@
+import time
+import numpy as np
+from utils.near_duplicates import MAX_NEAR_DUPLICATE_THRESHOLD, find_similar_groups
+
+def bursts(rng, groups: int, size: int) -> np.ndarray:
+    bases = np.repeat(rng.integers(-2**63, 2**63 - 1, size=groups, dtype=np.int64).view(np.uint64), size)
+    flips = rng.integers(0, 64, size=(len(bases), 2)).astype(np.uint64)
+    return (bases ^ (np.uint64(1) << flips[:, 0]) ^ (np.uint64(1) << flips[:, 1])).view(np.int64)
+
+# 互いに離れたグループは，全組み合わせを比べた場合と同じようにまとまる (代表は最も前の添字)
+def test_groups_match_brute_force():
+    rng = np.random.default_rng(0)
+    hashes = bursts(rng, 30, 8)
+    rng.shuffle(hashes)
+    distances = np.bitwise_count(hashes.view(np.uint64)[:, None] ^ hashes.view(np.uint64)[None, :])
+    expected = [int(np.flatnonzero(row <= 4)[0]) for row in distances]
+    assert find_similar_groups(hashes, 4).tolist() == expected
+
+# 連写のように似た画像が続いても全組み合わせを比べない
+def test_bursts_scale_linearly():
+    hashes = bursts(np.random.default_rng(1), 500, 100)
+    started = time.perf_counter()
+    roots = find_similar_groups(hashes, 6)
+    assert time.perf_counter() - started < 5
+    assert len(set(roots.tolist())) == 500
+
+# 上限を超える threshold はエンドポイントで拒否する
+def test_threshold_above_limit_is_rejected(client, make_project):
+    pid, _ = make_project(1)
+    url = f"/annotation/near-duplicates?pid={pid}"
+    assert client.get(f"{url}&threshold={MAX_NEAR_DUPLICATE_THRESHOLD}").status_code == 200
+    assert client.get(f"{url}&threshold={MAX_NEAR_DUPLICATE_THRESHOLD + 1}").status_code == 422
@@ -0,0 +1,73 @@
+import os
+import json
+import uuid
+import routers.playground as playground
+from conftest import make_image, mock_requests
+
+def process_batch(client, base_url, files=(), **fields):
+    data = {"model": "m", "role": "role", "api_key": "test-key", "base_url": base_url, **{k: str(v) for k, v in fields.items()}}
+    response = client.post("/playground/process_batch", data=data, files=list(files))
+    assert response.status_code == 200, response.text
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    return [json.loads(line) for line in response.text.splitlines()]
+
+def upload(n):
+    return [("files", (f"up{i}.png", make_image((i * 31 % 256, 200, i * 17 % 256)), "image/png")) for i in range(n)]
+
+# 429 が返ってもリトライし，アップロードしたすべての画像の結果を1行ずつ返す
+def test_process_batch_retries_and_streams_every_image(client, mock_openai, mock_base_url):
+    mock_openai.MOCK_RATE_LIMIT_EVERY = 3
+    results = process_batch(client, mock_base_url, upload(6), instruction=f"describe {uuid.uuid4()}", concurrency=3)
+
+    assert sorted(result["index"] for result in results) == list(range(6))
+    assert {result["image"] for result in results} == {f"up{i}.png" for i in range(6)}
+    assert all(result["status"] == "ok" and result["response"].startswith("mock caption") for result in results)
+    assert mock_requests(mock_openai) > 6
+
+# プロジェクトの画像を対象にした場合，読み込めない画像だけがエラーになる
+def test_process_batch_reports_errors_per_image(client, make_project, mock_openai, mock_base_url):
+    pid, annotations = make_project(4)
+    missing = annotations[2]["image"]
+    os.remove(os.path.join("datas", pid, "imgs", missing))
+
+    results = {result["image"]: result for result in process_batch(client, mock_base_url, pid=pid, instruction=f"describe {uuid.uuid4()}")}
+
+    assert set(results) == {anno["image"] for anno in annotations}
+    assert results[missing]["status"] == "error"
+    assert all(result["status"] == "ok" for image, result in results.items() if image != missing)
+
+# 同じ画像とプロンプトの2回目はキャッシュから返し，no_cache=True の場合はモデルに問い合わせる
+def test_process_batch_uses_response_cache(client, mock_openai, mock_base_url):
+    instruction = f"describe {uuid.uuid4()}"
+    first = process_batch(client, mock_base_url, upload(3), instruction=instruction)
+    second = process_batch(client, mock_base_url, upload(3), instruction=instruction)
+    assert mock_requests(mock_openai) == 3
+    assert not any(result["cached"] for result in first)
+    assert all(result["cached"] for result in second)
+    assert sorted(r["response"] for r in first) == sorted(r["response"] for r in second)
+
+    third = process_batch(client, mock_base_url, upload(3), instruction=instruction, no_cache="true")
+    assert not any(result["cached"] for result in third)
+
+# 設定に無い接続先はリクエストを送らずに拒否する
+def test_base_url_must_be_configured(client, make_project, mock_openai):
+    for path in ("/playground/process_batch", "/playground/process_image"):
+        response = client.post(path, data={
+            "model": "m", "role": "r", "instruction": "i", "api_key": "test-key", "base_url": "http://169.254.169.254/v1",
+        }, files=upload(1)[:1] if path.endswith("batch") else [("file", ("a.png", make_image((1, 1, 1)), "image/png"))])
+        assert response.status_code == 400, response.text
+    pid, _ = make_project(1)
+    response = client.post("/annotation/prelabel", data={"pid": pid, "api_key": "test-key", "model": "m", "base_url": "http://127.0.0.1:1/v1"})
+    assert response.status_code == 400, response.text
+    assert mock_requests(mock_openai) == 0
+
+# コネクションプールは接続先ごとに共有し，APIキーごとには作らない
+def test_get_client_shares_pools_per_base_url(monkeypatch):
+    monkeypatch.setattr(playground, "_http_clients", {})
+    first = playground.get_client("key-1", "http://a.example/v1")
+    second = playground.get_client("key-2", "http://a.example/v1")
+    other = playground.get_client("key-1", None)
+    assert first._client is second._client
+    assert other._client is not first._client
+    assert (first.api_key, second.api_key) == ("key-1", "key-2")
+    assert len(playground._http_clients) == 2
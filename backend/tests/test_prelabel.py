@@ -0,0 +1,115 @@
+import os
+import time
+import uuid
+import routers.playground as playground
+from conftest import mock_requests
+
+def start(client, pid, base_url, **fields):
+    data = {"pid": pid, "api_key": "test-key", "base_url": base_url, **{k: str(v) for k, v in fields.items()}}
+    response = client.post("/annotation/prelabel", data=data)
+    assert response.status_code == 202, response.text
+    return response.json()
+
+def wait(client, pid, job_id, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        status = client.get(f"/annotation/prelabel/status?pid={pid}&job_id={job_id}").json()
+        if status["job"]["status"] not in ("pending", "running"):
+            return status
+        time.sleep(0.02)
+    raise AssertionError(f"prelabel job {job_id} did not finish")
+
+def labels(client, pid):
+    annotations = client.get(f"/annotation/get_annotations?pid={pid}&fields=image,label,draft&include_project_info=false").json()["annotations"]
+    return {anno["image"]: anno for anno in annotations}
+
+# 429 が返ってもバックオフしてリトライし，すべての画像に下書きが付く
+def test_prelabel_retries_rate_limited_requests(client, make_project, mock_openai, mock_base_url):
+    mock_openai.MOCK_RATE_LIMIT_EVERY = 3
+    pid, annotations = make_project(6)
+
+    started = start(client, pid, mock_base_url, model="m", instruction=f"describe {uuid.uuid4()}", concurrency=3, batch_size=2)
+    assert started["targets"] == 6
+    status = wait(client, pid, started["job_id"])
+
+    assert status["job"]["status"] == "completed"
+    assert status["job"]["failed"] == 0
+    assert status["job"]["result"] == {"labeled": 6, "failed": 0}
+    assert status["checkpoint"]["labeled"] == 6
+    # 3件に1件が 429 のため，画像の枚数より多くリクエストしている
+    assert mock_requests(mock_openai) > 6
+    assert all(anno["label"].startswith("mock caption") and anno["draft"] for anno in labels(client, pid).values())
+
+# 失敗した画像はチェックポイントに記録し，他の画像の処理は続ける
+def test_prelabel_records_partial_failures(client, make_project, mock_openai, mock_base_url):
+    pid, annotations = make_project(5)
+    missing = annotations[1]["image"]
+    os.remove(os.path.join("datas", pid, "imgs", missing))
+
+    started = start(client, pid, mock_base_url, model="m", instruction=f"describe {uuid.uuid4()}", concurrency=2, batch_size=2)
+    status = wait(client, pid, started["job_id"])
+
+    assert status["job"]["status"] == "completed"
+    assert status["job"]["processed"] == 5
+    assert status["job"]["failed"] == 1
+    assert status["job"]["errors"][0].startswith(f"{missing}:")
+    assert status["checkpoint"]["failed"] == [missing]
+    assert status["checkpoint"]["labeled"] == 4
+    result = labels(client, pid)
+    assert result[missing]["label"] == ""
+    assert all(anno["label"] for image, anno in result.items() if image != missing)
+
+# リトライを使い切って失敗した画像は，retry_failed=True で再開したときだけ再び処理する
+# 件数はチェックポイントに引き継がれる
+def test_prelabel_resume_retries_failed_images(client, make_project, mock_openai, mock_base_url, monkeypatch):
+    monkeypatch.setattr(playground, "MAX_RETRIES", 0)
+    mock_openai.MOCK_RATE_LIMIT_EVERY = 2
+    pid, annotations = make_project(6)
+    instruction = f"describe {uuid.uuid4()}"
+
+    first = wait(client, pid, start(client, pid, mock_base_url, model="m", instruction=instruction, concurrency=1, batch_size=1)["job_id"])
+    assert first["checkpoint"]["labeled"] == 3
+    assert len(first["checkpoint"]["failed"]) == 3
+
+    mock_openai.MOCK_RATE_LIMIT_EVERY = 0
+    skipped = start(client, pid, mock_base_url, resume="true")
+    assert skipped["targets"] == 0
+    wait(client, pid, skipped["job_id"])
+
+    resumed = start(client, pid, mock_base_url, resume="true", retry_failed="true")
+    assert resumed["targets"] == 3
+    second = wait(client, pid, resumed["job_id"])
+    assert second["checkpoint"]["labeled"] == 6
+    assert second["checkpoint"]["failed"] == []
+    # モデルと指示は前回のチェックポイントから引き継ぐ
+    assert second["checkpoint"]["model"] == "m"
+    assert second["checkpoint"]["instruction"] == instruction
+    assert all(anno["label"] for anno in labels(client, pid).values())
+
+# 中断したジョブはそれまでの結果をチェックポイントに残し，再開すると残りの画像だけを処理する
+def test_prelabel_resumes_after_interruption(client, make_project, mock_openai, mock_base_url):
+    from utils.jobs import jobs
+    mock_openai.MOCK_LATENCY = 0.1
+    pid, annotations = make_project(8)
+
+    started = start(client, pid, mock_base_url, model="m", instruction=f"describe {uuid.uuid4()}", concurrency=1, batch_size=1)
+    deadline = time.monotonic() + 30
+    # チェックポイントは最初の書き込みで作られる
+    while (client.get(f"/annotation/prelabel/status?pid={pid}&job_id={started['job_id']}").json()["checkpoint"] or {}).get("labeled", 0) < 2:
+        assert time.monotonic() < deadline
+        time.sleep(0.02)
+    client.portal.call(jobs._tasks[started["job_id"]].cancel)
+    interrupted = wait(client, pid, started["job_id"])
+
+    assert interrupted["job"]["status"] == "interrupted"
+    assert interrupted["checkpoint"]["status"] == "interrupted"
+    labeled = interrupted["checkpoint"]["labeled"]
+    assert 2 <= labeled < 8
+    assert sum(1 for anno in labels(client, pid).values() if anno["label"]) == labeled
+
+    mock_openai.MOCK_LATENCY = 0.01
+    resumed = start(client, pid, mock_base_url, resume="true")
+    assert resumed["targets"] == 8 - labeled
+    status = wait(client, pid, resumed["job_id"])
+    assert status["checkpoint"]["status"] == "completed"
+    assert status["checkpoint"]["labeled"] == 8
@@ -0,0 +1,31 @@
+import os
+import threading
+from utils import trash
+
+def files_in(path: str) -> int:
+    return sum(len(files) for _, _, files in os.walk(path))
+
+# 最後のバッチに満たない分も reclaimed_files に数え，解放後はロックファイルも残さない
+def test_reclaim_counts_the_final_partial_batch(client, make_project, monkeypatch):
+    pid, _ = make_project(4)
+    assert client.delete(f"/projects/delete/{pid}").status_code == 200
+    trash.purge(pid)
+    total = files_in(trash._trash_dir(pid))
+    monkeypatch.setattr(trash, "TRASH_RECLAIM_RATE", 10 * (total - 1))
+
+    seen = []
+    release_project = trash.blob_store.release_project
+    monkeypatch.setattr(trash.blob_store, "release_project", lambda p: (seen.append(trash._load(p)["reclaimed_files"]), release_project(p)))
+    assert trash._reclaim(pid, threading.Event())
+    assert seen == [total]
+    assert not os.path.exists(trash._meta_path(pid))
+    assert not os.path.exists(trash._lock_path(pid))
+
+# 元に戻した後はロックファイルを削除し，同じプロジェクトをもう一度ゴミ箱に移して元に戻せる
+def test_restore_removes_lock_after_releasing(client, make_project):
+    pid, _ = make_project(1)
+    for _ in range(2):
+        assert client.delete(f"/projects/delete/{pid}").status_code == 200
+        assert client.post(f"/projects/trash/{pid}/restore").status_code == 200
+        assert not os.path.exists(trash._lock_path(pid))
+    assert client.get(f"/annotation/get_annotations?pid={pid}").status_code == 200
@@ -0,0 +1,94 @@
+import os
+import json
+import socket
+import time
+import routers.uploads as uploads
+from conftest import make_image
+
+def open_session(client, images):
+    specs = [{"filename": f"img{i}.png", "size": len(data)} for i, data in enumerate(images)]
+    response = client.post("/uploads/sessions", json={"name": "upload", "description": "d", "default_role": "r", "files": specs})
+    assert response.status_code == 201, response.text
+    session = response.json()
+    for spec, data in zip(session["files"], images):
+        assert client.put(f"/uploads/sessions/{session['session_id']}/files/{spec['file_id']}", content=data).status_code == 200
+    return session["session_id"]
+
+def parts(sid):
+    return sorted(os.listdir(os.path.join(uploads.UPLOADS_DIR, sid, "files")))
+
+def edit_session(sid, **fields):
+    path = os.path.join(uploads.UPLOADS_DIR, sid, "session.json")
+    with open(path, "r", encoding="utf-8") as f:
+        session = json.load(f)
+    session.update(fields)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(session, f)
+
+# コミットに失敗した場合は open に戻り，受信したファイルを残したままコミットし直せる
+def test_failed_commit_keeps_parts_and_reopens(client, monkeypatch):
+    sid = open_session(client, [make_image((10, 20, i)) for i in range(3)])
+    received = parts(sid)
+
+    async def failing_create(job, pid, staged, *args):
+        # 取り込みと同じく，渡されたファイルを消費してから失敗する
+        for _, staged_path, _ in staged:
+            os.remove(staged_path)
+        raise RuntimeError("ingest failed")
+
+    monkeypatch.setattr(uploads, "finish_create_project", failing_create)
+    assert client.post(f"/uploads/sessions/{sid}/commit").status_code == 500
+    status = client.get(f"/uploads/sessions/{sid}").json()
+    assert status["status"] == "open"
+    assert status["error"] == "ingest failed"
+    assert status["complete_files"] == 3
+    assert parts(sid) == received
+
+    monkeypatch.undo()
+    response = client.post(f"/uploads/sessions/{sid}/commit")
+    assert response.status_code == 201, response.text
+    assert response.json()["project"]["image_count"] == 3
+    assert client.get(f"/uploads/sessions/{sid}").json()["status"] == "committed"
+    assert not os.path.exists(os.path.join(uploads.UPLOADS_DIR, sid, "files"))
+
+# コミットしていたプロセスが終了したセッションは open として扱い，コミットし直せる
+def test_commit_of_dead_worker_is_treated_as_open(client):
+    sid = open_session(client, [make_image((30, 40, i)) for i in range(2)])
+    # 存在しないプロセスID
+    edit_session(sid, status="committing", commit_id="stale", commit_owner=f"{socket.gethostname()}:{2 ** 22 + 1}", commit_started_at=time.time())
+
+    status = client.get(f"/uploads/sessions/{sid}").json()
+    assert status["status"] == "open"
+    response = client.post(f"/uploads/sessions/{sid}/commit")
+    assert response.status_code == 201, response.text
+    assert response.json()["project"]["image_count"] == 2
+
+# 時間がかかりすぎているコミットも中断されたものとみなし，セッションを削除できる
+def test_commit_past_timeout_can_be_deleted(client):
+    sid = open_session(client, [make_image((50, 60, 1))])
+    edit_session(sid, status="committing", commit_id="stale", commit_owner=f"{socket.gethostname()}:{os.getpid()}", commit_started_at=time.time())
+    assert client.delete(f"/uploads/sessions/{sid}").status_code == 409
+
+    edit_session(sid, commit_started_at=time.time() - uploads.UPLOAD_COMMIT_TIMEOUT - 1)
+    assert client.delete(f"/uploads/sessions/{sid}").status_code == 200
+    assert not os.path.exists(os.path.join(uploads.UPLOADS_DIR, sid))
+
+# ファイルごとの受信状況は files.db に記録し，session.json にはセッション単位の情報だけを置く
+def test_file_progress_is_kept_out_of_session_json(client):
+    sid = open_session(client, [make_image((70, 80, i)) for i in range(2)])
+    with open(os.path.join(uploads.UPLOADS_DIR, sid, "session.json"), "r", encoding="utf-8") as f:
+        assert "files" not in json.load(f)
+    assert client.get(f"/uploads/sessions/{sid}").json()["complete_files"] == 2
+
+# ファイルの情報を session.json に置いていた以前のセッションも，そのまま続きから受信できる
+def test_legacy_session_files_are_migrated(client):
+    data = make_image((90, 91, 92))
+    response = client.post("/uploads/sessions", json={"name": "legacy", "description": "d", "default_role": "r", "files": []})
+    sid = response.json()["session_id"]
+    os.remove(os.path.join(uploads.UPLOADS_DIR, sid, "files.db"))
+    edit_session(sid, files={"legacy": {"filename": "a.png", "size": len(data), "sha256": None, "digest": None, "complete": False}})
+
+    status = client.get(f"/uploads/sessions/{sid}").json()
+    assert [entry["file_id"] for entry in status["files"]] == ["legacy"]
+    assert client.put(f"/uploads/sessions/{sid}/files/legacy", content=data).json()["complete"]
+    assert client.post(f"/uploads/sessions/{sid}/commit").status_code == 201
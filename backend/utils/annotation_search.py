@@ -0,0 +1,45 @@
+from typing import Dict, List, Optional
+from utils.annotation_store import get_store
+from utils.project_catalog import catalog
+
+# 全プロジェクトのアノテーションを横断して検索する
+# 各プロジェクトの annotation.db が持つ全文検索索引で件数を数え，offset / limit の範囲に掛かるプロジェクトからだけレコードを取り出す
+# 結果はプロジェクトID順，プロジェクト内では画像の登録順に並ぶ
+def search_annotations(text: str, field: Optional[str] = None, pid: Optional[str] = None,
+                       offset: int = 0, limit: int = 100) -> Dict:
+    entries = sorted(catalog.entries(), key=lambda entry: entry["info"]["id"])
+    if pid is not None:
+        entries = [entry for entry in entries if entry["info"]["id"] == pid]
+
+    projects: List[Dict] = []
+    hits: List[Dict] = []
+    total = 0
+    for entry in entries:
+        project_id = entry["info"]["id"]
+        try:
+            store = get_store(project_id)
+        except FileNotFoundError:
+            continue
+        count = store.count_matches(text, field)
+        if count == 0:
+            continue
+        projects.append({"project_id": project_id, "name": entry["info"].get("name", ""), "count": count})
+
+        # このプロジェクトの中で返す範囲
+        start = max(0, offset - total)
+        wanted = offset + limit - total - start
+        total += count
+        if wanted <= 0 or start >= count:
+            continue
+        for record in store.search(text, field, offset=start, limit=min(wanted, limit - len(hits))):
+            hits.append({"project_id": project_id, **record})
+
+    return {
+        "query": text,
+        "field": field,
+        "hits": hits,
+        "total": total,
+        "offset": offset,
+        "limit": limit,
+        "projects": projects,
+    }
@@ -0,0 +1,429 @@
+import os
+import json
+import sqlite3
+import threading
+import unicodedata
+from typing import Dict, List, Optional, Tuple
+from utils.fileio import write_json_atomic
+from utils.metrics import span
+
+# 全文検索の対象にするフィールド
+SEARCH_FIELDS = ("sys", "user", "label")
+# trigram トークナイザで索引を引ける最短の文字数 (これより短い語は LIKE で走査する)
+SEARCH_MIN_QUERY = 3
+
+# 変更履歴 (changes テーブル) に残す件数
+CHANGE_RETENTION = int(os.environ.get("CHANGE_RETENTION", 100000))
+
+# アノテーションの各レコードが持つフィールド
+# draft はモデルによる事前ラベル付けで書き込まれ，まだ人が確認していないラベルであることを示す
+ANNOTATION_FIELDS = ("image", "sys", "user", "label", "dataset_split", "draft")
+
+# Unicode正規化を行う関数
+# 入力文字列の正規化を行い，一貫性を保つ
+def normalize_string(s: str) -> str:
+    return unicodedata.normalize('NFC', s.strip())
+
+# プロジェクトごとのアノテーションストア
+# annotation.db (SQLite) に画像名の索引付きでレコードを保持し，変更されたレコードだけを書き込む
+# annotation.json はインポート元/エクスポート先として扱う
+class AnnotationStore:
+    def __init__(self, project_root: str):
+        self.project_root = project_root
+        self.db_path = os.path.join(project_root, "annotation.db")
+        self.json_path = os.path.join(project_root, "annotation.json")
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=FULL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        with self._lock:
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS annotations (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    image_key TEXT NOT NULL UNIQUE,
+                    image TEXT NOT NULL,
+                    sys TEXT NOT NULL DEFAULT '',
+                    user TEXT NOT NULL DEFAULT '',
+                    label TEXT NOT NULL DEFAULT '',
+                    dataset_split TEXT NOT NULL DEFAULT 'train',
+                    version INTEGER NOT NULL DEFAULT 1,
+                    draft INTEGER NOT NULL DEFAULT 0,
+                    phash INTEGER
+                );
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL
+                );
+            """)
+            # 古いストアに draft 列を追加する
+            columns = [row["name"] for row in self._conn.execute("PRAGMA table_info(annotations)")]
+            if "draft" not in columns:
+                self._conn.execute("ALTER TABLE annotations ADD COLUMN draft INTEGER NOT NULL DEFAULT 0")
+            # 古いストアに知覚ハッシュ (画像の取り込み時に計算する dHash) の列を追加する
+            if "phash" not in columns:
+                self._conn.execute("ALTER TABLE annotations ADD COLUMN phash INTEGER")
+            self._ensure_search_index()
+            self._ensure_change_log()
+
+    # レコードの変更履歴
+    # 追加・更新・削除のたびにトリガーで画像名を記録し，seq (単調増加) で変更フィードの位置を表す
+    # 同じトランザクション内で記録されるため，どの書き込み経路・どのワーカーからの変更も漏れない
+    def _ensure_change_log(self):
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS changes (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                image_key TEXT NOT NULL,
+                image TEXT NOT NULL
+            );
+            CREATE TRIGGER IF NOT EXISTS changes_insert AFTER INSERT ON annotations BEGIN
+                INSERT INTO changes (image_key, image) VALUES (new.image_key, new.image);
+            END;
+            CREATE TRIGGER IF NOT EXISTS changes_update
+            AFTER UPDATE OF sys, user, label, dataset_split, draft ON annotations BEGIN
+                INSERT INTO changes (image_key, image) VALUES (new.image_key, new.image);
+            END;
+            CREATE TRIGGER IF NOT EXISTS changes_delete AFTER DELETE ON annotations BEGIN
+                INSERT INTO changes (image_key, image) VALUES (old.image_key, old.image);
+            END;
+        """)
+
+    # sys / user / label の全文検索索引 (FTS5)
+    # annotations を外部コンテンツとし，トリガーで同じトランザクション内に更新するため，どの書き込み経路からでも索引がずれない
+    # 日本語は空白で区切られないため，trigram トークナイザで部分一致を引けるようにする
+    def _ensure_search_index(self):
+        exists = "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'annotations_fts'"
+        if self._conn.execute(exists).fetchone():
+            return
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            # 別のプロセスが先に作成した場合は何もしない
+            if not self._conn.execute(exists).fetchone():
+                self._conn.execute(
+                    "CREATE VIRTUAL TABLE annotations_fts USING fts5("
+                    "sys, user, label, content='annotations', content_rowid='seq', tokenize='trigram')"
+                )
+                self._conn.execute("""
+                    CREATE TRIGGER IF NOT EXISTS annotations_fts_insert AFTER INSERT ON annotations BEGIN
+                        INSERT INTO annotations_fts (rowid, sys, user, label) VALUES (new.seq, new.sys, new.user, new.label);
+                    END
+                """)
+                self._conn.execute("""
+                    CREATE TRIGGER IF NOT EXISTS annotations_fts_delete AFTER DELETE ON annotations BEGIN
+                        INSERT INTO annotations_fts (annotations_fts, rowid, sys, user, label)
+                        VALUES ('delete', old.seq, old.sys, old.user, old.label);
+                    END
+                """)
+                self._conn.execute("""
+                    CREATE TRIGGER IF NOT EXISTS annotations_fts_update AFTER UPDATE OF sys, user, label ON annotations BEGIN
+                        INSERT INTO annotations_fts (annotations_fts, rowid, sys, user, label)
+                        VALUES ('delete', old.seq, old.sys, old.user, old.label);
+                        INSERT INTO annotations_fts (rowid, sys, user, label) VALUES (new.seq, new.sys, new.user, new.label);
+                    END
+                """)
+                # 既存のレコードから索引を作る
+                self._conn.execute("INSERT INTO annotations_fts (annotations_fts) VALUES ('rebuild')")
+            self._conn.execute("COMMIT")
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    # 書き込みトランザクション (BEGIN IMMEDIATE で他プロセスの書き込みと直列化する)
+    def _write(self, fn):
+        with self._lock, span("sqlite.write"):
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(self._conn)
+                self._conn.execute(
+                    "INSERT INTO meta (key, value) VALUES ('revision', '1') "
+                    "ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1"
+                )
+                # 古い変更履歴を削除する
+                self._conn.execute(
+                    "DELETE FROM changes WHERE seq <= (SELECT MAX(seq) FROM changes) - ?", (CHANGE_RETENTION,)
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            return result
+
+    def _read(self, sql: str, params=()):
+        with self._lock, span("sqlite.read"):
+            return self._conn.execute(sql, params).fetchall()
+
+    @staticmethod
+    def _to_dict(row, include_version: bool = False) -> Dict:
+        record = {field: row[field] for field in ANNOTATION_FIELDS}
+        record["draft"] = bool(record["draft"])
+        if include_version:
+            record["version"] = row["version"]
+        return record
+
+    # 書き込みのたびに増加するリビジョン番号
+    @property
+    def revision(self) -> int:
+        rows = self._read("SELECT value FROM meta WHERE key = 'revision'")
+        return int(rows[0]["value"]) if rows else 0
+
+    # 最新の変更の seq (変更が無い場合は 0)
+    def change_seq(self) -> int:
+        return self._read("SELECT COALESCE(MAX(seq), 0) AS seq FROM changes")[0]["seq"]
+
+    # since より後の変更を seq 順に返す
+    # 同じ画像が何度も変わった場合は最後の変更だけを現在の内容で返す (レコードが無ければ削除)
+    # since が保持している履歴より古い場合は None を返す (クライアントは一覧を取り直す)
+    def changes_since(self, since: int, limit: int = 1000) -> Optional[List[Dict]]:
+        oldest = self._read("SELECT MIN(seq) AS seq FROM changes")[0]["seq"]
+        if oldest is not None and since < oldest - 1:
+            return None
+        rows = self._read(
+            "SELECT changes.seq AS change_seq, changes.image AS change_image, annotations.* FROM changes "
+            "LEFT JOIN annotations ON annotations.image_key = changes.image_key "
+            "WHERE changes.seq IN (SELECT MAX(seq) FROM changes WHERE seq > ? GROUP BY image_key) "
+            "ORDER BY changes.seq LIMIT ?",
+            (since, limit),
+        )
+        return [
+            {"seq": row["change_seq"], "op": "upsert", "annotation": self._to_dict(row, include_version=True)}
+            if row["seq"] is not None else
+            {"seq": row["change_seq"], "op": "delete", "image": row["change_image"]}
+            for row in rows
+        ]
+
+    def count(self) -> int:
+        return self._read("SELECT COUNT(*) AS n FROM annotations")[0]["n"]
+
+    # include_version=True の場合はレコードごとのバージョン番号 (更新のたびに増加) も含める
+    def all(self, include_version: bool = False) -> List[Dict]:
+        rows = self._read("SELECT * FROM annotations ORDER BY seq")
+        return [self._to_dict(row, include_version) for row in rows]
+
+    # 条件に一致するレコードをページ単位で取得する
+    # after_seq を指定した場合はその位置より後ろ (カーソル)，offset はそこからの読み飛ばし件数
+    # 戻り値は (レコード, 条件に一致する総件数, 次ページのカーソル)
+    def query(self, offset: int = 0, limit: Optional[int] = None, after_seq: Optional[int] = None,
+              dataset_split: Optional[str] = None, labeled: Optional[bool] = None,
+              fields: Optional[List[str]] = None) -> Tuple[List[Dict], int, Optional[int]]:
+        fields = list(fields or ANNOTATION_FIELDS)
+        conditions, params = [], []
+        if dataset_split is not None:
+            conditions.append("dataset_split = ?")
+            params.append(dataset_split)
+        if labeled is not None:
+            conditions.append("label != ''" if labeled else "label = ''")
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        total = self._read(f"SELECT COUNT(*) AS n FROM annotations {where}", params)[0]["n"]
+
+        if after_seq is not None:
+            conditions.append("seq > ?")
+            params.append(after_seq)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        rows = self._read(
+            f"SELECT seq, {', '.join(fields)} FROM annotations {where} ORDER BY seq LIMIT ? OFFSET ?",
+            (*params, -1 if limit is None else limit, offset),
+        )
+        records = [{field: bool(row[field]) if field == "draft" else row[field] for field in fields} for row in rows]
+        next_cursor = rows[-1]["seq"] if limit is not None and len(rows) == limit else None
+        return records, total, next_cursor
+
+    def first(self) -> Optional[Dict]:
+        rows = self._read("SELECT * FROM annotations ORDER BY seq LIMIT 1")
+        return self._to_dict(rows[0]) if rows else None
+
+    def get(self, image: str) -> Optional[Dict]:
+        rows = self._read("SELECT * FROM annotations WHERE image_key = ?", (normalize_string(image),))
+        return self._to_dict(rows[0]) if rows else None
+
+    # 検索語に一致するレコードの条件 (FROM 句, WHERE 句, パラメータ)
+    # field を指定した場合はそのフィールドだけを対象にする
+    @staticmethod
+    def _search_clause(text: str, field: Optional[str]) -> Tuple[str, str, List]:
+        fields = [field] if field else list(SEARCH_FIELDS)
+        if len(text) >= SEARCH_MIN_QUERY:
+            # 検索語全体を1つのフレーズとして扱う (FTS5 の演算子として解釈させない)
+            phrase = '"' + text.replace('"', '""') + '"'
+            expression = f"{{{' '.join(fields)}}} : {phrase}"
+            return "annotations_fts JOIN annotations ON annotations.seq = annotations_fts.rowid", \
+                "annotations_fts MATCH ?", [expression]
+        pattern = "%" + text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        return "annotations", " OR ".join(f"{f} LIKE ? ESCAPE '\\'" for f in fields), [pattern] * len(fields)
+
+    # 検索語に一致するレコードの件数
+    def count_matches(self, text: str, field: Optional[str] = None) -> int:
+        source, where, params = self._search_clause(normalize_string(text), field)
+        return self._read(f"SELECT COUNT(*) AS n FROM {source} WHERE {where}", params)[0]["n"]
+
+    # 検索語 (部分一致，大文字小文字は区別しない) に一致するレコードを画像の登録順に返す
+    def search(self, text: str, field: Optional[str] = None, offset: int = 0, limit: int = 100) -> List[Dict]:
+        source, where, params = self._search_clause(normalize_string(text), field)
+        rows = self._read(
+            f"SELECT annotations.* FROM {source} WHERE {where} ORDER BY annotations.seq LIMIT ? OFFSET ?",
+            (*params, limit, offset),
+        )
+        return [self._to_dict(row) for row in rows]
+
+    def _update_row(self, conn, image: str, fields: Dict) -> Optional[Dict]:
+        fields = {k: v for k, v in fields.items() if k in ANNOTATION_FIELDS and k != "image"}
+        key = normalize_string(image)
+        # ラベルを書き換えた場合は，明示されない限り確認済みのラベルとして扱う
+        if "label" in fields and "draft" not in fields:
+            fields["draft"] = False
+        if fields:
+            assignments = ", ".join(f"{k} = ?" for k in fields)
+            cur = conn.execute(
+                f"UPDATE annotations SET {assignments}, version = version + 1 WHERE image_key = ?",
+                (*fields.values(), key),
+            )
+            if cur.rowcount == 0:
+                return None
+        row = conn.execute("SELECT * FROM annotations WHERE image_key = ?", (key,)).fetchone()
+        return self._to_dict(row) if row else None
+
+    # 画像名に対応するレコードを更新する (存在しない場合は None を返す)
+    def update(self, image: str, fields: Dict) -> Optional[Dict]:
+        return self._write(lambda conn: self._update_row(conn, image, fields))
+
+    # レコードを更新し，受け付けた内容 (画像名・バージョン・変更フィードの seq) だけを返す
+    # 更新後のレコードは変更フィードで配信される
+    def save(self, image: str, fields: Dict) -> Optional[Dict]:
+        def apply(conn):
+            if self._update_row(conn, image, fields) is None:
+                return None
+            row = conn.execute("SELECT image, version FROM annotations WHERE image_key = ?", (normalize_string(image),)).fetchone()
+            seq = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM changes").fetchone()[0]
+            return {"image": row["image"], "version": row["version"], "seq": seq}
+
+        return self._write(apply)
+
+    # 複数のレコードを1つのトランザクションで更新する
+    # updates は (画像名, 更新するフィールド) のリストで，結果は同じ順で返す
+    def update_many(self, updates: List[Tuple[str, Dict]]) -> List[Optional[Dict]]:
+        return self._write(lambda conn: [self._update_row(conn, image, fields) for image, fields in updates])
+
+    # ラベルが空のレコードにだけ下書きのラベルを書き込む (人が入力したラベルは上書きしない)
+    # updates は (画像名, ラベル) のリストで，書き込んだ件数を返す
+    def fill_drafts(self, updates: List[Tuple[str, str]]) -> int:
+        def apply(conn):
+            filled = 0
+            for image, label in updates:
+                cur = conn.execute(
+                    "UPDATE annotations SET label = ?, draft = 1, version = version + 1 "
+                    "WHERE image_key = ? AND label = ''",
+                    (label, normalize_string(image)),
+                )
+                filled += cur.rowcount
+            return filled
+
+        return self._write(apply)
+
+    # 画像名と知覚ハッシュ (未計算の場合は None) を登録順に返す
+    def hashes(self) -> List[Tuple[str, Optional[int]]]:
+        return [(row["image"], row["phash"]) for row in self._read("SELECT image, phash FROM annotations ORDER BY seq")]
+
+    # 知覚ハッシュを保存する (アノテーションの内容は変わらないため，レコードのバージョンは上げない)
+    def set_hashes(self, updates: List[Tuple[str, int]]):
+        if not updates:
+            return
+        self._write(lambda conn: conn.executemany(
+            "UPDATE annotations SET phash = ? WHERE image_key = ?",
+            [(value, normalize_string(image)) for image, value in updates],
+        ))
+
+    @staticmethod
+    def _insert(conn, annotations: List[Dict]) -> int:
+        inserted = 0
+        for anno in annotations:
+            cur = conn.execute(
+                "INSERT OR IGNORE INTO annotations (image_key, image, sys, user, label, dataset_split, draft, phash, version) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    normalize_string(anno["image"]),
+                    anno["image"],
+                    anno.get("sys", ""),
+                    anno.get("user", ""),
+                    anno.get("label", ""),
+                    anno.get("dataset_split", "train"),
+                    int(bool(anno.get("draft", False))),
+                    anno.get("phash"),
+                    anno.get("version", 1),
+                ),
+            )
+            inserted += cur.rowcount
+        return inserted
+
+    # レコードを末尾に追加する (既に登録済みの画像は無視する)
+    def insert_many(self, annotations: List[Dict]) -> int:
+        return self._write(lambda conn: self._insert(conn, annotations))
+
+    # annotation.json の内容でストアを置き換える
+    def import_json(self, path: Optional[str] = None) -> int:
+        with span("json.load"), open(path or self.json_path, "r", encoding="utf-8") as f:
+            annotations = json.load(f)
+
+        def apply(conn):
+            # 画像が同じであれば計算済みの知覚ハッシュを引き継ぐ
+            known = dict(conn.execute("SELECT image_key, phash FROM annotations WHERE phash IS NOT NULL").fetchall())
+            # 取り込んだレコードには，これまでどのレコードにも付いたことのないバージョンを付ける
+            # (各レコードのバージョンはリビジョン番号を超えないため，リビジョン + 1 を使う)
+            # 1 に戻すと，エクスポートのマニフェストが取り込み前の古い行を再利用してしまう
+            row = conn.execute("SELECT value FROM meta WHERE key = 'revision'").fetchone()
+            version = (int(row["value"]) if row else 0) + 1
+            conn.execute("DELETE FROM annotations")
+            records = []
+            for anno in annotations:
+                record = {**anno, "version": version}
+                if "phash" not in anno:
+                    record["phash"] = known.get(normalize_string(anno["image"]))
+                records.append(record)
+            return self._insert(conn, records)
+
+        return self._write(apply)
+
+    # ストアの内容を annotation.json 形式で書き出す
+    def export_json(self, path: Optional[str] = None) -> str:
+        path = path or self.json_path
+        # 書き込み途中のファイルが残らないよう，一時ファイルに書いてから置き換える
+        write_json_atomic(path, self.all())
+        return path
+
+_stores: Dict[str, AnnotationStore] = {}
+_stores_lock = threading.Lock()
+
+# プロジェクトのストアを取得する
+# annotation.db が無く annotation.json がある場合は初回に取り込む
+# create=True の場合はどちらも無くても空のストアを作成する
+def get_store(pid: str, create: bool = False) -> AnnotationStore:
+    project_root = os.path.join("datas", f"{pid}")
+    with _stores_lock:
+        store = _stores.get(pid)
+        if store is not None:
+            if os.path.exists(store.db_path):
+                return store
+            # 外部でプロジェクトが消された場合は古い接続を破棄する
+            store.close()
+            del _stores[pid]
+
+        db_path = os.path.join(project_root, "annotation.db")
+        json_path = os.path.join(project_root, "annotation.json")
+        needs_import = not os.path.exists(db_path) and os.path.exists(json_path)
+        if not (os.path.exists(db_path) or needs_import or create):
+            raise FileNotFoundError(f"Annotation store not found for project '{pid}'")
+
+        store = AnnotationStore(project_root)
+        if needs_import:
+            store.import_json()
+        _stores[pid] = store
+        return store
+
+# プロジェクト削除時などにストアを閉じてキャッシュから外す
+def close_store(pid: str):
+    with _stores_lock:
+        store = _stores.pop(pid, None)
+    if store is not None:
+        store.close()
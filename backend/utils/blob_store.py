@@ -0,0 +1,105 @@
+import os
+import shutil
+import sqlite3
+import threading
+from typing import List, Optional
+
+# コンテンツハッシュをキーに画像を保持するブロブストア
+# 同じ内容の画像はプロジェクトをまたいで1つのファイルを共有し，
+# 各プロジェクトの imgs ディレクトリにはハードリンクを作成する
+# どのプロジェクトから参照されているかを refs.db で管理し，参照が無くなったブロブだけを削除する
+class BlobStore:
+    def __init__(self, root: str = os.path.join("datas", ".blobs")):
+        self.root = root
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(self.root, exist_ok=True)
+            self._conn = sqlite3.connect(os.path.join(self.root, "refs.db"), check_same_thread=False, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA busy_timeout=5000")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS refs (
+                    digest TEXT NOT NULL,
+                    project_id TEXT NOT NULL,
+                    PRIMARY KEY (digest, project_id)
+                )
+            """)
+        return self._conn
+
+    def blob_path(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest)
+
+    # プロジェクトからの参照を登録する (新たに参照した場合は True)
+    # ブロブを作成する前に参照を登録しておくことで，並行する削除処理に消されないようにする
+    def acquire(self, digest: str, project_id: str) -> bool:
+        with self._lock:
+            cur = self._connection().execute(
+                "INSERT OR IGNORE INTO refs (digest, project_id) VALUES (?, ?)", (digest, project_id)
+            )
+            return cur.rowcount == 1
+
+    # ステージング済みのファイルをブロブとして保存する
+    # 同じ内容のブロブが既にある場合は False を返す (重複排除のヒット)
+    def put(self, digest: str, staged_path: str) -> bool:
+        blob_path = self.blob_path(digest)
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        try:
+            os.link(staged_path, blob_path)
+        except FileExistsError:
+            return False
+        except OSError:
+            # ハードリンクが使えないファイルシステムではコピーする
+            if os.path.exists(blob_path):
+                return False
+            tmp_path = f"{blob_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            shutil.copyfile(staged_path, tmp_path)
+            os.replace(tmp_path, blob_path)
+        return True
+
+    # ブロブをプロジェクト内のパスに配置する
+    def link(self, digest: str, dest_path: str):
+        try:
+            os.link(self.blob_path(digest), dest_path)
+        except FileExistsError:
+            pass
+        except OSError:
+            shutil.copyfile(self.blob_path(digest), dest_path)
+
+    # 参照の無くなったブロブを削除し，削除したダイジェストを返す
+    def _collect(self, conn: sqlite3.Connection, digests: List[str]) -> List[str]:
+        removed = []
+        for digest in digests:
+            if conn.execute("SELECT 1 FROM refs WHERE digest = ? LIMIT 1", (digest,)).fetchone() is None:
+                try:
+                    os.remove(self.blob_path(digest))
+                    removed.append(digest)
+                except FileNotFoundError:
+                    pass
+        return removed
+
+    def _release(self, where: str, params) -> List[str]:
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                digests = [row[0] for row in conn.execute(f"SELECT digest FROM refs WHERE {where}", params)]
+                conn.execute(f"DELETE FROM refs WHERE {where}", params)
+                removed = self._collect(conn, digests)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            return removed
+
+    # 1つの画像についてプロジェクトからの参照を解除する
+    def release(self, digest: str, project_id: str) -> List[str]:
+        return self._release("digest = ? AND project_id = ?", (digest, project_id))
+
+    # プロジェクトからの参照をすべて解除する
+    def release_project(self, project_id: str) -> List[str]:
+        return self._release("project_id = ?", (project_id,))
+
+blob_store = BlobStore()
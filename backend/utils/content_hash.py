@@ -0,0 +1,79 @@
+import os
+import hashlib
+import sqlite3
+import threading
+from typing import Optional, Union
+
+# キャッシュの保存先 (画像のBase64エンコード結果や派生画像などを保持する)
+CACHE_ROOT = os.environ.get("CACHE_DIR", "cache")
+
+# 画像ファイルのパス・更新時刻・サイズからコンテンツハッシュを引く索引
+# 変更されていない画像はハッシュを計算し直さずにキャッシュを参照できる
+class StatIndex:
+    def __init__(self, db_path: str):
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS stat_index (
+                path TEXT PRIMARY KEY,
+                mtime_ns INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                digest TEXT NOT NULL
+            )
+        """)
+
+    def lookup(self, path: str, st: os.stat_result) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT digest FROM stat_index WHERE path = ? AND mtime_ns = ? AND size = ?",
+                (path, st.st_mtime_ns, st.st_size),
+            ).fetchone()
+        return row[0] if row else None
+
+    def store(self, path: str, st: os.stat_result, digest: str):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO stat_index (path, mtime_ns, size, digest) VALUES (?, ?, ?, ?)",
+                (path, st.st_mtime_ns, st.st_size, digest),
+            )
+
+_stat_index: Optional[StatIndex] = None
+_stat_index_lock = threading.Lock()
+
+def get_stat_index() -> StatIndex:
+    global _stat_index
+    with _stat_index_lock:
+        if _stat_index is None:
+            _stat_index = StatIndex(os.path.join(CACHE_ROOT, "stat_index.db"))
+        return _stat_index
+
+# 画像ファイルのコンテンツハッシュ (sha256) を返す
+# 更新時刻とサイズが変わっていなければ索引の値を使う
+def file_digest(path: str) -> str:
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    index = get_stat_index()
+    digest = index.lookup(path, st)
+    if digest is None:
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(chunk)
+        digest = h.hexdigest()
+        index.store(path, st, digest)
+    return digest
+
+# 一時ファイルに書いてから置き換えることで，途中までのキャッシュが残らないようにする
+def write_cache_file(path: str, data: Union[str, bytes]):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    if isinstance(data, bytes):
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+    else:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(data)
+    os.replace(tmp_path, path)
@@ -0,0 +1,267 @@
+import os
+import gzip
+import json
+import base64
+import zipfile
+from collections import deque
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from utils.annotation_store import get_store
+from utils.content_hash import CACHE_ROOT, file_digest, write_cache_file
+from utils.derivatives import export_image, export_params
+from utils.fileio import atomic_write, project_lock, write_json_atomic
+from utils.metrics import span
+from utils.near_duplicates import duplicate_images
+
+# エンコードを並列に行うワーカー数
+EXPORT_WORKERS = int(os.environ.get("EXPORT_WORKERS", os.cpu_count() or 4))
+
+# 圧縮してストリーミングする際の圧縮レベルと，クライアントへ送るチャンクの大きさ (バイト)
+DOWNLOAD_COMPRESSLEVEL = int(os.environ.get("DOWNLOAD_COMPRESSLEVEL", 6))
+DOWNLOAD_CHUNK_SIZE = int(os.environ.get("DOWNLOAD_CHUNK_SIZE", 1024 * 1024))
+
+_executor = ThreadPoolExecutor(max_workers=EXPORT_WORKERS, thread_name_prefix="export")
+
+def _cache_path(kind: str, key: str, ext: str) -> str:
+    return os.path.join(CACHE_ROOT, kind, key[:2], f"{key}{ext}")
+
+# 画像をBase64エンコードし，(Base64文字列, MIMEタイプ) を返す
+# エクスポート設定に合わせて縮小・再エンコードした結果を，コンテンツハッシュと設定をキーにディスクへキャッシュする
+def encode_image_cached(image_path: str) -> Tuple[str, str]:
+    digest = file_digest(image_path)
+    cache_file = _cache_path("encoded", f"{digest}_{export_params()}", ".b64")
+    try:
+        with span("file.read_encoded_cache"), open(cache_file, "r", encoding="utf-8") as f:
+            mime, encoded = f.read().split("\n", 1)
+            return encoded, mime
+    except FileNotFoundError:
+        pass
+
+    data, mime = export_image(image_path)
+    with span("base64.encode"):
+        encoded = base64.b64encode(data).decode('utf-8')
+    with span("file.write_encoded_cache"):
+        write_cache_file(cache_file, f"{mime}\n{encoded}")
+    return encoded, mime
+
+# データセットに含めるアノテーションかどうか
+def is_exportable(anno: Dict, dataset_split: str) -> bool:
+    return anno["dataset_split"] == dataset_split and (anno["sys"] != "") and (anno["user"] != "") and (anno["label"] != "")
+
+# アノテーション1件からJSONLの1行を作成する
+def build_line(project_root: str, anno: Dict) -> str:
+    # 画像ファイルのパスを取得
+    image_path = os.path.join(project_root, "imgs", anno["image"])
+    # 画像データをBase64エンコード
+    base64_image, mime = encode_image_cached(image_path)
+    # エンコードした画像データをURL形式に変換
+    url = f"data:{mime};base64,{base64_image}"
+    # JSONL形式のデータを作成
+    item = {
+        "messages": [
+            {"role": "system", "content": anno["sys"]},
+            {"role": "user", "content": anno["user"]},
+            {"role": "user", "content": [
+                {"type": "image_url", "image_url": {"url": url}}
+            ]},
+            {"role": "assistant", "content": anno["label"]}
+        ]
+    }
+    with span("json.dump"):
+        return json.dumps(item, ensure_ascii=False) + '\n'
+
+# 入力順を保ったままワーカープールで処理する
+# 先読みする件数を window に制限し，メモリ使用量を一定に保つ
+# 途中で例外が発生した場合や読み出しをやめた場合は，残りの処理を取り消して実行中のものが終わるまで待つ
+# (fn が参照するファイルなどを呼び出し側が閉じた後に処理が走らないようにする)
+def ordered_map(fn, items: Iterable, window: Optional[int] = None) -> Iterator:
+    window = window or EXPORT_WORKERS * 2
+    pending = deque()
+    try:
+        for item in items:
+            pending.append(_executor.submit(fn, item))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+        wait(pending)
+
+# エクスポートするレコードを登録順に返す
+# exclude_duplicates=True の場合は，ほぼ同じ画像のグループごとに最初の1件だけを残す
+def exportable_records(pid: str, dataset_split: str, exclude_duplicates: bool = False, include_version: bool = False) -> List[Dict]:
+    records = [anno for anno in get_store(pid).all(include_version=include_version) if is_exportable(anno, dataset_split)]
+    if exclude_duplicates:
+        duplicates = duplicate_images(pid, [anno["image"] for anno in records])
+        records = [anno for anno in records if anno["image"] not in duplicates]
+    return records
+
+# データセットのJSONL行を順に生成する
+def iter_dataset_lines(pid: str, dataset_split: str, exclude_duplicates: bool = False) -> Iterator[str]:
+    project_root = os.path.join("datas", f"{pid}")
+    annotations = exportable_records(pid, dataset_split, exclude_duplicates)
+    yield from ordered_map(lambda anno: build_line(project_root, anno), annotations)
+
+# 圧縮後のバイト列を溜めておき，ストリーミングのチャンクとして取り出すための書き込み先
+# シークできないため，zipfile はローカルヘッダの後ろにデータディスクリプタを書く形式で出力する
+class _StreamBuffer:
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def write(self, data) -> int:
+        self._buffer += data
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def __len__(self) -> int:
+        return len(self._buffer)
+
+    def take(self) -> bytes:
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        return data
+
+# 行を shard_size バイト (非圧縮のJSONLでの大きさ) 以下のシャードに分ける
+# 1行だけで上限を超える場合はその行だけのシャードにする
+def _shards(lines: Iterable[str], shard_size: Optional[int]) -> Iterator[Tuple[int, Iterator[bytes]]]:
+    lines = (line.encode("utf-8") for line in lines)
+    carry: List[bytes] = []
+    index = 0
+
+    def shard() -> Iterator[bytes]:
+        size = 0
+        while carry:
+            line = carry.pop()
+            size += len(line)
+            yield line
+        for line in lines:
+            if shard_size is not None and size > 0 and size + len(line) > shard_size:
+                carry.append(line)
+                return
+            size += len(line)
+            yield line
+
+    while True:
+        index += 1
+        yield index, shard()
+        if not carry:
+            return
+
+# データセットのJSONLを圧縮しながらチャンク単位で生成する (一時ファイルは作らない)
+# fmt="zip" は splits ごと (shard_size を指定した場合はシャードごと) のJSONLを1つのアーカイブにまとめる
+# fmt="gzip" は1つの split を1本の .jsonl.gz として出力する
+def iter_dataset_archive(pid: str, splits: List[str], fmt: str = "zip", shard_size: Optional[int] = None,
+                         exclude_duplicates: bool = False) -> Iterator[bytes]:
+    out = _StreamBuffer()
+    if fmt == "gzip":
+        with gzip.GzipFile(fileobj=out, mode="wb", compresslevel=DOWNLOAD_COMPRESSLEVEL, mtime=0) as gz:
+            for line in iter_dataset_lines(pid, splits[0], exclude_duplicates):
+                gz.write(line.encode("utf-8"))
+                if len(out) >= DOWNLOAD_CHUNK_SIZE:
+                    yield out.take()
+        yield out.take()
+        return
+
+    with zipfile.ZipFile(out, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=DOWNLOAD_COMPRESSLEVEL) as archive:
+        for split in splits:
+            for index, shard in _shards(iter_dataset_lines(pid, split, exclude_duplicates), shard_size):
+                name = f"{split}.jsonl" if shard_size is None else f"{split}-{index:05d}.jsonl"
+                # 大きさが事前に分からないため，4GBを超えても書けるよう常に ZIP64 で書く
+                with archive.open(name, "w", force_zip64=True) as entry:
+                    for line in shard:
+                        entry.write(line)
+                        if len(out) >= DOWNLOAD_CHUNK_SIZE:
+                            yield out.take()
+                yield out.take()
+    yield out.take()
+
+def _manifest_path(dataset_path: str) -> str:
+    return f"{os.path.splitext(dataset_path)[0]}.manifest.json"
+
+# 前回のエクスポート結果のマニフェストを読み込む
+# データセットファイルがマニフェスト作成時から変わっている場合は使わない
+def _load_manifest(dataset_path: str) -> Optional[Dict]:
+    try:
+        with open(_manifest_path(dataset_path), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        st = os.stat(dataset_path)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    if manifest.get("size") != st.st_size or manifest.get("mtime_ns") != st.st_mtime_ns:
+        return None
+    # エクスポート設定が変わった場合は全件作り直す
+    if manifest.get("params") != export_params():
+        return None
+    return manifest
+
+# データセットファイルを作成し，パスと再利用/再生成の件数を返す
+# 前回のエクスポートからバージョンと画像の更新時刻が変わっていないレコードは，
+# 既存のJSONLファイルから該当する行をそのままコピーする
+# 同じプロジェクトのエクスポートが同時に走らないよう，プロジェクト単位のロックを取って実行する
+def write_dataset(pid: str, dataset_split: str, exclude_duplicates: bool = False) -> Tuple[str, Dict[str, int]]:
+    with project_lock(pid), span("dataset.write"):
+        return _write_dataset(pid, dataset_split, exclude_duplicates)
+
+def _write_dataset(pid: str, dataset_split: str, exclude_duplicates: bool = False) -> Tuple[str, Dict[str, int]]:
+    project_root = os.path.join("datas", f"{pid}")
+    dataset_path = os.path.join(project_root, f"{dataset_split}_dataset.jsonl")
+    records = exportable_records(pid, dataset_split, exclude_duplicates, include_version=True)
+
+    manifest = _load_manifest(dataset_path)
+    previous = {}
+    if manifest is not None:
+        for image, version, mtime_ns, offset, length in manifest["entries"]:
+            previous[image] = (version, mtime_ns, offset, length)
+
+    # レコードごとに再利用できる行の位置を調べる
+    plan = []
+    for anno in records:
+        image_path = os.path.join(project_root, "imgs", anno["image"])
+        mtime_ns = os.stat(image_path).st_mtime_ns
+        entry = previous.get(anno["image"])
+        reusable = entry if entry is not None and entry[0] == anno["version"] and entry[1] == mtime_ns else None
+        plan.append((anno, mtime_ns, reusable))
+
+    stats = {
+        "reused": sum(1 for _, _, reusable in plan if reusable is not None),
+        "regenerated": sum(1 for _, _, reusable in plan if reusable is None),
+    }
+
+    # 変更が無く行の並びも同じであれば既存のファイルをそのまま使う
+    if manifest is not None and stats["regenerated"] == 0 and len(plan) == len(manifest["entries"]) and \
+            all(anno["image"] == entry[0] for (anno, _, _), entry in zip(plan, manifest["entries"])):
+        return dataset_path, stats
+
+    old_fd = os.open(dataset_path, os.O_RDONLY) if stats["reused"] else None
+
+    def produce(item) -> bytes:
+        anno, _, reusable = item
+        if reusable is not None:
+            _, _, offset, length = reusable
+            return os.pread(old_fd, length, offset)
+        return build_line(project_root, anno).encode("utf-8")
+
+    entries = []
+    offset = 0
+    try:
+        with atomic_write(dataset_path, "wb") as f, closing(ordered_map(produce, plan)) as lines:
+            for (anno, mtime_ns, _), line in zip(plan, lines):
+                f.write(line)
+                entries.append([anno["image"], anno["version"], mtime_ns, offset, len(line)])
+                offset += len(line)
+    finally:
+        if old_fd is not None:
+            os.close(old_fd)
+
+    st = os.stat(dataset_path)
+    write_json_atomic(
+        _manifest_path(dataset_path),
+        {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "params": export_params(), "entries": entries},
+        indent=None,
+    )
+    return dataset_path, stats
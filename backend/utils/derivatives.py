@@ -0,0 +1,73 @@
+import os
+import io
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Tuple
+from PIL import Image, ImageOps
+from utils.content_hash import CACHE_ROOT, file_digest, write_cache_file
+from utils.metrics import span
+
+# UI用サムネイルの最大辺とJPEG品質
+THUMBNAIL_MAX_SIDE = int(os.environ.get("THUMBNAIL_MAX_SIDE", 256))
+THUMBNAIL_QUALITY = int(os.environ.get("THUMBNAIL_QUALITY", 80))
+# エクスポート用画像の最大辺とJPEG品質 (最大辺が0の場合は元の画像をそのまま使う)
+EXPORT_MAX_SIDE = int(os.environ.get("EXPORT_MAX_SIDE", 2048))
+EXPORT_JPEG_QUALITY = int(os.environ.get("EXPORT_JPEG_QUALITY", 90))
+
+_executor = ThreadPoolExecutor(max_workers=int(os.environ.get("DERIVATIVE_WORKERS", 2)), thread_name_prefix="derivative")
+
+# 派生画像のキャッシュパス
+# 元画像のコンテンツハッシュをキーに含めるため，元画像が変われば別のファイルになる
+def derivative_path(digest: str, max_side: int, quality: int) -> str:
+    return os.path.join(CACHE_ROOT, "derivatives", digest[:2], f"{digest}_{max_side}_{quality}.jpg")
+
+# 最大辺を max_side に縮小したJPEGのバイト列を作成する
+def render_jpeg(source_path: str, max_side: int, quality: int) -> bytes:
+    with span("pil.render_jpeg"), Image.open(source_path) as img:
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((max_side, max_side), Image.LANCZOS)
+        if img.mode != "RGB":
+            # 透過部分は白で塗りつぶす
+            background = Image.new("RGB", img.size, (255, 255, 255))
+            rgba = img.convert("RGBA")
+            background.paste(rgba, mask=rgba.getchannel("A"))
+            img = background
+        buffer = io.BytesIO()
+        img.save(buffer, "JPEG", quality=quality, optimize=True)
+        return buffer.getvalue()
+
+# 派生画像を取得する (キャッシュに無ければ作成する)
+def get_derivative(source_path: str, max_side: int, quality: int) -> str:
+    path = derivative_path(file_digest(source_path), max_side, quality)
+    if not os.path.exists(path):
+        write_cache_file(path, render_jpeg(source_path, max_side, quality))
+    return path
+
+def get_thumbnail(source_path: str) -> str:
+    return get_derivative(source_path, THUMBNAIL_MAX_SIDE, THUMBNAIL_QUALITY)
+
+# エクスポートに使う画像のバイト列とMIMEタイプ
+# 既に最大辺以下のJPEGは再エンコードせずにそのまま使う
+def export_image(source_path: str) -> Tuple[bytes, str]:
+    with Image.open(source_path) as img:
+        source_format = img.format
+        size = img.size
+    if EXPORT_MAX_SIDE <= 0 or (source_format == "JPEG" and max(size) <= EXPORT_MAX_SIDE):
+        with open(source_path, "rb") as f:
+            return f.read(), Image.MIME.get(source_format, "image/jpeg")
+    with open(get_derivative(source_path, EXPORT_MAX_SIDE, EXPORT_JPEG_QUALITY), "rb") as f:
+        return f.read(), "image/jpeg"
+
+# エクスポート設定 (設定が変わった場合は既存のデータセットを再利用しない)
+def export_params() -> str:
+    return f"{EXPORT_MAX_SIDE}_{EXPORT_JPEG_QUALITY}"
+
+# サムネイルをバックグラウンドで作成しておく
+def schedule_thumbnails(source_paths: Iterable[str]):
+    for source_path in source_paths:
+        _executor.submit(_warm_thumbnail, source_path)
+
+def _warm_thumbnail(source_path: str):
+    try:
+        get_thumbnail(source_path)
+    except Exception as e:
+        print(f"Failed to create thumbnail for {source_path}: {e}")
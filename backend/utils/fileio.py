@@ -0,0 +1,96 @@
+import os
+import json
+import asyncio
+import fcntl
+import tempfile
+import threading
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, Dict
+from fastapi.concurrency import run_in_threadpool
+from utils.metrics import span
+
+# ファイルを一時ファイルに書いてから置き換える
+# 置き換えはアトミックに行われるため，書き込み途中でクラッシュしても元のファイルか新しいファイルのどちらかが残る
+@contextmanager
+def atomic_write(path: str, mode: str = "w", encoding: str = "utf-8"):
+    with span("file.atomic_write"):
+        directory = os.path.dirname(path) or "."
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(path)}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, mode, encoding=None if "b" in mode else encoding) as f:
+                yield f
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        # ディレクトリのエントリも永続化する
+        dir_fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+# JSONファイルをアトミックに書き込む
+def write_json_atomic(path: str, data: Any, **kwargs):
+    kwargs.setdefault("indent", 4)
+    kwargs.setdefault("ensure_ascii", False)
+    with atomic_write(path) as f, span("json.dump"):
+        json.dump(data, f, **kwargs)
+
+_thread_locks: Dict[str, threading.Lock] = {}
+_thread_locks_guard = threading.Lock()
+
+def _thread_lock(key: str) -> threading.Lock:
+    with _thread_locks_guard:
+        return _thread_locks.setdefault(key, threading.Lock())
+
+# ロックファイルに対する排他ロック
+# flock で複数のワーカープロセスの間でも排他し，同じプロセス内のスレッド同士はスレッドロックで排他する
+# blocking=False の場合，他で保持されていれば待たずに BlockingIOError を送出する
+@contextmanager
+def file_lock(lock_path: str, blocking: bool = True):
+    lock = _thread_lock(os.path.abspath(lock_path))
+    if not lock.acquire(blocking=blocking):
+        raise BlockingIOError(f"{lock_path} is locked")
+    try:
+        fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            try:
+                yield
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+    finally:
+        lock.release()
+
+# プロジェクト単位の排他ロック (datas/{pid}/.lock)
+# プロジェクトディレクトリが無い場合は FileNotFoundError を送出する (削除済みのプロジェクトを作り直さない)
+@contextmanager
+def project_lock(pid: str):
+    with file_lock(os.path.join("datas", f"{pid}", ".lock")):
+        yield
+
+# イベントループを塞がないよう，ロックの取得と解放をスレッドで行う
+# ロックを待っている間に取り消された場合も，スレッドはロックを取得するため，取得した時点で解放する
+@asynccontextmanager
+async def async_project_lock(pid: str):
+    loop = asyncio.get_running_loop()
+    manager = project_lock(pid)
+    acquiring = loop.run_in_executor(None, manager.__enter__)
+    try:
+        await asyncio.shield(acquiring)
+    except asyncio.CancelledError:
+        def release(future):
+            if not future.cancelled() and future.exception() is None:
+                loop.run_in_executor(None, manager.__exit__, None, None, None)
+        acquiring.add_done_callback(release)
+        raise
+    try:
+        yield
+    finally:
+        await run_in_threadpool(manager.__exit__, None, None, None)
@@ -0,0 +1,55 @@
+import os
+import re
+from typing import Optional
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import NotModifiedResponse, StaticFiles
+from starlette.types import Scope
+from utils.content_hash import get_stat_index
+
+# コンテンツハッシュ (sha256) をファイル名に持つ画像
+CONTENT_ADDRESSED_NAME = re.compile(r"^([0-9a-f]{64})\.[A-Za-z0-9]+$")
+# ファイル名から内容が決まるため，ブラウザやプロキシに無期限にキャッシュさせる
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# それ以外のファイル (annotation.json など) は毎回 ETag で再検証させる
+REVALIDATE_CACHE_CONTROL = "no-cache"
+# nginx などのリバースプロキシに送信を任せる場合の内部パス (例: /protected-images/)
+# 設定した場合は X-Accel-Redirect ヘッダだけを返し，プロキシ側が sendfile で送信する
+IMAGES_ACCEL_REDIRECT = os.environ.get("IMAGES_ACCEL_REDIRECT", "")
+
+# コンテンツハッシュ名の画像であれば，そのハッシュを返す
+def content_hash_of(path: str) -> Optional[str]:
+    if os.path.basename(os.path.dirname(path)) != "imgs":
+        return None
+    match = CONTENT_ADDRESSED_NAME.match(os.path.basename(path))
+    return match.group(1) if match else None
+
+# datas ディレクトリを配信する StaticFiles
+# - コンテンツハッシュ名の画像はハッシュを強いETagにし，immutable でキャッシュさせる
+# - それ以外のファイルもハッシュの索引にあればそれを強いETagにする (無ければ更新時刻とサイズから作られる既定のETag)
+# - If-None-Match / If-Modified-Since には 304 を返す
+# - Range リクエストと，サーバーが対応していれば http.response.pathsend による送信は FileResponse が行う
+class ImageFiles(StaticFiles):
+    def file_response(self, full_path, stat_result: os.stat_result, scope: Scope, status_code: int = 200) -> Response:
+        request_headers = Headers(scope=scope)
+        path = os.fspath(full_path)
+
+        response = FileResponse(path, status_code=status_code, stat_result=stat_result)
+        digest = content_hash_of(path)
+        if digest is not None:
+            response.headers["cache-control"] = IMMUTABLE_CACHE_CONTROL
+        else:
+            digest = get_stat_index().lookup(os.path.abspath(path), stat_result)
+            response.headers["cache-control"] = REVALIDATE_CACHE_CONTROL
+        if digest is not None:
+            response.headers["etag"] = f'"{digest}"'
+
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+
+        if IMAGES_ACCEL_REDIRECT and status_code == 200:
+            relative = os.path.relpath(path, self.directory).replace(os.sep, "/")
+            headers = {key: value for key, value in response.headers.items() if key not in ("content-length", "accept-ranges")}
+            headers["x-accel-redirect"] = IMAGES_ACCEL_REDIRECT.rstrip("/") + "/" + relative
+            return Response(status_code=200, headers=headers)
+        return response
@@ -0,0 +1,163 @@
+import os
+import asyncio
+import threading
+import uuid
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Dict, List, Optional, Tuple
+from fastapi import UploadFile
+from fastapi.concurrency import run_in_threadpool
+from PIL import Image
+from utils.jobs import Job
+from utils.blob_store import blob_store
+from utils.content_hash import get_stat_index
+from utils.near_duplicates import dhash
+from utils.metrics import span
+
+# アップロードをディスクに書き出す際のチャンクサイズ
+CHUNK_SIZE = 1024 * 1024
+# 画像の取り込み (検証・ブロブへの登録・配置) を同時に実行する数
+INGEST_CONCURRENCY = int(os.environ.get("INGEST_CONCURRENCY", 4))
+
+_executor = ThreadPoolExecutor(max_workers=INGEST_CONCURRENCY, thread_name_prefix="ingest")
+
+# アップロードをコピーしながらコンテンツハッシュを計算する
+def _copy_upload(file: UploadFile, dest_path: str) -> str:
+    h = hashlib.sha256()
+    file.file.seek(0)
+    with span("file.stage_upload"), open(dest_path, "wb") as buffer:
+        for chunk in iter(lambda: file.file.read(CHUNK_SIZE), b""):
+            h.update(chunk)
+            buffer.write(chunk)
+    return h.hexdigest()
+
+# アップロードされたファイルをチャンク単位でステージングディレクトリに書き出す
+# 戻り値は (元のファイル名, ステージング先のパス, コンテンツハッシュ) のリスト
+async def stage_uploads(files: List[UploadFile], staging_dir: str) -> List[Tuple[str, str, str]]:
+    os.makedirs(staging_dir, exist_ok=True)
+    staged = []
+    for file in files:
+        staged_path = os.path.join(staging_dir, uuid.uuid4().hex)
+        digest = await run_in_threadpool(_copy_upload, file, staged_path)
+        staged.append((file.filename or "", staged_path, digest))
+    return staged
+
+# 検出した画像形式ごとの拡張子 (同じ内容の画像は .jpg / .jpeg などの違いに関わらず同じファイル名にする)
+IMAGE_EXTENSIONS = {
+    "JPEG": ".jpg",
+    "MPO": ".jpg",
+    "PNG": ".png",
+    "GIF": ".gif",
+    "WEBP": ".webp",
+    "BMP": ".bmp",
+    "TIFF": ".tif",
+}
+
+# PILを使って画像として検証し，画像形式を返す (画像でない場合は None)
+def verify_image(path: str) -> Optional[str]:
+    try:
+        with span("pil.verify"), Image.open(path) as img:
+            img.verify()
+            return img.format or ""
+    except (IOError, SyntaxError):
+        return None
+
+# 画像として検証し，画像形式と知覚ハッシュを返す (画像でない場合は None)
+def verify_and_hash(path: str) -> Optional[Tuple[str, int]]:
+    image_format = verify_image(path)
+    if image_format is None:
+        return None
+    try:
+        return image_format, dhash(path)
+    except (IOError, SyntaxError):
+        return None
+
+# ステージング済みのファイルを検証してブロブストアに登録し，imgs ディレクトリに配置する
+# 画像名はコンテンツハッシュから決まるため，同じ画像はブロブを共有し，
+# 同じプロジェクト内で重複する画像 (拡張子が違っても内容が同じもの) は追加しない
+# 1ファイル分の処理 (検証・ブロブの登録・配置) は同時実行数を制限したスレッドプールで行い，進捗はジョブに記録する
+# 途中で失敗した場合は配置済みのファイルと参照も削除し，何も追加しなかった状態に戻す
+# 戻り値は (追加した画像のパス, 重複排除の統計, 画像のパスごとの知覚ハッシュ)
+async def ingest_staged(job: Job, staged: List[Tuple[str, str, str]], imgs_dir: str, project_id: str) -> Tuple[List[str], Dict, Dict[str, int]]:
+    os.makedirs(imgs_dir, exist_ok=True)
+    image_paths: List[Optional[str]] = [None] * len(staged)
+    acquired: List[str] = []
+    stats = {"dedup_hits": 0, "duplicates_in_project": 0, "bytes_saved": 0}
+    hashes: Dict[str, int] = {}
+    # 重複の判定と結果の記録はワーカー間で排他する
+    lock = threading.Lock()
+    # プロジェクトに既にある画像のコンテンツハッシュ (以前の拡張子のままのファイルも含む)
+    existing = await run_in_threadpool(lambda: {os.path.splitext(name)[0] for name in os.listdir(imgs_dir)})
+
+    def process(index: int, filename: str, staged_path: str, digest: str):
+        verified = verify_and_hash(staged_path)
+        if verified is None:
+            # 画像でない場合はスキップ
+            print(f"Skipped non-image file: {filename}")
+            os.remove(staged_path)
+            job.advance(failed=True)
+            return
+        image_format, phash = verified
+
+        # コンテンツハッシュと画像形式からファイル名を生成
+        file_extension = IMAGE_EXTENSIONS.get(image_format, os.path.splitext(filename)[1].lower())
+        full_file_path = os.path.join(imgs_dir, f"{digest}{file_extension}")
+        size = os.path.getsize(staged_path)
+
+        with lock:
+            if blob_store.acquire(digest, project_id):
+                acquired.append(digest)
+            duplicate = digest in existing or os.path.exists(full_file_path)
+            if duplicate:
+                # 同じプロジェクトに同じ画像が既にある
+                stats["duplicates_in_project"] += 1
+                stats["dedup_hits"] += 1
+                stats["bytes_saved"] += size
+            else:
+                existing.add(digest)
+                image_paths[index] = full_file_path
+                hashes[full_file_path] = phash
+        if duplicate:
+            os.remove(staged_path)
+            job.advance()
+            return
+
+        if not blob_store.put(digest, staged_path):
+            with lock:
+                stats["dedup_hits"] += 1
+                stats["bytes_saved"] += size
+        blob_store.link(digest, full_file_path)
+        os.remove(staged_path)
+        # エクスポート時にハッシュを計算し直さなくて済むよう索引に登録しておく
+        get_stat_index().store(os.path.abspath(full_file_path), os.stat(full_file_path), digest)
+        job.advance()
+
+    # 失敗や取り消しの場合は，実行中の処理が終わるのを待ってから配置済みのファイルと参照を削除する
+    def rollback(futures):
+        for future in futures:
+            future.cancel()
+        wait(futures)
+        for path in image_paths:
+            if path is not None and os.path.exists(path):
+                os.remove(path)
+        for digest in acquired:
+            blob_store.release(digest, project_id)
+
+    def remove_staged():
+        for _, staged_path, _ in staged:
+            if os.path.exists(staged_path):
+                os.remove(staged_path)
+
+    futures = [_executor.submit(process, i, filename, path, digest) for i, (filename, path, digest) in enumerate(staged)]
+    try:
+        results = await asyncio.gather(*(asyncio.wrap_future(future) for future in futures), return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+    except BaseException:
+        await run_in_threadpool(rollback, futures)
+        raise
+    finally:
+        await run_in_threadpool(remove_staged)
+
+    return [path for path in image_paths if path is not None], stats, hashes
@@ -0,0 +1,236 @@
+import os
+import json
+import time
+import uuid
+import socket
+import asyncio
+import sqlite3
+import threading
+from typing import Any, Coroutine, Dict, List, Optional
+from utils.content_hash import CACHE_ROOT
+
+# ジョブごとに保持するエラー内容の件数
+MAX_ERRORS = 20
+# 進捗をデータベースに書き込む間隔 (秒)
+JOB_PERSIST_INTERVAL = float(os.environ.get("JOB_PERSIST_INTERVAL", 0.5))
+# 終了したジョブの情報を保持する期間 (秒)
+JOB_RETENTION = float(os.environ.get("JOB_RETENTION", 7 * 24 * 3600))
+# ワーカーの終了時に実行中のジョブを待つ時間 (秒，gunicorn の graceful_timeout より短くする)
+JOB_SHUTDOWN_TIMEOUT = float(os.environ.get("JOB_SHUTDOWN_TIMEOUT", 20))
+
+# ジョブを実行しているプロセスの識別子 (ホスト名とプロセスID)
+def _owner() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+# 同じホストのプロセスであれば，まだ動いているかを確認する
+def _owner_alive(owner: Optional[str]) -> bool:
+    if not owner:
+        return True
+    host, _, pid = owner.rpartition(":")
+    if host != socket.gethostname():
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, ValueError):
+        return True
+    return True
+
+# バックグラウンド処理の進捗を保持するジョブ
+class Job:
+    def __init__(self, kind: str, total: int = 0, **params):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.status = "pending"
+        self.total = total
+        self.processed = 0
+        self.failed = 0
+        self.params = params
+        self.result: Optional[Any] = None
+        self.error: Optional[str] = None
+        self.errors: List[str] = []
+        self.owner = _owner()
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.updated_at = self.created_at
+        self._lock = threading.Lock()
+        self._registry: Optional["JobRegistry"] = None
+        self._persisted_at = 0.0
+
+    # 処理済み件数を進める (failed=True の場合は失敗件数も数え，エラー内容は直近のものだけ保持する)
+    def advance(self, failed: bool = False, error: Optional[str] = None):
+        with self._lock:
+            self.processed += 1
+            if failed:
+                self.failed += 1
+            if error is not None:
+                self.errors = (self.errors + [error])[-MAX_ERRORS:]
+            self.updated_at = time.time()
+        self.persist()
+
+    # 他のワーカーからも参照できるよう，ジョブの状態をデータベースに書き込む
+    # force=False の場合は JOB_PERSIST_INTERVAL 秒に1回だけ書き込む
+    def persist(self, force: bool = False):
+        if self._registry is None:
+            return
+        now = time.time()
+        if not force and now - self._persisted_at < JOB_PERSIST_INTERVAL:
+            return
+        self._persisted_at = now
+        self._registry.save(self)
+
+    def to_dict(self) -> Dict:
+        with self._lock:
+            end = time.time() if self.status == "running" else self.updated_at
+            elapsed = end - self.started_at if self.started_at else 0.0
+            return {
+                "job_id": self.id,
+                "kind": self.kind,
+                "status": self.status,
+                "total": self.total,
+                "processed": self.processed,
+                "failed": self.failed,
+                "progress": self.processed / self.total if self.total else 1.0,
+                "params": self.params,
+                "result": self.result,
+                "error": self.error,
+                "errors": list(self.errors),
+                "elapsed": elapsed,
+                "throughput": self.processed / elapsed if elapsed > 0 else 0.0,
+                "owner": self.owner,
+                "created_at": self.created_at,
+                "started_at": self.started_at,
+                "updated_at": self.updated_at,
+            }
+
+    # データベースに保存された状態からジョブを復元する (別のワーカーで実行中のジョブの参照用)
+    @classmethod
+    def from_dict(cls, data: Dict) -> "Job":
+        job = cls(data["kind"], data["total"], **data["params"])
+        job.id = data["job_id"]
+        for name in ("status", "processed", "failed", "result", "error", "errors", "owner", "created_at", "started_at", "updated_at"):
+            setattr(job, name, data.get(name))
+        # 実行していたプロセスが終了している場合は中断扱いにする
+        if job.status in ("pending", "running") and not _owner_alive(job.owner):
+            job.status = "interrupted"
+        return job
+
+# ジョブの登録と実行を管理する
+# 実行中のジョブは各ワーカーのメモリ上で管理し，状態はデータベースを通して全ワーカーで共有する
+class JobRegistry:
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._jobs: Dict[str, Job] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA busy_timeout=5000")
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    data TEXT NOT NULL,
+                    updated_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS jobs_updated_at ON jobs (updated_at);
+            """)
+        return self._conn
+
+    def save(self, job: Job):
+        data = job.to_dict()
+        with self._db_lock:
+            self._connection().execute(
+                "INSERT OR REPLACE INTO jobs (id, kind, status, data, updated_at) VALUES (?, ?, ?, ?, ?)",
+                (job.id, job.kind, data["status"], json.dumps(data, ensure_ascii=False, default=str), data["updated_at"]),
+            )
+
+    # 保持期間を過ぎた終了済みのジョブを削除する (このワーカーのメモリ上のものも含む)
+    def _purge(self):
+        expire = time.time() - JOB_RETENTION
+        with self._lock:
+            for job_id in [job.id for job in self._jobs.values() if job.updated_at < expire and job.status not in ("pending", "running")]:
+                del self._jobs[job_id]
+        with self._db_lock:
+            self._connection().execute(
+                "DELETE FROM jobs WHERE updated_at < ? AND status NOT IN ('pending', 'running')",
+                (expire,),
+            )
+
+    def create(self, kind: str, total: int = 0, **params) -> Job:
+        job = Job(kind, total, **params)
+        job._registry = self
+        with self._lock:
+            self._jobs[job.id] = job
+        self._purge()
+        job.persist(force=True)
+        return job
+
+    # このワーカーで作成したジョブはメモリ上のものを，それ以外はデータベースの内容を返す
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is not None:
+            return job
+        with self._db_lock:
+            row = self._connection().execute("SELECT data FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        return Job.from_dict(json.loads(row[0]))
+
+    # ジョブを実行して結果を返す (失敗した場合は状態を記録して例外を送出する)
+    async def run(self, job: Job, coro: Coroutine) -> Any:
+        job.status = "running"
+        job.started_at = time.time()
+        job.persist(force=True)
+        try:
+            result = await coro
+        except BaseException as e:
+            job.status = "interrupted" if isinstance(e, asyncio.CancelledError) else "failed"
+            job.error = str(e) or e.__class__.__name__
+            job.updated_at = time.time()
+            job.persist(force=True)
+            raise
+        job.status = "completed"
+        job.result = result
+        job.updated_at = time.time()
+        job.persist(force=True)
+        return result
+
+    # ジョブをバックグラウンドで実行する
+    def start(self, job: Job, coro: Coroutine) -> asyncio.Task:
+        async def runner():
+            try:
+                await self.run(job, coro)
+            except Exception:
+                pass
+            finally:
+                with self._lock:
+                    self._tasks.pop(job.id, None)
+
+        task = asyncio.get_running_loop().create_task(runner())
+        with self._lock:
+            self._tasks[job.id] = task
+        return task
+
+    # ワーカーの終了時に呼ぶ
+    # 実行中のジョブを timeout 秒まで待ち，終わらなかったものは取り消して中断として記録する
+    async def shutdown(self, timeout: float = JOB_SHUTDOWN_TIMEOUT):
+        with self._lock:
+            tasks = list(self._tasks.values())
+        if not tasks:
+            return
+        _, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+jobs = JobRegistry(os.path.join(CACHE_ROOT, "jobs.db"))
@@ -0,0 +1,144 @@
+import os
+import json
+import time
+import socket
+import threading
+from contextlib import contextmanager
+from typing import Dict, List, Tuple
+from utils.content_hash import CACHE_ROOT, write_cache_file
+
+# ヒストグラムのバケット (秒)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# 各ワーカーの計測値をファイルに書き出す間隔 (秒)
+METRICS_FLUSH_INTERVAL = float(os.environ.get("METRICS_FLUSH_INTERVAL", 1.0))
+# 更新されなくなったワーカーの計測値を集計に含める期間 (秒)
+METRICS_RETENTION = float(os.environ.get("METRICS_RETENTION", 24 * 3600))
+
+METRIC_HELP = {
+    "http_request_duration_seconds": "HTTP request latency by route",
+    "span_duration_seconds": "Duration of internal operations (file I/O, JSON, PIL, base64, OpenAI calls)",
+}
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+# ルートごとのレイテンシと内部処理の所要時間をヒストグラムで保持する
+# 各ワーカーは自分の計測値を {dir}/{host}-{pid}.json に書き出し，/metrics では全ワーカーの値を合算して返す
+class MetricsRegistry:
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._histograms: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], Histogram] = {}
+        self._flushed_at = 0.0
+        self._flush_lock = threading.Lock()
+
+    def observe(self, metric: str, value: float, **labels):
+        key = (metric, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def observe_request(self, method: str, route: str, status: int, seconds: float):
+        self.observe("http_request_duration_seconds", seconds, method=method, route=route, status=str(status))
+
+    # with span("json.dump"): ... の形で処理の所要時間を記録する
+    @contextmanager
+    def span(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe("span_duration_seconds", time.perf_counter() - start, span=name)
+
+    def snapshot(self) -> List[Dict]:
+        with self._lock:
+            return [{
+                "metric": metric,
+                "labels": dict(labels),
+                "buckets": list(histogram.buckets),
+                "counts": list(histogram.counts),
+                "sum": histogram.sum,
+                "count": histogram.count,
+            } for (metric, labels), histogram in self._histograms.items()]
+
+    def _path(self) -> str:
+        return os.path.join(self.directory, f"{socket.gethostname()}-{os.getpid()}.json")
+
+    # 計測値をファイルに書き出す (force=False の場合は METRICS_FLUSH_INTERVAL 秒に1回だけ)
+    def flush(self, force: bool = False):
+        now = time.time()
+        if not force and now - self._flushed_at < METRICS_FLUSH_INTERVAL:
+            return
+        if not self._flush_lock.acquire(blocking=force):
+            return
+        try:
+            self._flushed_at = now
+            write_cache_file(self._path(), json.dumps(self.snapshot()))
+        finally:
+            self._flush_lock.release()
+
+    # 全ワーカーの計測値を合算する
+    def collect(self) -> List[Dict]:
+        self.flush(force=True)
+        merged: Dict[Tuple[str, Tuple], Dict] = {}
+        cutoff = time.time() - METRICS_RETENTION
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if not name.endswith(".json") or os.stat(path).st_mtime < cutoff:
+                    continue
+                with open(path, "r", encoding="utf-8") as f:
+                    entries = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError):
+                continue
+            for entry in entries:
+                key = (entry["metric"], tuple(sorted(entry["labels"].items())))
+                total = merged.get(key)
+                if total is None:
+                    merged[key] = dict(entry, counts=list(entry["counts"]))
+                    continue
+                total["counts"] = [a + b for a, b in zip(total["counts"], entry["counts"])]
+                total["sum"] += entry["sum"]
+                total["count"] += entry["count"]
+        return [merged[key] for key in sorted(merged)]
+
+    # Prometheus のテキスト形式で出力する
+    def render(self) -> str:
+        lines = []
+        current = None
+        for entry in self.collect():
+            metric = entry["metric"]
+            if metric != current:
+                current = metric
+                lines.append(f"# HELP {metric} {METRIC_HELP.get(metric, metric)}")
+                lines.append(f"# TYPE {metric} histogram")
+            labels = ",".join(f'{k}="{_escape(v)}"' for k, v in sorted(entry["labels"].items()))
+            prefix = f"{labels}," if labels else ""
+            cumulative = 0
+            for bound, count in zip(entry["buckets"], entry["counts"]):
+                cumulative += count
+                lines.append(f'{metric}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+            lines.append(f'{metric}_bucket{{{prefix}le="+Inf"}} {entry["count"]}')
+            lines.append(f"{metric}_sum{{{labels}}} {entry['sum']}")
+            lines.append(f"{metric}_count{{{labels}}} {entry['count']}")
+        return "\n".join(lines) + "\n"
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+metrics = MetricsRegistry(os.path.join(CACHE_ROOT, "metrics"))
+span = metrics.span
@@ -0,0 +1,140 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+import numpy as np
+from PIL import Image
+from utils.annotation_store import get_store
+from utils.metrics import span
+
+# 知覚ハッシュ (dHash) の一辺の大きさ (HASH_SIZE x HASH_SIZE = 64ビット)
+HASH_SIZE = 8
+HASH_BITS = HASH_SIZE * HASH_SIZE
+# ハミング距離がこの値以下の画像を「ほぼ同じ画像」とみなす
+NEAR_DUPLICATE_THRESHOLD = int(os.environ.get("NEAR_DUPLICATE_THRESHOLD", 6))
+# threshold の上限 (区間が細かくなるほど値が一致する候補が増え，比較が全組み合わせに近づくため)
+MAX_NEAR_DUPLICATE_THRESHOLD = 8
+# 比較を行列でまとめて行う際の1ブロックの行数 (メモリ使用量を抑える)
+COMPARE_CHUNK = 1024
+
+_executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 4, thread_name_prefix="phash")
+
+# 画像の dHash を計算する
+# 縮小したグレースケール画像で隣り合う画素の明暗を比べ，64ビットの値にする
+# SQLite の INTEGER に収まるよう，符号付き64ビット整数として返す
+def dhash(path: str) -> int:
+    with span("pil.dhash"), Image.open(path) as img:
+        # JPEG は縮小した状態でデコードして読み込みを速くする
+        img.draft("L", (HASH_SIZE * 4, HASH_SIZE * 4))
+        small = img.convert("L").resize((HASH_SIZE + 1, HASH_SIZE), Image.Resampling.BILINEAR)
+        pixels = np.asarray(small, dtype=np.int16)
+    bits = pixels[:, 1:] > pixels[:, :-1]
+    value = int.from_bytes(np.packbits(bits).tobytes(), "big")
+    return value - (1 << HASH_BITS) if value >= 1 << (HASH_BITS - 1) else value
+
+# ハミング距離が threshold 以下の画像を Union-Find でつなぎ，各画像の属するグループの代表 (最も前の添字) を返す
+# threshold + 1 個のビット区間に分けると，距離が threshold 以下の組は少なくとも1つの区間が完全に一致する (鳩の巣原理)
+# 区間の値が同じ候補の中では，各ハッシュをそれまでのグループの代表とだけ比べる
+# 連写のように似た画像が多くても，比較の回数はグループの数に比例し，組の一覧も作らない
+def find_similar_groups(hashes: np.ndarray, threshold: int) -> np.ndarray:
+    hashes = np.asarray(hashes, dtype=np.int64).view(np.uint64)
+    parent = list(range(len(hashes)))
+
+    def find(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def union(a: int, b: int) -> None:
+        ra, rb = find(a), find(b)
+        if ra != rb:
+            parent[max(ra, rb)] = min(ra, rb)
+
+    # 同じハッシュ値の画像は先にまとめ，以降は値ごとに1回だけ比較する
+    values, first, inverse = np.unique(hashes, return_index=True, return_inverse=True)
+    for i, value_index in enumerate(inverse.ravel().tolist()):
+        union(int(first[value_index]), i)
+
+    blocks = min(threshold + 1, HASH_BITS)
+    bounds = [HASH_BITS * k // blocks for k in range(blocks + 1)]
+    for low, high in zip(bounds, bounds[1:]):
+        keys = (values >> np.uint64(low)) & np.uint64((1 << (high - low)) - 1)
+        order = np.argsort(keys, kind="stable")
+        starts = np.flatnonzero(np.r_[True, keys[order][1:] != keys[order][:-1], True])
+        for start, end in zip(starts[:-1], starts[1:]):
+            if end - start < 2:
+                continue
+            bucket = values[order[start:end]]
+            ids = first[order[start:end]]
+            leaders = np.empty(0, dtype=np.uint64)
+            leader_ids = np.empty(0, dtype=np.int64)
+            for row in range(0, len(bucket), COMPARE_CHUNK):
+                chunk, chunk_ids = bucket[row:row + COMPARE_CHUNK], ids[row:row + COMPARE_CHUNK]
+                matched = np.zeros(len(chunk), dtype=bool)
+                for col in range(0, len(leaders), COMPARE_CHUNK):
+                    i, k = np.nonzero(np.bitwise_count(chunk[:, None] ^ leaders[None, col:col + COMPARE_CHUNK]) <= threshold)
+                    matched[i] = True
+                    for a, b in zip(chunk_ids[i].tolist(), leader_ids[col + k].tolist()):
+                        union(a, b)
+                # どの代表とも近くない画像は，チャンク内で先に代表になった画像とも近くなければ新しい代表にする
+                near = np.bitwise_count(chunk[:, None] ^ chunk[None, :]) <= threshold
+                covered = matched.copy()
+                new: List[int] = []
+                for u in np.flatnonzero(~matched).tolist():
+                    if not covered[u]:
+                        new.append(u)
+                        covered |= near[u]
+                if not new:
+                    continue
+                # チャンク内の各画像を，自分より前に代表になった画像とつなぐ
+                new_index = np.array(new)
+                i, k = np.nonzero(near[:, new_index] & (new_index[None, :] < np.arange(len(chunk))[:, None]))
+                for a, b in zip(chunk_ids[i].tolist(), chunk_ids[new_index[k]].tolist()):
+                    union(a, b)
+                leaders = np.concatenate([leaders, chunk[new_index]])
+                leader_ids = np.concatenate([leader_ids, chunk_ids[new_index]])
+    return np.array([find(i) for i in range(len(hashes))], dtype=np.int64)
+
+# ハッシュが未計算のレコード (この機能より前に取り込んだ画像など) を計算してストアに保存する
+def ensure_hashes(pid: str) -> List[Tuple[str, Optional[int]]]:
+    store = get_store(pid)
+    hashes = store.hashes()
+    missing = [image for image, value in hashes if value is None]
+    if not missing:
+        return hashes
+    imgs_dir = os.path.join("datas", f"{pid}", "imgs")
+
+    def compute(image: str) -> Optional[int]:
+        try:
+            return dhash(os.path.join(imgs_dir, image))
+        except (OSError, SyntaxError):
+            return None
+
+    computed = [(image, value) for image, value in zip(missing, _executor.map(compute, missing)) if value is not None]
+    store.set_hashes(computed)
+    return store.hashes()
+
+# ほぼ同じ画像のグループを返す (各グループは登録順の画像名のリストで，先頭を代表とする)
+# images を指定した場合はその画像の中だけで比較する
+def near_duplicate_groups(pid: str, threshold: int = NEAR_DUPLICATE_THRESHOLD,
+                          images: Optional[Iterable[str]] = None) -> List[List[str]]:
+    hashes = ensure_hashes(pid)
+    if images is not None:
+        selected = set(images)
+        hashes = [(image, value) for image, value in hashes if image in selected]
+    hashes = [(image, value) for image, value in hashes if value is not None]
+    if len(hashes) < 2:
+        return []
+
+    with span("phash.compare"):
+        roots = find_similar_groups(np.array([value for _, value in hashes], dtype=np.int64),
+                                    min(threshold, MAX_NEAR_DUPLICATE_THRESHOLD))
+
+    groups: Dict[int, List[str]] = {}
+    for i, (image, _) in enumerate(hashes):
+        groups.setdefault(int(roots[i]), []).append(image)
+    return [members for _, members in sorted(groups.items()) if len(members) > 1]
+
+# エクスポートから除く画像 (各グループの代表以外)
+def duplicate_images(pid: str, images: Iterable[str], threshold: int = NEAR_DUPLICATE_THRESHOLD) -> Set[str]:
+    return {image for members in near_duplicate_groups(pid, threshold, images) for image in members[1:]}
@@ -0,0 +1,69 @@
+import os
+import time
+import pstats
+import random
+import cProfile
+import threading
+from typing import Optional
+from fastapi import Request
+from utils.content_hash import CACHE_ROOT
+
+# リクエスト単位のプロファイリング (既定では無効)
+# PROFILE_SAMPLE_RATE: プロファイルを取るリクエストの割合 (0.0〜1.0)
+# PROFILE_ALLOW_HEADER=1 の場合は X-Profile: 1 ヘッダの付いたリクエストも対象にする
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", 0))
+PROFILE_ALLOW_HEADER = os.environ.get("PROFILE_ALLOW_HEADER", "0") == "1"
+PROFILE_DIR = os.path.join(CACHE_ROOT, "profiles")
+# 保持するプロファイルの件数 (古いものから削除する)
+PROFILE_MAX_FILES = int(os.environ.get("PROFILE_MAX_FILES", 100))
+
+# cProfile は同時に1つしか有効にできないため，プロファイル中の別のリクエストは対象外にする
+_active = threading.Lock()
+
+def should_profile(request: Request) -> bool:
+    if PROFILE_ALLOW_HEADER and request.headers.get("x-profile") == "1":
+        return True
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+# イベントループのスレッドで実行された処理を記録する
+# 非同期処理の待ち時間中に実行された他のリクエストの処理も含まれる点に注意
+class RequestProfiler:
+    def __init__(self):
+        self._profile = cProfile.Profile()
+
+    @classmethod
+    def start(cls, request: Request) -> Optional["RequestProfiler"]:
+        if not should_profile(request) or not _active.acquire(blocking=False):
+            return None
+        profiler = cls()
+        try:
+            profiler._profile.enable()
+        except ValueError:
+            # 他のプロファイラが有効になっている
+            _active.release()
+            return None
+        return profiler
+
+    # プロファイルを止めて PROFILE_DIR に .prof 形式で保存し，ファイル名を返す
+    def stop(self, method: str, route: str) -> str:
+        try:
+            self._profile.disable()
+        finally:
+            _active.release()
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        slug = route.strip("/").replace("/", "_").replace("{", "").replace("}", "") or "root"
+        filename = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{method}-{slug}.prof"
+        pstats.Stats(self._profile).dump_stats(os.path.join(PROFILE_DIR, filename))
+        _prune()
+        return filename
+
+def _prune():
+    files = sorted(
+        (entry for entry in os.scandir(PROFILE_DIR) if entry.name.endswith(".prof")),
+        key=lambda entry: entry.stat().st_mtime,
+    )
+    for entry in files[:max(0, len(files) - PROFILE_MAX_FILES)]:
+        try:
+            os.remove(entry.path)
+        except FileNotFoundError:
+            pass
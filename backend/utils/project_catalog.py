@@ -0,0 +1,167 @@
+import os
+import json
+import threading
+from urllib.parse import quote
+from typing import Dict, List, Optional, Pattern, Set
+
+IMAGE_EXTENSIONS = ('png', 'jpg', 'jpeg', 'gif')
+
+# プロジェクト一覧のインメモリカタログ
+# 起動時に一度だけ datas ディレクトリを走査し，以降は各エンドポイントからの通知で更新する
+# 外部からの変更 (別のワーカーによる変更を含む) は datas ディレクトリと project_info.json の更新時刻で検出する
+class ProjectCatalog:
+    def __init__(self, datas_dir: str = "./datas"):
+        self.datas_dir = datas_dir
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Dict] = {}
+        # ディレクトリはあるが project_info.json がまだ無いプロジェクト (作成中)
+        # project_info.json が書き込まれても datas ディレクトリの更新時刻は変わらないため，毎回確認する
+        self._pending: Set[str] = set()
+        self._dir_mtime_ns: Optional[int] = None
+
+    @property
+    def root(self) -> str:
+        return os.path.abspath(self.datas_dir)
+
+    # 最初の画像ファイルを取得 (一覧全体は読まずに最初に見つかった画像で止める)
+    @staticmethod
+    def _first_image(imgs_dir: str) -> Optional[str]:
+        if not os.path.exists(imgs_dir):
+            return None
+        with os.scandir(imgs_dir) as it:
+            for entry in it:
+                if entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                    return os.path.join(imgs_dir, entry.name)
+        return None
+
+    # プロジェクト1件分の情報を読み込む (project_info.json が無い場合は None)
+    def _load(self, project_id: str) -> Optional[Dict]:
+        project_root = os.path.join(self.root, project_id)
+        project_info_path = os.path.join(project_root, "project_info.json")
+        try:
+            mtime_ns = os.stat(project_info_path).st_mtime_ns
+            with open(project_info_path, "r", encoding="utf-8") as f:
+                info = json.load(f)
+        except (FileNotFoundError, NotADirectoryError, json.JSONDecodeError):
+            return None
+        return {
+            "info": info,
+            "mtime_ns": mtime_ns,
+            "first_image": self._first_image(os.path.join(project_root, "imgs")),
+            "dir_path": os.path.abspath(project_root),
+        }
+
+    # datas ディレクトリを走査してカタログを作り直す
+    def build(self):
+        entries = {}
+        pending = set()
+        dir_mtime_ns = None
+        if os.path.exists(self.root):
+            dir_mtime_ns = os.stat(self.root).st_mtime_ns
+            for project_id in os.listdir(self.root):
+                entry = self._load(project_id)
+                if entry is not None:
+                    entries[project_id] = entry
+                elif self._is_project_dir(project_id):
+                    pending.add(project_id)
+        with self._lock:
+            self._entries = entries
+            self._pending = pending
+            self._dir_mtime_ns = dir_mtime_ns
+
+    # プロジェクトのディレクトリになり得るか (.blobs などの内部用ディレクトリは除く)
+    def _is_project_dir(self, name: str) -> bool:
+        return not name.startswith(".") and os.path.isdir(os.path.join(self.root, name))
+
+    # 更新時刻を確認し，変更のあったプロジェクトだけを読み直す
+    def refresh(self):
+        if not os.path.exists(self.root):
+            with self._lock:
+                self._entries = {}
+                self._pending = set()
+                self._dir_mtime_ns = None
+            return
+
+        dir_mtime_ns = os.stat(self.root).st_mtime_ns
+        with self._lock:
+            dir_changed = dir_mtime_ns != self._dir_mtime_ns
+            known = dict(self._entries)
+            pending = set(self._pending)
+
+        project_ids = os.listdir(self.root) if dir_changed else list(known) + list(pending)
+        entries = {}
+        pending = set()
+        for project_id in project_ids:
+            entry = known.get(project_id)
+            project_info_path = os.path.join(self.root, project_id, "project_info.json")
+            try:
+                mtime_ns = os.stat(project_info_path).st_mtime_ns
+            except (FileNotFoundError, NotADirectoryError):
+                if self._is_project_dir(project_id):
+                    pending.add(project_id)
+                continue
+            if entry is None or entry["mtime_ns"] != mtime_ns:
+                entry = self._load(project_id)
+            if entry is not None:
+                entries[project_id] = entry
+
+        with self._lock:
+            self._entries = entries
+            self._pending = pending
+            self._dir_mtime_ns = dir_mtime_ns
+
+    # 作成・画像追加などの後に1件だけ読み直す
+    def update(self, project_id: str):
+        entry = self._load(project_id)
+        with self._lock:
+            if entry is None:
+                self._entries.pop(project_id, None)
+            else:
+                self._entries[project_id] = entry
+
+    def remove(self, project_id: str):
+        with self._lock:
+            self._entries.pop(project_id, None)
+
+    def entries(self) -> List[Dict]:
+        self.refresh()
+        with self._lock:
+            return list(self._entries.values())
+
+    # 最初の画像のサムネイルURL
+    @staticmethod
+    def _thumbnail_url(entry: Dict) -> Optional[str]:
+        if entry["first_image"] is None:
+            return None
+        return f"/projects/thumbnail/{quote(entry['info']['id'])}/{quote(os.path.basename(entry['first_image']))}"
+
+    # プロジェクト一覧のサマリー情報
+    def summaries(self) -> List[Dict]:
+        return [{
+            "id": entry["info"]["id"],
+            "name": entry["info"]["name"],
+            "created_at": entry["info"]["created_at"],
+            "first_image": entry["first_image"],
+            "thumbnail": self._thumbnail_url(entry),
+            "dir_path": entry["dir_path"]
+        } for entry in self.entries()]
+
+    # name または description に正規表現が一致するプロジェクト
+    def search(self, pattern: Pattern) -> List[Dict]:
+        matched_projects = []
+        for entry in self.entries():
+            info = entry["info"]
+            if pattern.search(info.get("name", "")) or pattern.search(info.get("description", "")):
+                matched_projects.append({
+                    "id": info["id"],
+                    "name": info["name"],
+                    "created_at": info["created_at"],
+                    "description": info["description"],
+                    "image_count": info.get("image_count", 0),
+                    "first_image": entry["first_image"],
+                    "thumbnail": self._thumbnail_url(entry),
+                    "dir_path": info["dir_path"]
+                })
+        return matched_projects
+
+catalog = ProjectCatalog()
@@ -0,0 +1,223 @@
+import os
+import json
+import time
+import asyncio
+import threading
+from datetime import datetime
+from typing import Dict, List, Optional
+from fastapi.concurrency import run_in_threadpool
+from utils.blob_store import blob_store
+from utils.fileio import file_lock, write_json_atomic
+
+# 削除したプロジェクトを置くディレクトリ (datas 直下の "." で始まるディレクトリはプロジェクト一覧に含まれない)
+TRASH_ROOT = os.path.join("datas", ".trash")
+# 削除を取り消せる期間 (秒)。この期間を過ぎるとバックグラウンドでディスクを解放する
+TRASH_UNDO_WINDOW = float(os.environ.get("TRASH_UNDO_WINDOW", 3600))
+# ディスクを解放する速さの上限 (1秒あたりに削除するファイル数)
+TRASH_RECLAIM_RATE = int(os.environ.get("TRASH_RECLAIM_RATE", 2000))
+# 解放の対象を探す間隔 (秒)
+TRASH_SCAN_INTERVAL = float(os.environ.get("TRASH_SCAN_INTERVAL", 60))
+
+def _trash_dir(pid: str) -> str:
+    return os.path.join(TRASH_ROOT, pid)
+
+def _meta_path(pid: str) -> str:
+    return os.path.join(TRASH_ROOT, f"{pid}.json")
+
+def _lock_path(pid: str) -> str:
+    return os.path.join(TRASH_ROOT, f"{pid}.lock")
+
+def _load(pid: str) -> Optional[Dict]:
+    try:
+        with open(_meta_path(pid), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+# エントリが無くなったプロジェクトのロックファイルを削除する (ロックを解放してから呼ぶ)
+# ロックを持ったまま削除すると，待っていた別のワーカーは削除されたファイルのロックを取り，
+# 新しく作られたファイルのロックを取ったワーカーと同時に処理を進めてしまう
+def _remove_lock(pid: str):
+    if os.path.exists(_meta_path(pid)):
+        return
+    try:
+        os.remove(_lock_path(pid))
+    except FileNotFoundError:
+        pass
+
+def _expired(entry: Dict, now: float) -> bool:
+    return entry.get("purge", False) or now >= entry["deleted_at"] + TRASH_UNDO_WINDOW
+
+# ゴミ箱のエントリの状態
+# state は trashed (取り消し可能) / expired (解放待ち) / reclaiming (解放中)
+def _status(entry: Dict) -> Dict:
+    now = time.time()
+    state = entry["state"]
+    if state == "trashed" and _expired(entry, now):
+        state = "expired"
+    return {
+        "project_id": entry["project_id"],
+        "name": entry.get("name", ""),
+        "state": state,
+        "deleted_at": datetime.fromtimestamp(entry["deleted_at"]).isoformat(),
+        "restorable_until": datetime.fromtimestamp(entry["deleted_at"] + TRASH_UNDO_WINDOW).isoformat(),
+        "restorable": state == "trashed",
+        "reclaimed_files": entry.get("reclaimed_files", 0),
+    }
+
+# プロジェクトをゴミ箱に移す (プロジェクトのロックを取った状態で呼ぶ)
+# 先にエントリの情報を書いてから1回の rename で移すため，途中でクラッシュしても半端なプロジェクトは一覧に残らない
+def move_to_trash(pid: str) -> Dict:
+    project_root = os.path.join("datas", f"{pid}")
+    os.makedirs(TRASH_ROOT, exist_ok=True)
+    try:
+        with open(os.path.join(project_root, "project_info.json"), "r", encoding="utf-8") as f:
+            name = json.load(f).get("name", "")
+    except (FileNotFoundError, json.JSONDecodeError):
+        name = ""
+    entry = {"project_id": pid, "name": name, "deleted_at": time.time(), "state": "trashed"}
+    write_json_atomic(_meta_path(pid), entry)
+    try:
+        os.rename(project_root, _trash_dir(pid))
+    except BaseException:
+        os.remove(_meta_path(pid))
+        raise
+    return _status(entry)
+
+def trash_status(pid: str) -> Optional[Dict]:
+    entry = _load(pid)
+    return _status(entry) if entry is not None else None
+
+def trash_entries() -> List[Dict]:
+    if not os.path.exists(TRASH_ROOT):
+        return []
+    entries = [_load(name[:-len(".json")]) for name in os.listdir(TRASH_ROOT) if name.endswith(".json")]
+    return sorted((_status(entry) for entry in entries if entry is not None), key=lambda entry: entry["deleted_at"], reverse=True)
+
+# ゴミ箱からプロジェクトを元に戻す
+# 解放中の場合は BlockingIOError，取り消せる期間を過ぎた場合は ValueError を送出する
+def restore(pid: str) -> Dict:
+    with file_lock(_lock_path(pid), blocking=False):
+        entry = _load(pid)
+        if entry is None or not os.path.exists(_trash_dir(pid)):
+            raise FileNotFoundError(f"Project '{pid}' is not in the trash")
+        if entry["state"] != "trashed" or _expired(entry, time.time()):
+            raise ValueError(f"Project '{pid}' can no longer be restored")
+        os.rename(_trash_dir(pid), os.path.join("datas", f"{pid}"))
+        os.remove(_meta_path(pid))
+    _remove_lock(pid)
+    return entry
+
+# 取り消せる期間を待たずに解放の対象にする
+def purge(pid: str) -> Dict:
+    with file_lock(_lock_path(pid)):
+        entry = _load(pid)
+        if entry is None:
+            raise FileNotFoundError(f"Project '{pid}' is not in the trash")
+        entry["purge"] = True
+        write_json_atomic(_meta_path(pid), entry)
+    return _status(entry)
+
+# ゴミ箱のプロジェクト1件を削除する
+# 1秒あたり TRASH_RECLAIM_RATE ファイルまでに抑えながら削除し，最後にブロブへの参照を解除する
+# stop がセットされた場合は途中で止め，次回はその続きから削除する
+def _reclaim(pid: str, stop: threading.Event) -> bool:
+    try:
+        with file_lock(_lock_path(pid), blocking=False):
+            entry = _load(pid)
+            if entry is None:
+                return False
+            trash_dir = _trash_dir(pid)
+            if not os.path.exists(trash_dir) and os.path.exists(os.path.join("datas", f"{pid}")):
+                # ゴミ箱に移す前にクラッシュした場合はプロジェクトが元の場所に残っている
+                os.remove(_meta_path(pid))
+                return False
+            if entry["state"] == "trashed":
+                if not _expired(entry, time.time()):
+                    return False
+                # ここから先は元に戻せない
+                entry["state"] = "reclaiming"
+                write_json_atomic(_meta_path(pid), entry)
+
+            batch = max(1, TRASH_RECLAIM_RATE // 10)
+            started = time.monotonic()
+            removed = 0
+            for root, dirs, files in os.walk(trash_dir, topdown=False):
+                for name in files:
+                    os.remove(os.path.join(root, name))
+                    removed += 1
+                    if removed % batch == 0:
+                        entry["reclaimed_files"] = entry.get("reclaimed_files", 0) + batch
+                        write_json_atomic(_meta_path(pid), entry)
+                        if stop.is_set():
+                            return False
+                        # 速度の上限を超えないように待つ
+                        time.sleep(max(0.0, removed / TRASH_RECLAIM_RATE - (time.monotonic() - started)))
+                for name in dirs:
+                    os.rmdir(os.path.join(root, name))
+            if os.path.exists(trash_dir):
+                os.rmdir(trash_dir)
+            # 最後のバッチに満たない分も数える
+            entry["reclaimed_files"] = entry.get("reclaimed_files", 0) + removed % batch
+            write_json_atomic(_meta_path(pid), entry)
+
+            # 参照の無くなったブロブだけを削除する
+            blob_store.release_project(pid)
+            os.remove(_meta_path(pid))
+    except BlockingIOError:
+        # 別のワーカーが解放中または元に戻している
+        return False
+    _remove_lock(pid)
+    return True
+
+# 取り消せる期間を過ぎたプロジェクトをすべて解放し，解放したプロジェクトIDを返す
+def reclaim_expired(stop: Optional[threading.Event] = None) -> List[str]:
+    stop = stop or threading.Event()
+    reclaimed = []
+    for entry in trash_entries():
+        if stop.is_set():
+            break
+        if entry["state"] != "trashed" and _reclaim(entry["project_id"], stop):
+            reclaimed.append(entry["project_id"])
+    return reclaimed
+
+# ゴミ箱のプロジェクトを定期的に解放するバックグラウンドタスク
+class TrashReclaimer:
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+        self._wake: Optional[asyncio.Event] = None
+        self._stop = threading.Event()
+
+    def start(self):
+        self._stop.clear()
+        self._wake = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    # 次の間隔を待たずに解放を始める
+    def wake(self):
+        if self._wake is not None:
+            self._wake.set()
+
+    async def _run(self):
+        while not self._stop.is_set():
+            try:
+                await run_in_threadpool(reclaim_expired, self._stop)
+            except Exception:
+                import traceback
+                traceback.print_exc()
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=TRASH_SCAN_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+    # 削除中のプロジェクトはバッチの区切りで止め，次回の起動時に続きから削除する
+    async def stop(self):
+        if self._task is None:
+            return
+        self._stop.set()
+        self._wake.set()
+        await self._task
+        self._task = None
+
+reclaimer = TrashReclaimer()
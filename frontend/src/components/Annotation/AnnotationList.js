@@ -22,6 +22,8 @@ const AnnotationList = ({ pid }) => {
   const [menuOpen, setMenuOpen] = useState(false);
 
   const [isLoading, setIsLoading] = useState(true);
+  // 変更フィードを購読し始める位置 (一覧を取得した時点の seq)
+  const [feedSince, setFeedSince] = useState(null);
 
   // 画像のインデックスをリロードせずに保持するためのref
   const imageIndexRef = useRef(currentImageIndex);
@@ -40,6 +42,7 @@ const AnnotationList = ({ pid }) => {
       setDescription(data.project_info.description);
       setModel(data.project_info.model);
       setProjectNameUpdate(data.project_info.name);
+      setFeedSince(data.change_seq);
     } catch (error) {
       console.error("Failed to fetch annotations:", error);
     } finally {
@@ -47,19 +50,55 @@ const AnnotationList = ({ pid }) => {
     }
   };
 
+  // 一覧は ETag で検証されるため，画像の移動ごとには再取得しない
   useEffect(() => {
     fetchAnnotations();
-  }, [pid, currentImageIndex]);
+  }, [pid]);
 
+  // 他の作業者の変更を変更フィード (Server-Sent Events) で受け取り，変わったレコードだけを反映する
+  // 接続が切れた場合はブラウザが Last-Event-ID を付けて再接続し，その続きから受け取る
+  useEffect(() => {
+    if (feedSince === null) {
+      return;
+    }
+    const source = new EventSource(
+      `${backendurl}/annotation/changes?pid=${encodeURIComponent(pid)}&since=${feedSince}`
+    );
+    source.addEventListener("change", (event) => {
+      const change = JSON.parse(event.data);
+      setAnnotations((prev) => {
+        if (change.op === "delete") {
+          return prev.filter((anno) => anno.image !== change.image);
+        }
+        const index = prev.findIndex((anno) => anno.image === change.annotation.image);
+        if (index === -1) {
+          return [...prev, change.annotation];
+        }
+        return prev.map((anno, i) => (i === index ? change.annotation : anno));
+      });
+    });
+    // サーバーに変更履歴が残っていない場合は一覧を取り直す
+    source.addEventListener("reset", () => {
+      fetchAnnotations();
+    });
+    source.addEventListener("deleted", () => {
+      source.close();
+      navigate("/projects");
+    });
+    return () => source.close();
+  }, [pid, feedSince]);
+
+  // 表示中のレコードが変わった場合だけ入力欄を設定し直す (他のレコードの変更では入力中の内容を消さない)
+  const displayedAnnotation = annotations[currentImageIndex];
   useEffect(() => {
     // 現在のアノテーション情報を設定
-    if (annotations.length > 0 && annotations[imageIndexRef.current]) {
-      const currentAnnotation = annotations[imageIndexRef.current];
-      setRole(currentAnnotation.sys || "");
-      setInstruction(currentAnnotation.user || "");
-      setExpectedResponse(currentAnnotation.label || "");
+    if (displayedAnnotation) {
+      setDataSplit(displayedAnnotation.dataset_split);
+      setRole(displayedAnnotation.sys || "");
+      setInstruction(displayedAnnotation.user || "");
+      setExpectedResponse(displayedAnnotation.label || "");
     }
-  }, [currentImageIndex, annotations]);
+  }, [currentImageIndex, displayedAnnotation]);
 
   useEffect(() => {
     const handleKeyDown = (event) => {
@@ -123,14 +162,16 @@ const AnnotationList = ({ pid }) => {
       const result = await response.json();
       console.log("Annotation updated successfully:", result);
 
-      // 再度アノテーションを取得
-      setIsLoading(true); // ローディング開始
-      const updatedAnnotationsResponse = await fetch(
-        `${backendurl}/annotation/get_annotations?pid=${pid}`
+      // 保存は受け付けの確認だけが返るため，送った内容をそのまま反映する
+      // (サーバー側の最新の内容は変更フィードで届く)
+      const updatedIndex = imageIndexRef.current;
+      setAnnotations((prev) =>
+        prev.map((anno, index) =>
+          index === updatedIndex
+            ? { ...anno, sys: role, user: instruction, label: expectedResponse, dataset_split: data_split, draft: false, version: result.version }
+            : anno
+        )
       );
-      const updatedAnnotationsData = await updatedAnnotationsResponse.json();
-      setAnnotations(updatedAnnotationsData.annotations);
-      setProjectName(updatedAnnotationsData.projectName);
       handleNextImage();
     } catch (error) {
       if (error.response) {
@@ -143,55 +184,15 @@ const AnnotationList = ({ pid }) => {
     }
   };
 
-  const handleDownloadDataset = async () => {
-    try {
-      const response = await fetch(`${backendurl}/annotation/generate-jsonl?pid=${pid}`, {
-        method: "POST",
-      });
-
-      if (!response.ok) {
-        const errorData = await response.json();
-        throw new Error(errorData.detail || "Failed to generate dataset");
-      }
-
-      // Train と Val ファイルのURLを取得
-      const result = await response.json();
-      const trainFileUrl = `${backendurl}/annotation/download?path=${result.train_file}`;
-      const valFileUrl = `${backendurl}/annotation/download?path=${result.val_file}`;
-
-      // Train ファイルのダウンロード
-      const trainResponse = await fetch(trainFileUrl);
-      if (!trainResponse.ok) {
-        throw new Error("Failed to download train dataset");
-      }
-      const trainBlob = await trainResponse.blob();
-      const trainUrl = window.URL.createObjectURL(trainBlob);
-      const trainLink = document.createElement("a");
-      trainLink.href = trainUrl;
-      trainLink.download = `train.jsonl`;
-      document.body.appendChild(trainLink);
-      trainLink.click();
-      trainLink.remove();
-      window.URL.revokeObjectURL(trainUrl);
-
-      // Val ファイルのダウンロード
-      const valResponse = await fetch(valFileUrl);
-      if (!valResponse.ok) {
-        throw new Error("Failed to download val dataset");
-      }
-      const valBlob = await valResponse.blob();
-      const valUrl = window.URL.createObjectURL(valBlob);
-      const valLink = document.createElement("a");
-      valLink.href = valUrl;
-      valLink.download = `val.jsonl`;
-      document.body.appendChild(valLink);
-      valLink.click();
-      valLink.remove();
-      window.URL.revokeObjectURL(valUrl);
-
-    } catch (error) {
-      console.error("Error downloading dataset:", error);
-    }
+  const handleDownloadDataset = () => {
+    // train / val をまとめた zip をサーバー側で生成しながらストリーミングで受け取る
+    // (ブラウザのダウンロードとしてディスクに直接書き込むため，巨大なデータセットでもメモリに載せない)
+    const link = document.createElement("a");
+    link.href = `${backendurl}/annotation/download-dataset?pid=${encodeURIComponent(pid)}&format=zip`;
+    link.download = `${pid}_dataset.zip`;
+    document.body.appendChild(link);
+    link.click();
+    link.remove();
   };
 
   const handleDeleteProject = async (projectId) => {
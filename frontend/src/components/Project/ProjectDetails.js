@@ -1,31 +1,20 @@
-import React, { useState, useEffect } from "react";
+import React from "react";
 import { useNavigate } from "react-router-dom";
 
-const ProjectDetails = ({ image, title, price, pid }) => {
+const ProjectDetails = ({ image, thumbnail, imageExists, title, price, pid }) => {
     const backendurl = process.env.REACT_APP_BACKEND_URL;
     const navigate = useNavigate();
 
-    useEffect(() => {
-        const checkImageExists = async () => {
-            try {
-                const apiImageUrl = `${backendurl}/images${image.replace(
-                    "/4ovisionannotator/backend/datas",
-                    ""
-                )}`;
-                const response = await fetch(apiImageUrl, { method: "HEAD" });
-                console.log("Image check:", apiImageUrl, response.ok);
-            } catch (error) {
-                console.error("Image check failed:", error);
-            }
-        };
-        checkImageExists();
-    }, [image, backendurl]);
-
-    const imageUrl = `${backendurl}/images${image.replace(
-        "/4ovisionannotator/backend/datas",
-        ""
-    )}`;
-    console.log("Image URL:", imageUrl);
+    // サムネイルがある場合は縮小画像を表示する
+    // 画像が見つからない場合 (一覧でまとめて確認した結果) は背景色だけを表示する
+    const imageUrl = imageExists === false
+        ? null
+        : thumbnail
+            ? `${backendurl}${thumbnail}`
+            : `${backendurl}/images${image.replace(
+                "/4ovisionannotator/backend/datas",
+                ""
+            )}`;
 
     // カードクリック時に/annotation/:pidに遷移
     const handleCardClick = () => {
@@ -37,7 +26,7 @@ const ProjectDetails = ({ image, title, price, pid }) => {
             <div
                 className="w-full h-[200px] bg-center bg-no-repeat bg-cover rounded-lg"
                 style={{
-                    backgroundImage: `url(${imageUrl})`,
+                    backgroundImage: imageUrl ? `url(${imageUrl})` : "none",
                     backgroundColor: "#f0f0f0",
                 }}
             ></div>
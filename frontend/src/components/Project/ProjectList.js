@@ -61,6 +61,27 @@ const ProjectList = () => {
     const currentProjects = projects.slice(indexOfFirstProject, indexOfLastProject);
     const totalPages = Math.ceil(projects.length / projectsPerPage);
 
+    // 表示中のプロジェクトの代表画像が存在するかを1回のリクエストでまとめて確認する
+    const [imageExists, setImageExists] = useState({});
+    const imagePath = (image) => image.split("/datas/").pop();
+    const currentImages = currentProjects
+        .filter((project) => project.first_image)
+        .map((project) => imagePath(project.first_image));
+    const currentImagesKey = currentImages.join("\n");
+
+    useEffect(() => {
+        if (currentImages.length === 0) return;
+        fetch(`${backendurl}/projects/images/exists`, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ paths: currentImages }),
+        })
+            .then(response => response.json())
+            .then(data => setImageExists(prev => ({ ...prev, ...data.exists })))
+            .catch(error => console.error('Error checking images:', error));
+    // eslint-disable-next-line react-hooks/exhaustive-deps
+    }, [currentImagesKey, backendurl]);
+
     const handlePageChange = (pageNumber) => {
         setCurrentPage(pageNumber);
     };
@@ -203,6 +224,8 @@ const ProjectList = () => {
                             <ProjectDetails
                                 key={index}
                                 image={project.first_image || 'https://via.placeholder.com/150'}
+                                thumbnail={project.thumbnail}
+                                imageExists={project.first_image ? imageExists[imagePath(project.first_image)] : false}
                                 title={project.name}
                                 price={project.created_at}
                                 pid={project.id}